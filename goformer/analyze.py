@@ -0,0 +1,316 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+from goformer.batched_rules import to_point
+from goformer.dedup import MOVE_POINTS, read_lines
+from goformer.goformer import GoFormer
+from goformer.rules import GoGame
+from goformer.threads import load_thread_config, set_threads
+
+
+GAMES_FILE = "games.jsonl"
+RESULT_PATTERN = re.compile(r"^([BW])\+([0-9.]+|R)$", re.IGNORECASE)
+
+_worker_agent: Optional[GoFormer] = None
+_worker_config: Dict = {}
+
+
+def _init_worker(artifact_dir: str, threads_per_worker: int, config: Dict):
+    global _worker_agent, _worker_config
+    set_threads(threads_per_worker)
+    logging.getLogger().setLevel(logging.WARNING)
+    _worker_agent = GoFormer(artifact_dir, 'b', context_window=config["context_window"])
+    _worker_config = config
+
+
+def check_score(record: dict, black_score: float, white_score: float) -> Optional[bool]:
+    """Whether the scores of the local rules agree with the recorded ones, None if the record has none to check"""
+    if "black_score" in record and "white_score" in record:
+        return abs(record["black_score"] - black_score) < 1e-6 and abs(record["white_score"] - white_score) < 1e-6
+    match = RESULT_PATTERN.match(str(record.get("result", "")).strip())
+    if match is None or match.group(2).upper() == "R":
+        return None
+    margin = black_score - white_score
+    return match.group(1).upper() == ("B" if margin > 0 else "W") and abs(abs(margin) - float(match.group(2))) < 1e-6
+
+
+def _empty_columns(n_moves: int) -> Dict[str, np.ndarray]:
+    return {"ply": np.arange(n_moves, dtype=np.int16),
+            "played": np.zeros(n_moves, dtype=np.int16),
+            "best": np.zeros(n_moves, dtype=np.int16),
+            "played_prob": np.zeros(n_moves, dtype=np.float32),
+            "best_prob": np.zeros(n_moves, dtype=np.float32),
+            "rank": np.zeros(n_moves, dtype=np.int16)}
+
+
+def analyze_game(item: Tuple[str, dict]) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    Replay a game record, score every position with GoFormer and compare it with the move played.
+    Returns the summary of the game and its per-move columns. A record that cannot be analysed gets a summary
+    with its error and no moves, so that the run and its resumption move on.
+    """
+    game_id, record = item
+    try:
+        return _analyze_game(game_id, record)
+    except Exception as e:
+        logging.warning(f"Cannot analyse game {game_id}: {e!r}")
+        return {"game_id": game_id, "error": repr(e), "moves": 0, "blunders": [], "score_check": None}, \
+            _empty_columns(0)
+
+
+def _analyze_game(game_id: str, record: dict) -> Tuple[dict, Dict[str, np.ndarray]]:
+    agent = _worker_agent
+    config = _worker_config
+    game = GoGame("B", record.get("komi", config["komi"]))
+    prompts, colors, legal_moves, played = [], [], [], []
+    diverged = None
+    for move in record["moves"]:
+        move = str(move).upper()
+        if move == "RESIGN":
+            break
+        color = game.current_player.lower()
+        prompt = agent.history_to_model_rounds(game.get_move_history(), color)
+        legal = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+        if move not in MOVE_POINTS or not game.play(move):
+            # the positions after it would not be the ones of the game, nor the final score
+            logging.debug(f"Illegal move {move} at ply {len(played)} of game {game_id}, stopping the replay")
+            diverged = {"ply": len(played), "move": move}
+            break
+        prompts.append(prompt)
+        colors.append(color)
+        legal_moves.append(legal)
+        played.append(move)
+
+    n_moves = len(played)
+    columns = _empty_columns(n_moves)
+    columns["played"][:] = [to_point(m) for m in played]
+    blunders = []
+    batch_size = config["batch_size"]
+    for start in range(0, n_moves, batch_size):
+        distributions = agent.move_distribution_batch(prompts[start:start + batch_size],
+                                                      colors[start:start + batch_size],
+                                                      legal_moves[start:start + batch_size])
+        for ply, distribution in enumerate(distributions, start):
+            best = max(distribution, key=distribution.get)
+            played_prob = distribution.get(played[ply], 0.0)
+            columns["best"][ply] = to_point(best)
+            columns["played_prob"][ply] = played_prob
+            columns["best_prob"][ply] = distribution[best]
+            columns["rank"][ply] = 1 + sum(p > played_prob for p in distribution.values())
+            # GoFormer was confident in another move, and the played one is far less likely
+            if distribution[best] - played_prob >= config["blunder_drop"]:
+                blunders.append({"ply": ply, "move": played[ply], "prob": round(played_prob, 4), "best": best,
+                                 "best_prob": round(distribution[best], 4)})
+
+    game.calculate_score()
+    agreement = columns["rank"] == 1
+    summary = {
+        "game_id": game_id,
+        "moves": n_moves,
+        "agreement": float(agreement.mean()) if n_moves else None,
+        "mean_logprob": float(np.log(np.maximum(columns["played_prob"], 1e-12)).mean()) if n_moves else None,
+        "blunders": blunders,
+        "diverged": diverged,
+        "black_score": game.black_score,
+        "white_score": game.white_score,
+        "recorded_result": record.get("result"),
+        "score_check": None if diverged else check_score(record, game.black_score, game.white_score),
+    }
+    return summary, columns
+
+
+class AnalysisWriter:
+    """
+    Writes game summaries to games.jsonl and their per-move columns to numpy shards (moves-<n>.npz), every
+    `flush_every` games. A shard is written under a temporary name and renamed before its summaries are appended,
+    so the summaries list the games done; on resume, a shard whose games are not all listed is left from an
+    interrupted flush: it is removed with the summaries of its games, which are analysed again.
+    """
+    def __init__(self, output_dir: str, flush_every: int = 64):
+        self._output_dir = output_dir
+        self._flush_every = flush_every
+        os.makedirs(output_dir, exist_ok=True)
+        self.completed_game_ids = set()
+        path = os.path.join(output_dir, GAMES_FILE)
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                # a line cut by an interruption: its game is analysed again
+                f.truncate(f.read().rfind(b"\n") + 1)
+            with open(path) as f:
+                self.completed_game_ids.update(json.loads(line)["game_id"] for line in f)
+        self._n_shards = 0
+        orphaned = set()
+        for name in sorted(os.listdir(output_dir)):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(output_dir, name))
+            elif name.startswith("moves-") and name.endswith(".npz"):
+                with np.load(os.path.join(output_dir, name)) as shard:
+                    game_ids = set(shard["game_ids"].tolist())
+                if game_ids <= self.completed_game_ids:
+                    self._n_shards += 1
+                else:
+                    logging.warning(f"Removing {name} and its games, written by an interrupted flush")
+                    os.remove(os.path.join(output_dir, name))
+                    orphaned |= game_ids
+        if orphaned & self.completed_game_ids:
+            with open(path) as f, open(path + ".tmp", "w") as out:
+                out.writelines(line for line in f if json.loads(line)["game_id"] not in orphaned)
+            os.replace(path + ".tmp", path)
+            self.completed_game_ids -= orphaned
+        self._summaries: List[dict] = []
+        self._columns: List[Dict[str, np.ndarray]] = []
+
+    def write(self, summary: dict, columns: Dict[str, np.ndarray]):
+        self._summaries.append(summary)
+        self._columns.append(columns)
+        if len(self._summaries) >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._summaries:
+            return
+        path = os.path.join(self._output_dir, f"moves-{self._n_shards:05d}.npz")
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f,
+                     game_ids=np.array([s["game_id"] for s in self._summaries]),
+                     offsets=np.cumsum([0] + [len(c["ply"]) for c in self._columns]),
+                     **{name: np.concatenate([c[name] for c in self._columns]) for name in self._columns[0]})
+        os.replace(path + ".tmp", path)
+        self._n_shards += 1
+        with open(os.path.join(self._output_dir, GAMES_FILE), "a") as f:
+            f.write("".join(json.dumps(s) + "\n" for s in self._summaries))
+        self.completed_game_ids.update(s["game_id"] for s in self._summaries)
+        self._summaries, self._columns = [], []
+
+
+def read_games(paths: List[str]) -> Iterator[Tuple[str, dict]]:
+    """(game id, record) of every game record; a record without "game_id" is identified by its position"""
+    for i, line in enumerate(read_lines(paths)):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = {}  # analysed as an error
+        yield str(record.get("game_id", record.get("game", i))), record
+
+
+def run_analysis(artifact_dir: str,
+                 paths: List[str],
+                 output_dir: str,
+                 workers: int = 1,
+                 threads_per_worker: int = 1,
+                 batch_size: int = 32,
+                 blunder_drop: float = 0.5,
+                 context_window: Optional[int] = None,
+                 komi: float = 7.5,
+                 flush_every: int = 64,
+                 log_interval: float = 10.0,
+                 count: bool = True) -> Dict[str, float]:
+    """
+    Analyse every game of `paths` across a pool of `workers` processes, each holding a GoFormer. Games already in
+    `output_dir` are skipped. At most a few games per worker are in flight, so archives are streamed.
+    """
+    writer = AnalysisWriter(output_dir, flush_every)
+    done = writer.completed_game_ids
+    total = sum(1 for game_id, _ in read_games(paths) if game_id not in done) if count else None
+    if done:
+        logging.info(f"Resuming: {len(done)} games already analysed"
+                     + (f", {total} to go" if total is not None else ""))
+    config = {"komi": komi, "batch_size": batch_size, "blunder_drop": blunder_drop, "context_window": context_window}
+
+    n_games = n_moves = n_agreed = n_blunders = n_score_mismatches = n_errors = 0
+    start_time = last_log_time = time.time()
+
+    def log_progress():
+        seconds = time.time() - start_time
+        games_per_second = n_games / seconds if seconds else 0.0
+        eta = (f", ETA {(total - n_games) / games_per_second / 60:.1f} min"
+               if total is not None and games_per_second else "")
+        logging.info(f"{n_games}{'/' + str(total) if total is not None else ''} games, "
+                     f"{games_per_second:.2f} games/s, {n_moves / seconds if seconds else 0:.0f} moves/s, "
+                     f"agreement {n_agreed / max(n_moves, 1):.1%}, {n_blunders} blunders, "
+                     f"{n_score_mismatches} score mismatches, {n_errors} errors{eta}")
+
+    games = ((game_id, record) for game_id, record in read_games(paths) if game_id not in done)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(artifact_dir, threads_per_worker, config)) as executor:
+        in_flight = set()
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < 4 * workers:
+                item = next(games, None)
+                if item is None:
+                    exhausted = True
+                else:
+                    in_flight.add(executor.submit(analyze_game, item))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                summary, columns = future.result()
+                writer.write(summary, columns)
+                n_games += 1
+                n_moves += summary["moves"]
+                n_agreed += int((columns["rank"] == 1).sum())
+                n_blunders += len(summary["blunders"])
+                n_score_mismatches += summary["score_check"] is False
+                n_errors += "error" in summary
+            if time.time() - last_log_time >= log_interval:
+                last_log_time = time.time()
+                log_progress()
+    writer.flush()
+    log_progress()
+    return {"games": n_games, "moves": n_moves, "agreement": n_agreed / max(n_moves, 1), "blunders": n_blunders,
+            "score_mismatches": n_score_mismatches, "errors": n_errors, "seconds": time.time() - start_time}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Analyse archives of finished games with GoFormer")
+    parser.add_argument("games", nargs="+", help="game records (.jsonl or .jsonl.gz) or directories of them")
+    parser.add_argument("--output-dir", required=True, help="games.jsonl and moves-*.npz, resumed from")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="default: from the thread config of goformer.threads, else the number of cores")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch intra-op threads per worker (default: from the thread config, else 1)")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="positions per forward pass (default: from the thread config, else 32)")
+    parser.add_argument("--blunder-drop", type=float, default=0.5,
+                        help="a move is a blunder when its probability is this far below the best move's")
+    parser.add_argument("--context-window", type=int, default=None, help="see GoFormer")
+    parser.add_argument("--komi", type=float, default=7.5, help="komi of the records without one")
+    parser.add_argument("--flush-every", type=int, default=64, help="games between two writes")
+    parser.add_argument("--log-interval", type=float, default=10.0, help="seconds between two progress lines")
+    parser.add_argument("--no-count", action="store_true", help="do not count the games first, no ETA")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    thread_config = load_thread_config() or {}
+    args.workers = args.workers or thread_config.get("workers") or os.cpu_count()
+    args.threads_per_worker = args.threads_per_worker or thread_config.get("intra_op_threads") or 1
+    args.batch_size = args.batch_size or thread_config.get("batch_size") or 32
+    result = run_analysis(args.model, args.games, args.output_dir,
+                          workers=args.workers,
+                          threads_per_worker=args.threads_per_worker,
+                          batch_size=args.batch_size,
+                          blunder_drop=args.blunder_drop,
+                          context_window=args.context_window,
+                          komi=args.komi,
+                          flush_every=args.flush_every,
+                          log_interval=args.log_interval,
+                          count=not args.no_count)
+    print(f"{result['games']} games, {result['moves']} moves in {result['seconds']:.1f}s: "
+          f"agreement {result['agreement']:.1%}, {result['blunders']} blunders, "
+          f"{result['score_mismatches']} score mismatches, {result['errors']} errors")
+
+
+if __name__ == '__main__':
+    main()
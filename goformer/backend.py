@@ -0,0 +1,187 @@
+from typing import Dict, List, Optional, Tuple
+import logging
+import warnings
+import torch
+
+
+def expand_past_key_values(past_key_values, repeats: int):
+    """Repeat every sequence of a KV cache `repeats` times along the batch dimension"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        # transformers Cache object
+        expanded = expand_past_key_values(past_key_values.to_legacy_cache(), repeats)
+        return type(past_key_values).from_legacy_cache(expanded)
+    return tuple(tuple(t.repeat_interleave(repeats, dim=0) for t in layer) for layer in past_key_values)
+
+
+def crop_past_key_values(past_key_values, length: int):
+    """Keep the first `length` positions of a KV cache, as a tuple of (key, value) per layer"""
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in _to_legacy_cache(past_key_values))
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+class EagerBackend:
+    """
+    Runs the two forward passes that score every move: a prefill over the (left padded) model inputs, and a decode
+    step of every column token on top of it.
+    """
+    def __init__(self, model, column_token_ids: List[int]):
+        self._model = model
+        self._column_token_ids = torch.tensor(column_token_ids)
+
+    def prefill(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor,
+                past_key_values=None):
+        """
+        Logits of the token after each input, and the KV cache as a tuple of (key, value) per layer.
+        The inputs may continue the KV cache of a prefix, the attention mask then covers the prefix too.
+        """
+        outputs = self._model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                              past_key_values=past_key_values, use_cache=True)
+        return outputs.logits[:, -1], _to_legacy_cache(outputs.past_key_values)
+
+    def decode(self, past_key_values, attention_mask: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
+        """Logits of the token after every column token, [batch * columns, vocabulary]"""
+        batch_size = attention_mask.shape[0]
+        n_columns = self._column_token_ids.shape[0]
+        outputs = self._model(
+            input_ids=self._column_token_ids.repeat(batch_size).unsqueeze(-1),
+            attention_mask=torch.cat([attention_mask, torch.ones(batch_size, 1, dtype=attention_mask.dtype)],
+                                     dim=-1).repeat_interleave(n_columns, dim=0),
+            position_ids=(position_ids[:, -1:] + 1).repeat_interleave(n_columns, dim=0),
+            past_key_values=expand_past_key_values(past_key_values, n_columns),
+            use_cache=True,
+        )
+        return outputs.logits[:, -1]
+
+    @torch.no_grad()
+    def move_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                    position_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Logits of the next token [batch, vocabulary], and after each column [batch * columns, vocabulary]"""
+        first_logits, past_key_values = self.prefill(input_ids, attention_mask, position_ids)
+        return first_logits, self.decode(past_key_values, attention_mask, position_ids)
+
+
+class _PrefillModule(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids):
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             use_cache=True, return_dict=False)
+        return outputs[0][:, -1], _to_legacy_cache(outputs[1])
+
+
+class _DecodeModule(torch.nn.Module):
+    def __init__(self, backend: EagerBackend):
+        super().__init__()
+        self.model = backend._model
+        self.backend = backend
+
+    def forward(self, past_key_values, attention_mask, position_ids):
+        return self.backend.decode(past_key_values, attention_mask, position_ids)
+
+
+class CompiledBackend(EagerBackend):
+    """
+    Same as EagerBackend with TorchScript graphs traced for fixed shapes, which removes most of the Python and
+    dispatch overhead of the small forward passes.
+    Inputs are left padded to a multiple of `bucket_size` tokens, so that a graph is traced for each batch size and
+    bucket, and the decode step reads a KV cache of static length.
+    """
+    def __init__(self, model, column_token_ids: List[int], pad_token_id: int = 0, bucket_size: int = 32,
+                 max_positions: Optional[int] = None, max_graphs: int = 32):
+        """
+        :param model: the causal language model
+        :param column_token_ids: the column tokens decoded on top of the prefill
+        :param pad_token_id: token id used for left padding
+        :param bucket_size: inputs are padded to a multiple of this length
+        :param max_positions: model's maximum positions, the last bucket is cut to leave room for the decode step
+        :param max_graphs: traced graphs kept, the oldest is dropped beyond
+        """
+        super().__init__(model, column_token_ids)
+        self._pad_token_id = pad_token_id
+        self._bucket_size = bucket_size
+        self._max_positions = max_positions
+        self._max_graphs = max_graphs
+        self._graphs: Dict[Tuple[int, int], Tuple[torch.jit.ScriptModule, torch.jit.ScriptModule]] = {}
+
+    def _bucket(self, length: int) -> int:
+        bucket = -(-length // self._bucket_size) * self._bucket_size
+        if self._max_positions is not None:
+            bucket = min(bucket, self._max_positions - 1)
+        return max(bucket, length)
+
+    def _trace(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor):
+        logging.debug(f"Tracing graphs for batch size {input_ids.shape[0]} and length {input_ids.shape[1]}")
+        with warnings.catch_warnings():
+            # shape dependent branches are fixed on purpose, a graph only serves the shapes it was traced for
+            warnings.simplefilter("ignore")
+            prefill = torch.jit.trace(_PrefillModule(self._model), (input_ids, attention_mask, position_ids),
+                                      check_trace=False)
+            _, past_key_values = prefill(input_ids, attention_mask, position_ids)
+            decode = torch.jit.trace(_DecodeModule(self), (past_key_values, attention_mask, position_ids),
+                                     check_trace=False)
+            return torch.jit.freeze(prefill.eval()), torch.jit.freeze(decode.eval())
+
+    @torch.no_grad()
+    def move_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                    position_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size, length = input_ids.shape
+        padding = self._bucket(length) - length
+        if padding:
+            input_ids = torch.cat([torch.full((batch_size, padding), self._pad_token_id, dtype=input_ids.dtype),
+                                   input_ids], dim=-1)
+            attention_mask = torch.cat([torch.zeros(batch_size, padding, dtype=attention_mask.dtype),
+                                        attention_mask], dim=-1)
+            position_ids = torch.cat([torch.zeros(batch_size, padding, dtype=position_ids.dtype), position_ids],
+                                     dim=-1)
+        key = tuple(input_ids.shape)
+        if key not in self._graphs:
+            if len(self._graphs) >= self._max_graphs:
+                self._graphs.pop(next(iter(self._graphs)))
+            self._graphs[key] = self._trace(input_ids, attention_mask, position_ids)
+        prefill, decode = self._graphs[key]
+        first_logits, past_key_values = prefill(input_ids, attention_mask, position_ids)
+        return first_logits, decode(past_key_values, attention_mask, position_ids)
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import time
+    import numpy as np
+    from goformer.goformer import GoFormer, Round, alphabets_wo_I
+
+    parser = argparse.ArgumentParser(description="Per-move latency of the eager and compiled backends")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[1, 25, 50], help="game lengths to benchmark")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    agents = {backend: GoFormer(args.model, 'b', backend=backend, exact_scoring=True) for backend in ("eager", "compiled")}
+    rng = random.Random(0)
+    points = [f"{x}{y}" for x in alphabets_wo_I for y in range(1, 20)]
+    for n_rounds in args.rounds:
+        moves = rng.sample(points, 2 * (n_rounds - 1))
+        history = [Round(n=i + 1, black_move=moves[2 * i], white_move=moves[2 * i + 1]) for i in range(n_rounds - 1)]
+        history.append(Round(n=n_rounds, black_move=None, white_move=None))
+        suggestions = {}
+        latencies = {}
+        for backend, agent in agents.items():
+            suggestions[backend] = agent.suggest_moves(history, n_suggestion=10)  # warm up, traces the graphs
+            timings = []
+            for _ in range(args.repeats):
+                start_time = time.perf_counter()
+                agent.suggest_moves(history, n_suggestion=10)
+                timings.append(time.perf_counter() - start_time)
+            latencies[backend] = float(np.median(timings))
+        same_top_k = [m for m, _ in suggestions["eager"]] == [m for m, _ in suggestions["compiled"]]
+        print(f"{n_rounds} rounds: eager {latencies['eager'] * 1000:.1f}ms, "
+              f"compiled {latencies['compiled'] * 1000:.1f}ms "
+              f"({latencies['eager'] / latencies['compiled']:.1f}x), identical top 10: {same_top_k}")
@@ -0,0 +1,314 @@
+from typing import List, Optional, Tuple
+import argparse
+import logging
+import random
+import time
+import numpy as np
+from goformer.rules import BOARD_SIZE, GTP_COLUMNS, ZOBRIST_STONES, GoGame
+
+
+N_POINTS = BOARD_SIZE * BOARD_SIZE
+PASS = N_POINTS  # the move index of a pass
+EMPTY, BLACK, WHITE, OFF_BOARD = 0, 1, 2, 3
+COLORS = {BLACK: 'B', WHITE: 'W'}
+
+# Boards are stored flat with a border of OFF_BOARD cells, so the neighbours of the points are four shifted slices
+PADDED = BOARD_SIZE + 2
+N_CELLS = PADDED * PADDED
+SPAN = slice(PADDED + 1, N_CELLS - PADDED - 1)  # from the first point to the last, with the borders in between
+DIRECTIONS = (PADDED, 1, -PADDED, -1)
+CELL_OF_POINT = np.array([(y + 1) * PADDED + x + 1 for y in range(BOARD_SIZE) for x in range(BOARD_SIZE)])
+SPAN_OF_POINT = CELL_OF_POINT - SPAN.start
+# [cell, colour]: the Zobrist keys of goformer.rules, so that the hashes of both engines agree
+ZOBRIST = np.zeros((N_CELLS, 3), dtype=np.uint64)
+for (_x, _y, _color), _key in ZOBRIST_STONES.items():
+    ZOBRIST[(_y + 1) * PADDED + _x + 1, BLACK if _color == 'B' else WHITE] = _key
+
+
+def _shifted(cells: np.ndarray, direction: int) -> np.ndarray:
+    """[batch, span]: the neighbour in `direction` of every cell of the span"""
+    return cells[:, SPAN.start + direction:SPAN.stop + direction]
+
+
+def to_point(move: str) -> int:
+    """Move index of a GTP move"""
+    if move.upper() == "PASS":
+        return PASS
+    return (BOARD_SIZE - int(move[1:])) * BOARD_SIZE + GTP_COLUMNS.index(move[0].upper())
+
+
+def to_gtp(point: int) -> str:
+    if point == PASS:
+        return "PASS"
+    y, x = divmod(int(point), BOARD_SIZE)
+    return f"{GTP_COLUMNS[x]}{BOARD_SIZE - y}"
+
+
+def connected_components(board: np.ndarray) -> np.ndarray:
+    """
+    [batch, cell]: for every point, the smallest cell of its chain, the points of the same value (stones of a
+    colour, or empty points) connected to it; the border cells are their own labels. Labels spread to same-valued
+    neighbours, with pointer jumping.
+    """
+    inside = board[:, SPAN] != OFF_BOARD
+    same = [inside & (_shifted(board, d) == board[:, SPAN]) for d in DIRECTIONS]
+    labels = np.broadcast_to(np.arange(N_CELLS, dtype=np.int32), board.shape).copy()
+    while True:
+        spread = labels[:, SPAN].copy()
+        for d, same_d in zip(DIRECTIONS, same):
+            np.minimum(spread, np.where(same_d, _shifted(labels, d), N_CELLS), out=spread)
+        jumped = labels.copy()
+        jumped[:, SPAN] = spread
+        jumped = np.take_along_axis(jumped, jumped, axis=1)
+        if np.array_equal(jumped, labels):
+            return labels
+        labels = jumped
+
+
+class BatchedGoGame:
+    """
+    B games of GoGame's rules in NumPy arrays, stepped together: one move per board per step.
+    Chains, liberties, legality, captures and area scores are computed for the whole batch with array operations.
+    Moves are indexed y * 19 + x like GoGame.board[y][x], and PASS is a move of every board.
+    """
+    def __init__(self, batch_size: int, komi: float = 7.5):
+        """
+        :param batch_size: number of boards
+        :param komi: added to White's score
+        """
+        self.batch_size = batch_size
+        self.komi = komi
+        self.cells = np.full((batch_size, N_CELLS), OFF_BOARD, dtype=np.int8)
+        self.cells[:, CELL_OF_POINT] = EMPTY
+        self.current_player = np.full(batch_size, BLACK, dtype=np.int8)
+        self.passed = np.zeros(batch_size, dtype=bool)
+        self.consecutive_passes = np.zeros(batch_size, dtype=np.int32)
+        self.game_over = np.zeros(batch_size, dtype=bool)
+        self.black_score = np.zeros(batch_size, dtype=np.float64)
+        self.white_score = np.full(batch_size, komi, dtype=np.float64)
+        self.stones_hash = np.zeros(batch_size, dtype=np.uint64)
+        # for the Ko rule: the stones before the opponent's last move, if it was not a pass
+        self.previous_stones_hash = np.zeros(batch_size, dtype=np.uint64)
+        self.has_previous = np.zeros(batch_size, dtype=bool)
+        self._analysis = None
+
+    @property
+    def board(self) -> np.ndarray:
+        """[batch, y, x] view of the boards"""
+        return self.cells.reshape(self.batch_size, PADDED, PADDED)[:, 1:-1, 1:-1]
+
+    def _analyse(self) -> dict:
+        """Chains of the current positions, their liberties, and what playing every point captures; until a step"""
+        if self._analysis is not None:
+            return self._analysis
+        cells = self.cells
+        rows = np.arange(self.batch_size)[:, None] * N_CELLS
+        labels = connected_components(cells)
+        neighbours = [_shifted(cells, d) for d in DIRECTIONS]
+        neighbour_labels = [_shifted(labels, d) for d in DIRECTIONS]
+        # a chain touching a point on several sides counts once
+        distinct = [np.ones_like(neighbour_labels[0], dtype=bool)]
+        for k in range(1, 4):
+            repeated = np.zeros_like(distinct[0])
+            for j in range(k):
+                repeated |= neighbour_labels[k] == neighbour_labels[j]
+            distinct.append(~repeated)
+        empty = cells[:, SPAN] == EMPTY
+        # distinct liberties of every chain, counted at its (empty point, side) pairs
+        liberty_pairs = np.concatenate([
+            (rows + neighbour_labels[k])[empty & distinct[k] & ((neighbours[k] == BLACK) | (neighbours[k] == WHITE))]
+            for k in range(4)])
+        liberties = np.bincount(liberty_pairs, minlength=self.batch_size * N_CELLS).reshape(self.batch_size, -1)
+        # XOR of the keys of every chain's stones, to hash the positions after a capture
+        stones = (cells == BLACK) | (cells == WHITE)
+        chain_hash = np.zeros(self.batch_size * N_CELLS, dtype=np.uint64)
+        np.bitwise_xor.at(chain_hash, (rows + labels)[stones],
+                          ZOBRIST[np.arange(N_CELLS), cells.astype(np.int64) % 3][stones])
+        chain_hash = chain_hash.reshape(self.batch_size, -1)
+
+        # what the current player captures by playing every point, and the stones hash after it
+        enemy = (3 - self.current_player)[:, None]
+        captures = [distinct[k] & (neighbours[k] == enemy)
+                    & (np.take_along_axis(liberties, neighbour_labels[k], axis=1) == 1)
+                    for k in range(4)]
+        hash_after = self.stones_hash[:, None] ^ ZOBRIST[SPAN, :][:, self.current_player].T
+        for k in range(4):
+            hash_after ^= np.where(captures[k], np.take_along_axis(chain_hash, neighbour_labels[k], axis=1),
+                                   np.uint64(0))
+        has_liberty = (neighbours[0] == EMPTY) | (neighbours[1] == EMPTY) | (neighbours[2] == EMPTY) \
+            | (neighbours[3] == EMPTY)
+        any_capture = captures[0] | captures[1] | captures[2] | captures[3]
+        ko = any_capture & self.has_previous[:, None] & (hash_after == self.previous_stones_hash[:, None])
+        legal = np.ones((self.batch_size, N_POINTS + 1), dtype=bool)
+        legal[:, :N_POINTS] = (empty & (has_liberty | any_capture) & ~ko)[:, SPAN_OF_POINT]
+        self._analysis = {"labels": labels, "neighbour_labels": neighbour_labels, "captures": captures,
+                          "hash_after": hash_after, "legal": legal}
+        return self._analysis
+
+    def legal_mask(self) -> np.ndarray:
+        """
+        [batch, 362]: the moves the current player may play, as GoGame.is_valid_move: an empty point where the new
+        stone has a liberty or captures, and that does not recreate the stones before the opponent's last move.
+        A pass is always legal.
+        """
+        return self._analyse()["legal"]
+
+    def step(self, moves: np.ndarray) -> np.ndarray:
+        """
+        Play one move per board: a point, PASS, or -1 to leave the board as it is. Like GoGame, an illegal move
+        changes nothing and a second consecutive pass ends the game. Returns whether each move was played.
+        """
+        moves = np.asarray(moves, dtype=np.int64)
+        analysis = self._analyse()
+        played = (moves >= 0) & analysis["legal"][np.arange(self.batch_size), np.maximum(moves, 0)]
+        passes = played & (moves == PASS)
+        stones = played & (moves != PASS)
+
+        # a pass after a pass ends the game and nothing else
+        ends = passes & self.passed
+        self.game_over |= ends
+        passes &= ~ends
+        self.passed[passes] = True
+        self.consecutive_passes[passes] += 1
+        self.has_previous[passes] = False
+
+        if stones.any():
+            b = np.flatnonzero(stones)
+            span_index = SPAN_OF_POINT[moves[b]]
+            player = self.current_player[b]
+            labels = analysis["labels"][b]
+            removed = np.zeros(labels.shape, dtype=bool)
+            for k in range(4):
+                captured = analysis["captures"][k][b, span_index]
+                captured_label = np.where(captured, analysis["neighbour_labels"][k][b, span_index], -1)
+                removed |= labels == captured_label[:, None]
+            self.previous_stones_hash[b] = self.stones_hash[b]
+            self.has_previous[b] = True
+            self.stones_hash[b] = analysis["hash_after"][b, span_index]
+            cells = self.cells[b]
+            cells[removed] = EMPTY
+            cells[np.arange(len(b)), CELL_OF_POINT[moves[b]]] = player
+            self.cells[b] = cells
+            n_captured = removed.sum(axis=1)
+            self.black_score[b] += np.where(player == BLACK, n_captured, 0)
+            self.white_score[b] += np.where(player == WHITE, n_captured, 0)
+            self.passed[b] = False
+            self.consecutive_passes[b] = 0
+
+        switched = passes | stones
+        self.current_player[switched] = 3 - self.current_player[switched]
+        self._analysis = None
+        return played
+
+    def area_scores(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Black's and White's scores as GoGame.calculate_score: stones, plus the empty regions bordered by stones of
+        one colour only, plus komi for White
+        """
+        cells = self.cells
+        rows = np.arange(self.batch_size)[:, None] * N_CELLS
+        labels = connected_components(cells)
+        empty = cells[:, SPAN] == EMPTY
+        region_of = rows + labels[:, SPAN]
+        touches = {}
+        for color in (BLACK, WHITE):
+            borders = np.zeros_like(empty)
+            for d in DIRECTIONS:
+                borders |= _shifted(cells, d) == color
+            touched = np.zeros(self.batch_size * N_CELLS, dtype=bool)
+            touched[region_of[empty & borders]] = True
+            touches[color] = touched[region_of]
+        black_stones = (cells == BLACK).sum(axis=1)
+        white_stones = (cells == WHITE).sum(axis=1)
+        black_territory = (empty & touches[BLACK] & ~touches[WHITE]).sum(axis=1)
+        white_territory = (empty & touches[WHITE] & ~touches[BLACK]).sum(axis=1)
+        return black_stones + black_territory, white_stones + white_territory + self.komi
+
+    def to_game(self, index: int) -> List[List[Optional[str]]]:
+        """The board of one game, in the format of GoGame.board"""
+        return [[COLORS.get(int(v)) for v in row] for row in self.board[index]]
+
+
+def random_moves(legal: np.ndarray, rng: np.random.Generator, pass_rate: float = 0.0) -> np.ndarray:
+    """A uniformly random legal point per board, or a pass with probability `pass_rate` or if there is none"""
+    scores = rng.random(legal.shape) * legal[:, :]
+    scores[:, PASS] = 0
+    moves = scores.argmax(axis=1)
+    no_point = scores.max(axis=1) == 0
+    return np.where(no_point | (rng.random(len(legal)) < pass_rate), PASS, moves)
+
+
+def verify(n_games: int = 16, max_moves: int = 400, seed: int = 0, pass_rate: float = 0.02) -> int:
+    """
+    Play seeded random games with both engines, comparing after every move the boards, stones hashes, capture
+    scores, passes and legal moves, and the area scores at the end. Returns the number of moves compared.
+    """
+    rng = np.random.default_rng(seed)
+    batch = BatchedGoGame(n_games)
+    games = [GoGame("B", batch.komi) for _ in range(n_games)]
+    n_compared = 0
+    for _ in range(max_moves):
+        legal = batch.legal_mask()
+        for i, game in enumerate(games):
+            expected = {y * BOARD_SIZE + x for x, y in game.legal_moves()}
+            assert set(np.flatnonzero(legal[i, :N_POINTS]).tolist()) == expected, f"Legal moves differ in game {i}"
+        moves = np.where(batch.game_over, -1, random_moves(legal, rng, pass_rate))
+        played = batch.step(moves)
+        for i, game in enumerate(games):
+            if moves[i] < 0:
+                continue
+            assert played[i] == game.play(to_gtp(moves[i])), f"Move {to_gtp(moves[i])} of game {i}"
+            assert batch.to_game(i) == game.board, f"Boards differ in game {i}"
+            assert int(batch.stones_hash[i]) == game.stones_hash, f"Hashes differ in game {i}"
+            assert (batch.black_score[i], batch.white_score[i]) == (game.black_score, game.white_score)
+            assert (bool(batch.passed[i]), bool(batch.game_over[i])) == (game.passed, game.game_over)
+            n_compared += 1
+        if batch.game_over.all():
+            break
+    black, white = batch.area_scores()
+    for i, game in enumerate(games):
+        game.calculate_score()
+        assert (black[i], white[i]) == (game.black_score, game.white_score), f"Area scores differ in game {i}"
+    return n_compared
+
+
+def benchmark(batch_size: int, n_steps: int = 100, seed: int = 0) -> float:
+    """Board-steps per second of random playouts, a legality mask and a move per board per step"""
+    rng = np.random.default_rng(seed)
+    batch = BatchedGoGame(batch_size)
+    start_time = time.perf_counter()
+    for _ in range(n_steps):
+        batch.step(random_moves(batch.legal_mask(), rng))
+    return batch_size * n_steps / (time.perf_counter() - start_time)
+
+
+def benchmark_gogame(n_steps: int = 100, seed: int = 0) -> float:
+    """Steps per second of the same playouts on a single GoGame"""
+    rng = random.Random(seed)
+    game = GoGame("B", 7.5)
+    start_time = time.perf_counter()
+    for _ in range(n_steps):
+        moves = game.legal_moves()
+        if moves:
+            game.place_stone(*rng.choice(moves))
+        else:
+            game.pass_turn()
+    return n_steps / (time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the batched rules against GoGame and benchmark them")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 64, 256, 1024])
+    parser.add_argument("--steps", type=int, default=100, help="moves per board of every benchmark")
+    parser.add_argument("--verify-games", type=int, default=16, help="seeded random games compared with GoGame")
+    parser.add_argument("--verify-moves", type=int, default=400)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    if args.verify_games:
+        n_compared = verify(args.verify_games, args.verify_moves)
+        print(f"Agrees with GoGame on {args.verify_games} random games ({n_compared} moves)")
+    print(f"GoGame: {benchmark_gogame(args.steps):.0f} steps/s")
+    for batch_size in args.batch_sizes:
+        print(f"batch {batch_size:>5}: {benchmark(batch_size, args.steps):.0f} board-steps/s")
@@ -0,0 +1,90 @@
+from typing import Dict, Iterator, List, Optional
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+import numpy as np
+from goformer.goformer import GoFormer, bound_context
+from goformer.rules import GoGame
+
+
+def read_games(paths: List[str]) -> Iterator[List[str]]:
+    """Move lists (GTP) of the games in self-play shards (.jsonl.gz or .jsonl) or directories of shards"""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_games(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                         if name.endswith((".jsonl", ".jsonl.gz"))))
+            continue
+        open_fn = gzip.open if path.endswith(".gz") else open
+        with open_fn(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)["moves"]
+
+
+def evaluate_windows(agent: GoFormer, games: List[List[str]], windows: List[int], hop: int = 8,
+                     min_rounds: int = 0, stride: int = 1) -> Dict[Optional[int], Dict[str, float]]:
+    """
+    Replay the games and compare, at every `stride`-th position after `min_rounds` rounds, the most likely legal
+    move with each bounded context window against the full context (window None).
+    """
+    windows = [None] + list(windows)
+    stats = {w: {"positions": 0, "agreements": 0, "tokens": 0, "seconds": 0.0} for w in windows}
+    for moves in games:
+        game = GoGame("B", 7.5)
+        for ply, move in enumerate(moves):
+            color = game.current_player.lower()
+            rounds = agent.history_to_model_rounds(game.get_move_history(), color)
+            if len(rounds) > min_rounds and ply % stride == 0:
+                legal_moves = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+                full_move = None
+                for window in windows:
+                    bounded = rounds if window is None else bound_context(rounds, window, hop)
+                    start_time = time.perf_counter()
+                    distribution = agent.move_distribution(bounded, color, legal_moves)
+                    stats[window]["seconds"] += time.perf_counter() - start_time
+                    best_move = max(distribution, key=distribution.get)
+                    full_move = full_move or best_move
+                    stats[window]["positions"] += 1
+                    stats[window]["agreements"] += best_move == full_move
+                    stats[window]["tokens"] += len(agent.tokenize(bounded, color))
+            game.play(move)
+            if game.game_over:
+                break
+
+    return {w: {"agreement": s["agreements"] / max(s["positions"], 1),
+                "mean_tokens": s["tokens"] / max(s["positions"], 1),
+                "mean_latency": s["seconds"] / max(s["positions"], 1),
+                "positions": s["positions"]}
+            for w, s in stats.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move agreement of bounded context windows against full context")
+    parser.add_argument("games", nargs="+", help="self-play shards (.jsonl.gz) or directories of shards")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--windows", type=int, nargs="+", default=[16, 32, 64], help="window sizes in rounds")
+    parser.add_argument("--hop", type=int, default=8)
+    parser.add_argument("--max-games", type=int, default=20)
+    parser.add_argument("--min-rounds", type=int, default=24,
+                        help="positions with fewer rounds are skipped, every window agrees there")
+    parser.add_argument("--stride", type=int, default=4, help="evaluate every n-th ply")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    # histories longer than the model's positions are bounded even as full context
+    agent = GoFormer(args.model, 'b')
+    games = []
+    for moves in read_games(args.games):
+        games.append(moves)
+        if len(games) >= args.max_games:
+            break
+    results = evaluate_windows(agent, games, args.windows, args.hop, args.min_rounds, args.stride)
+    for window, result in results.items():
+        print(f"{'full' if window is None else window:>5} rounds: agreement {result['agreement']:.1%} "
+              f"over {result['positions']} positions, {result['mean_tokens']:.0f} tokens, "
+              f"{result['mean_latency'] * 1000:.1f}ms")
+    print(f"median game length: {np.median([len(m) for m in games]):.0f} plies")
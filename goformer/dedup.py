@@ -0,0 +1,337 @@
+from typing import Dict, Iterable, Iterator, List, Tuple
+from dataclasses import dataclass, field
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
+from goformer.rules import BOARD_SIZE, GTP_COLUMNS, N_SYMMETRIES, SYMMETRIES
+
+
+PASS_POINT = BOARD_SIZE * BOARD_SIZE
+# Point index of a GTP move: column * 19 + row, the coordinates of Round.encode_a_move and goformer.symmetry
+MOVE_POINTS: Dict[str, int] = {f"{c}{row + 1}": i * BOARD_SIZE + row
+                               for i, c in enumerate(GTP_COLUMNS) for row in range(BOARD_SIZE)}
+MOVE_POINTS["PASS"] = PASS_POINT
+MOVE_POINTS.update({move.lower(): point for move, point in list(MOVE_POINTS.items())})
+
+
+def _symmetric_points() -> np.ndarray:
+    """[symmetry, point]: the point every point is mapped to by each board symmetry, a pass to a pass"""
+    points = np.full((N_SYMMETRIES, PASS_POINT + 1), PASS_POINT, dtype=np.int16)
+    for s, symmetry in enumerate(SYMMETRIES):
+        for i in range(BOARD_SIZE):
+            for j in range(BOARD_SIZE):
+                x, y = symmetry(i, j)
+                points[s, i * BOARD_SIZE + j] = x * BOARD_SIZE + y
+    return points
+
+
+SYMMETRIC_POINTS = _symmetric_points()
+_zobrist_rng = np.random.default_rng(BOARD_SIZE)
+_ZOBRIST = _zobrist_rng.integers(0, 2 ** 64 - 1, size=(PASS_POINT + 1, 2), dtype=np.uint64, endpoint=True)
+_ZOBRIST[PASS_POINT] = 0  # a pass places no stone
+# [symmetry, point, colour]: key of a stone seen through each symmetry
+SYMMETRIC_ZOBRIST = _ZOBRIST[SYMMETRIC_POINTS]
+ZOBRIST_WHITE_TO_PLAY = _zobrist_rng.integers(0, 2 ** 64 - 1, dtype=np.uint64, endpoint=True)
+
+
+def game_points(moves: List[str]) -> np.ndarray:
+    """Point indices of a game's moves, up to its end or its first move that is not a point or a pass"""
+    points = np.fromiter(map(MOVE_POINTS.get, moves, itertools.repeat(-1)), dtype=np.int16, count=len(moves))
+    invalid = np.flatnonzero(points < 0)  # resign, or a malformed move
+    return points[:invalid[0]] if len(invalid) else points
+
+
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    """A bijective mix of 64-bit integers, to draw a random key for every (ply, point) without a table"""
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def position_hashes(points: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Symmetry-canonical hash of the position after every ply of concatenated games (game g is
+    points[offsets[g]:offsets[g + 1]]).
+    The hash XORs the key of every stone played, black moving first, with the side to move: it does not depend on
+    the move order, so transposed openings share their hashes, and the canonical hash is the smallest over the 8
+    symmetries. Captures are not replayed: after one, equal hashes mean that the same stones were played.
+    """
+    plies = np.arange(len(points)) - np.repeat(offsets[:-1], np.diff(offsets))
+    keys = SYMMETRIC_ZOBRIST[:, points, plies % 2]  # [symmetry, ply of the concatenation]
+    cumulated = np.bitwise_xor.accumulate(keys, axis=1)
+    # XOR out the games before each one
+    starts = np.repeat(offsets[:-1], np.diff(offsets))
+    before = np.where(starts > 0, cumulated[:, np.maximum(starts - 1, 0)], np.uint64(0))
+    hashes = cumulated ^ before ^ np.where(plies % 2 == 0, ZOBRIST_WHITE_TO_PLAY, np.uint64(0))
+    return hashes.min(axis=0)
+
+
+_KEYED_PLIES = 1024
+# [ply, point]: key of a move in a game's hash, the plies beyond _KEYED_PLIES reuse the keys
+_GAME_KEYS = _splitmix64(np.arange(_KEYED_PLIES * 512, dtype=np.uint64)).reshape(_KEYED_PLIES, 512)[:, :PASS_POINT + 1]
+
+
+def game_hashes(points: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Symmetry-canonical hash of the move sequence of concatenated games: mirrored or rotated copies of a game are
+    duplicates. It sums a random key of every (ply, point) played.
+    """
+    lengths = np.diff(offsets)
+    plies = np.arange(len(points)) - np.repeat(offsets[:-1], lengths)
+    keys = _GAME_KEYS[plies % _KEYED_PLIES, SYMMETRIC_POINTS[:, points]]
+    sums = np.zeros((N_SYMMETRIES, len(lengths)), dtype=np.uint64)
+    # reduceat over the starts of the games with moves only: an empty game has no segment of its own
+    non_empty = np.flatnonzero(lengths > 0)
+    if len(non_empty):
+        with np.errstate(over="ignore"):
+            sums[:, non_empty] = np.add.reduceat(keys, offsets[non_empty], axis=1)
+    return _splitmix64(sums ^ lengths.astype(np.uint64)).min(axis=0)
+
+
+def _merge_runs(a: np.ndarray, b: np.ndarray, path: str, block_size: int = 1 << 20) -> np.ndarray:
+    """Merge two disjoint sorted runs into a new run file, a block at a time"""
+    out = open_memmap(path, mode="w+", dtype=np.uint64, shape=(len(a) + len(b),))
+    i = j = k = 0
+    while i < len(a) or j < len(b):
+        a_block = np.asarray(a[i:i + block_size])
+        b_block = np.asarray(b[j:j + block_size])
+        if len(a_block) == 0 or len(b_block) == 0:
+            rest = a_block if len(a_block) else b_block
+            out[k:k + len(rest)] = rest
+            i, j, k = i + len(a_block), j + len(b_block), k + len(rest)
+            continue
+        bound = min(a_block[-1], b_block[-1])
+        n_a = int(np.searchsorted(a_block, bound, side="right"))
+        n_b = int(np.searchsorted(b_block, bound, side="right"))
+        out[k:k + n_a + n_b] = np.sort(np.concatenate([a_block[:n_a], b_block[:n_b]]), kind="mergesort")
+        i, j, k = i + n_a, j + n_b, k + n_a + n_b
+    out.flush()
+    del out
+    return np.load(path, mmap_mode="r")
+
+
+class HashIndex:
+    """
+    A set of 64-bit hashes on disk: disjoint sorted runs, memory-mapped and searched with a binary search.
+    New hashes are written as a new run, and the newest runs are merged while the last is at least half the size
+    of the one before, so there are O(log n) runs and memory does not grow with the index.
+    """
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._manifest = os.path.join(directory, "runs.json")
+        names = []
+        if os.path.exists(self._manifest):
+            with open(self._manifest) as f:
+                names = json.load(f)["runs"]
+        self._runs: List[Tuple[str, np.ndarray]] = [(n, np.load(os.path.join(directory, n), mmap_mode="r"))
+                                                    for n in names]
+        self._next_run = max([int(n.split("-")[1].split(".")[0]) + 1 for n in names], default=0)
+
+    def __len__(self):
+        return sum(len(run) for _, run in self._runs)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Whether each hash is in the index; sorted hashes are looked up faster"""
+        found = np.zeros(len(hashes), dtype=bool)
+        for _, run in self._runs:
+            positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+            found |= run[positions] == hashes
+        return found
+
+    def add(self, hashes: np.ndarray, missing: bool = False):
+        """Add the hashes missing from the index; `missing` if they are already unique, sorted and missing"""
+        if not missing:
+            hashes = np.unique(hashes)
+            hashes = hashes[~self.contains(hashes)]
+        if len(hashes) == 0:
+            return
+        name = self._new_run_name()
+        np.save(os.path.join(self._directory, name), hashes)
+        self._runs.append((name, np.load(os.path.join(self._directory, name), mmap_mode="r")))
+        self._save_manifest()
+        while len(self._runs) >= 2 and 2 * len(self._runs[-1][1]) >= len(self._runs[-2][1]):
+            (name_a, a), (name_b, b) = self._runs[-2:]
+            name = self._new_run_name()
+            self._runs[-2:] = [(name, _merge_runs(a, b, os.path.join(self._directory, name)))]
+            del a, b
+            self._save_manifest()  # before the merged runs are removed
+            for old in (name_a, name_b):
+                os.remove(os.path.join(self._directory, old))
+
+    def _new_run_name(self) -> str:
+        name = f"run-{self._next_run:06d}.npy"
+        self._next_run += 1
+        return name
+
+    def _save_manifest(self):
+        with open(self._manifest + ".tmp", "w") as f:
+            json.dump({"runs": [name for name, _ in self._runs], "hashes": len(self)}, f)
+        os.replace(self._manifest + ".tmp", self._manifest)
+
+
+@dataclass
+class DedupStats:
+    games: int = 0
+    duplicates: int = 0
+    positions: int = 0  # positions looked up, in the first max_ply plies of the unique games
+    seen_positions: int = 0  # of which already in the index
+    seconds: float = 0.0
+    # prefix_overlap[k]: unique games whose first k positions, and not the next one, were already in the index
+    prefix_overlap: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+
+    @property
+    def unique_games(self) -> int:
+        return self.games - self.duplicates
+
+    @property
+    def duplicate_rate(self) -> float:
+        return self.duplicates / self.games if self.games else 0.0
+
+    @property
+    def seen_position_ratio(self) -> float:
+        return self.seen_positions / self.positions if self.positions else 0.0
+
+    @property
+    def mean_prefix_overlap(self) -> float:
+        total = self.prefix_overlap.sum()
+        return float(np.arange(len(self.prefix_overlap)) @ self.prefix_overlap / total) if total else 0.0
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.games} games ({self.games_per_second:.0f}/s), {self.duplicates} duplicates "
+                f"({self.duplicate_rate:.1%}), {self.seen_position_ratio:.1%} of the opening positions already seen, "
+                f"mean prefix overlap {self.mean_prefix_overlap:.1f} plies")
+
+
+class Deduplicator:
+    """
+    Streams games through a position-hash index: exact duplicates, up to the board symmetries, are dropped, and
+    the positions of the first `max_ply` plies of the other games are compared with the games before them,
+    including the games of previous runs on the same index directory.
+    Games are processed in chunks, so memory is bounded by the chunk size.
+    """
+    def __init__(self, index_dir: str, max_ply: int = 60):
+        """
+        :param index_dir: directory of the on-disk index, created if needed and reused across runs
+        :param max_ply: plies of every game whose positions are indexed
+        """
+        self._games = HashIndex(os.path.join(index_dir, "games"))
+        self._positions = HashIndex(os.path.join(index_dir, "positions"))
+        self._max_ply = max_ply
+        self.stats = DedupStats(prefix_overlap=np.zeros(max_ply + 1, dtype=np.int64))
+
+    def process(self, games: List[List[str]]) -> List[bool]:
+        """Whether each game of a chunk is kept, i.e. is not a duplicate of a game before it"""
+        start_time = time.time()
+        points = [game_points(moves) for moves in games]
+        hashes = game_hashes(np.concatenate(points), np.concatenate([[0], np.cumsum([len(p) for p in points])]))
+        # a duplicate is in the index, or earlier in the chunk
+        _, first = np.unique(hashes, return_index=True)
+        first_in_chunk = np.zeros(len(games), dtype=bool)
+        first_in_chunk[first] = True
+        keep = first_in_chunk & ~self._games.contains(hashes)
+        self._games.add(hashes[keep])
+
+        kept = [p[:self._max_ply] for p, k in zip(points, keep) if k]
+        lengths = np.array([len(p) for p in kept], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        if offsets[-1] > 0:
+            positions = position_hashes(np.concatenate(kept), offsets)
+            game_of = np.repeat(np.arange(len(kept)), lengths)
+            # a position is seen if it is in the index, or in an earlier game of the chunk
+            unique_positions, inverse = np.unique(positions, return_inverse=True)
+            first_game = np.full(len(unique_positions), len(kept))
+            np.minimum.at(first_game, inverse, game_of)
+            in_index = self._positions.contains(unique_positions)
+            seen = in_index[inverse] | (first_game[inverse] < game_of)
+            # the prefix overlap of a game is its ply of the first unseen position
+            plies = np.arange(len(positions)) - offsets[game_of]
+            overlap = lengths.copy()
+            np.minimum.at(overlap, game_of[~seen], plies[~seen])
+            self.stats.prefix_overlap += np.bincount(overlap, minlength=self._max_ply + 1)
+            self.stats.positions += len(positions)
+            self.stats.seen_positions += int(seen.sum())
+            self._positions.add(unique_positions[~in_index], missing=True)
+        else:
+            self.stats.prefix_overlap[0] += len(kept)
+
+        self.stats.games += len(games)
+        self.stats.duplicates += len(games) - int(keep.sum())
+        self.stats.seconds += time.time() - start_time
+        return keep.tolist()
+
+    def run(self, lines: Iterable[str], chunk_size: int = 4096) -> Iterator[str]:
+        """Yield the lines (JSON records with a "moves" list) of the games kept"""
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                return
+            keep = self.process([json.loads(line)["moves"] for line in chunk])
+            yield from (line for line, k in zip(chunk, keep) if k)
+
+
+def read_lines(paths: List[str]) -> Iterator[str]:
+    """Lines of game records in self-play shards (.jsonl.gz or .jsonl) or directories of shards"""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_lines(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                         if name.endswith((".jsonl", ".jsonl.gz"))))
+            continue
+        open_fn = gzip.open if path.endswith(".gz") else open
+        with open_fn(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield line.rstrip("\n")
+
+
+def _overlap_table(prefix_overlap: np.ndarray, bucket: int = 10) -> str:
+    total = prefix_overlap.sum()
+    rows = []
+    for start in range(0, len(prefix_overlap), bucket):
+        n = int(prefix_overlap[start:start + bucket].sum())
+        if n:
+            rows.append(f"  {start:>3}-{min(start + bucket, len(prefix_overlap)) - 1:<3} plies: {n:>9} "
+                        f"({n / total:.1%})")
+    return "\n".join(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drop duplicate games and report the prefix overlap of a corpus")
+    parser.add_argument("games", nargs="+", help="self-play shards or directories of shards")
+    parser.add_argument("--index", required=True, help="index directory, reuse it to deduplicate across corpora")
+    parser.add_argument("--output", default=None, help="JSONL(.gz) of the games kept")
+    parser.add_argument("--max-ply", type=int, default=60, help="plies of every game whose positions are indexed")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="games processed at once")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    deduplicator = Deduplicator(args.index, args.max_ply)
+    output = None
+    if args.output is not None:
+        output = (gzip.open if args.output.endswith(".gz") else open)(args.output, "wt", encoding="utf-8")
+    try:
+        start_time = time.time()
+        for i, line in enumerate(deduplicator.run(read_lines(args.games), args.chunk_size)):
+            if output is not None:
+                output.write(line + "\n")
+            if (i + 1) % (10 * args.chunk_size) == 0:
+                logging.info(f"{deduplicator.stats}, {time.time() - start_time:.0f}s")
+    finally:
+        if output is not None:
+            output.close()
+    print(deduplicator.stats)
+    print(f"Prefix overlap of the {deduplicator.stats.unique_games} unique games with the games before them:")
+    print(_overlap_table(deduplicator.stats.prefix_overlap))
@@ -1,8 +1,13 @@
 import sys
 import logging
 import copy
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pygame
-from goformer.goformer import GoFormer, alphabets_wo_I
+from goformer.rules import GoGame, BOARD_SIZE, GTP_COLUMNS
+# goformer.goformer imports torch and transformers, which take seconds: only the model loader thread imports it
 
 
 # Set up logging
@@ -16,7 +21,6 @@ pygame.init()
 
 # Constants
 WIDTH, HEIGHT = 800, 800  # Increased size to accommodate labels
-BOARD_SIZE = 19
 CELL_SIZE = (WIDTH - 150) // BOARD_SIZE  # Adjusted for labels
 MARGIN = 50  # Margin for labels
 BLACK = (0, 0, 0)
@@ -25,7 +29,11 @@ BOARD_COLOR = (220, 179, 92)
 FONT_COLOR = (50, 50, 50)
 BUTTON_COLOR = (100, 100, 100)
 BUTTON_HOVER_COLOR = (150, 150, 150)
-AI_TURN_TIMEOUT = 10
+AI_TURN_TIMEOUT = 10  # seconds before the AI plays the best move found so far
+AI_SUGGESTION_WIDTHS = (1, 19)  # a quick greedy move first, then the full beam search
+PONDER = True  # think on the player's time
+PONDER_REPLIES = 4  # number of the player's most likely replies answered in advance
+MODEL_NAME = "kenhktsui/goformer-v0.1"
 
 # Create the screen
 screen = pygame.display.set_mode((WIDTH, HEIGHT))
@@ -37,346 +45,19 @@ label_font = pygame.font.Font(None, 24)
 large_font = pygame.font.Font(None, 48)
 
 
-class GoGame:
-    def __init__(self, player_color, komi):
-        self.board = [[None for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)]
-        self._player_color = player_color
-        self._ai_color = "W" if player_color == "B" else "B"
-        self._current_player = "B"  # Black always starts
-        self.last_move = None
-        self.ai_last_move = None
-        self.passed = False
-        self.game_over = False
-        self.black_score = 0
-        self.white_score = komi
-        self.komi = komi
-        self.move_history = {}
-        self.move_count = 0
-        self.consecutive_passes = 0
-        self.previous_board_state = None  # For Ko rule checking
-        self.territory = {'B': 0, 'W': 0}
-        self.resigned = False
-        self.winner = None
-
-    @property
-    def player_color(self):
-        return self._player_color
-
-    @property
-    def ai_color(self):
-        return self._ai_color
-
-    @property
-    def current_player(self):
-        return self._current_player
-
-    def switch_player(self):
-        self._current_player = 'W' if self.current_player == 'B' else 'B'
-
-    @property
-    def is_player_turn(self):
-        return self.current_player == self.player_color
-
-    def start_turn(self):
-        """Prepare for the start of a new turn."""
-        pass
-
-    def end_turn(self):
-        """End the current turn and switch to the next player."""
-        self._current_player = 'W' if self._current_player == 'B' else 'B'
-        logging.debug(f"Ending turn. Next player: {self.current_player} (Player's turn: {self.is_player_turn})")
-
-    def place_stone(self, x, y):
-        if self.board[y][x] is None and not self.is_ko_violation(x, y):
-            # Check if the move is legal (has liberties or captures opponent stones)
-            if self.is_legal_move(x, y):
-                self.board[y][x] = self.current_player
-                self.last_move = (x, y)
-                if self.current_player == self.ai_color:
-                    self.ai_last_move = (x, y)
-                self.passed = False
-                self.consecutive_passes = 0
-
-                # Check for captures
-                enemy_color = 'W' if self.current_player == 'B' else 'B'
-                captured_stones = self.check_captures(x, y, enemy_color, dryrun=False)
-                self.update_score(len(captured_stones))
-                self.record_move(x, y)
-                self.previous_board_state = copy.deepcopy(self.board)
-
-                self.end_turn()
-                logging.debug(f"Stone placed at ({x}, {y}) by {self.current_player}")
-                return True
-            else:
-                logging.debug(f"Illegal move attempted at ({x}, {y})")
-                return False
-        return False
-
-    def is_legal_move(self, x, y):
-        # Temporarily place the stone
-        self.board[y][x] = self.current_player
-
-        # Check if the move captures any opponent stones
-        enemy_color = 'W' if self.current_player == 'B' else 'B'
-        captures = self.check_captures(x, y, enemy_color, dryrun=True)
-
-        # Check if the placed stone has liberties
-        has_liberties = self.has_liberties([(x, y)])
-
-        # Remove the temporary stone
-        self.board[y][x] = None
-
-        # The move is legal if it either captures stones or has liberties
-        return len(captures) > 0 or has_liberties
-
-    def check_captures(self, x, y, color_to_capture, dryrun=False):
-        captured_stones = []
-        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                if self.board[ny][nx] == color_to_capture:
-                    group = self.find_group(nx, ny)
-                    if not self.has_liberties(group):
-                        captured_stones.extend(group)
-
-        if dryrun:
-            return captured_stones
-
-        # Remove captured stones from the board
-        for cx, cy in captured_stones:
-            self.board[cy][cx] = None
-
-        return captured_stones
-
-    def is_ko_violation(self, x, y):
-        if self.previous_board_state is None:
-            return False
-
-        # Create a temporary board with the new move
-        temp_board = copy.deepcopy(self.board)
-        temp_board[y][x] = self.current_player
-
-        # Check captures on the temporary board
-        enemy_color = 'W' if self.current_player == 'B' else 'B'
-        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                if temp_board[ny][nx] == enemy_color:
-                    group = self.find_group(nx, ny)
-                    if not self.has_liberties(group):
-                        for cx, cy in group:
-                            temp_board[cy][cx] = None
-
-        # Check if this new board state matches the previous board state
-        return temp_board == self.previous_board_state
-
-    def would_capture(self, x, y, board):
-        captured = []
-        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                if board[ny][nx] == ('W' if self.current_player == 'B' else 'B'):
-                    group = self.find_group(nx, ny, board)
-                    if not self.has_liberties(group, board):
-                        captured.extend(group)
-        return captured
-
-    def find_group(self, x, y):
-        color = self.board[y][x]
-        group = set()
-        stack = [(x, y)]
-        while stack:
-            cx, cy = stack.pop()
-            if (cx, cy) not in group:
-                group.add((cx, cy))
-                for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                    nx, ny = cx + dx, cy + dy
-                    if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE and self.board[ny][nx] == color:
-                        stack.append((nx, ny))
-        return group
-
-    def pass_turn(self):
-        if self.passed:
-            print("Both players have passed. Ending game.")
-            self.game_over = True
-        else:
-            self.passed = True
-            self.consecutive_passes += 1
-            self.record_move(None, None)  # Record a pass
-            self.end_turn()
-
-    def resign(self):
-        self.game_over = True
-        self.resigned = True
-        self.winner = 'W' if self.current_player == 'B' else 'B'
-        logging.info(f"Player {self.current_player} has resigned. {self.winner} wins.")
-
-    def can_make_move(self):
-        """Check if the current player can make any legal move."""
-        for y in range(BOARD_SIZE):
-            for x in range(BOARD_SIZE):
-                if self.board[y][x] is None and not self.is_ko_violation(x, y):
-                    if self.is_legal_move(x, y):
-                        return True
-        return False
-
-    def remove_captured_stones(self, x, y):
-        captured = []
-        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                if self.board[ny][nx] == ('W' if self.current_player == 'B' else 'B'):
-                    group = self.find_group(nx, ny, self.board)
-                    if not self.has_liberties(group, self.board):
-                        captured.extend(group)
-                        for cx, cy in group:
-                            self.board[cy][cx] = None
-        return len(captured)
-
-    def has_liberties(self, group):
-        for x, y in group:
-            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                    if self.board[ny][nx] is None:
-                        return True
-        return False
-
-    def update_score(self, captured_stones):
-        if self.current_player == 'B':
-            self.black_score += captured_stones
-        else:
-            self.white_score += captured_stones
-
-    def get_score(self):
-        return self.black_score, self.white_score
-
-    def record_move(self, x, y):
-        if self.current_player == "B":
-            self.move_count += 1
-        if x is None and y is None:
-            move = "PASS"
-        else:
-            col = chr(x + 65)  # Convert to letter (A-T, skipping I)
-            if col >= "I":
-                col = chr(ord(col) + 1)
-            row = str(BOARD_SIZE - y)
-            move = col + row
-
-        if self.current_player == "B":
-            self.move_history[self.move_count] = {"black": move}
-        else:
-            self.move_history[self.move_count]["white"] = move
-
-    def get_move_history(self):
-        if not self.move_history:
-            return {1: {"black": None, "white": None}}
-        return self.move_history
-
-    def calculate_score(self):
-        if self.resigned:
-            # In case of resignation, the winner gets all points on the board plus komi
-            if self.winner == 'B':
-                self.black_score = BOARD_SIZE * BOARD_SIZE
-                self.white_score = self.komi
-            else:
-                self.black_score = 0
-                self.white_score = BOARD_SIZE * BOARD_SIZE + self.komi
-        else:
-            self.territory = {'B': 0, 'W': 0}
-            visited = set()
-            seki_points = set()
-
-            for y in range(BOARD_SIZE):
-                for x in range(BOARD_SIZE):
-                    if (x, y) not in visited and self.board[y][x] is None:
-                        territory, borders, is_seki = self.find_territory(x, y)
-                        visited.update(territory)
-                        if is_seki:
-                            seki_points.update(territory)
-                        elif len(set(borders)) == 1:  # Territory is surrounded by one color
-                            self.territory[borders[0]] += len(territory)
-
-            # Count stones on the board
-            black_stones = sum(row.count('B') for row in self.board)
-            white_stones = sum(row.count('W') for row in self.board)
-
-            # Calculate final scores
-            self.black_score = self.territory['B'] + black_stones
-            self.white_score = self.territory['W'] + white_stones + self.komi
-
-            logging.info(f"Final Score - Black: {self.black_score}, White: {self.white_score}")
-            if not self.resigned:
-                logging.info(f"Territory - Black: {self.territory['B']}, White: {self.territory['W']}")
-                logging.info(f"Stones - Black: {black_stones}, White: {white_stones}")
-                logging.info(f"Seki points: {len(seki_points)}")
-
-    def find_territory(self, x, y):
-        color = self.board[y][x]
-        territory = set()
-        borders = []
-        stack = [(x, y)]
-        adjacent_colors = set()
-
-        while stack:
-            cx, cy = stack.pop()
-            if (cx, cy) in territory:
-                continue
-            territory.add((cx, cy))
-
-            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                nx, ny = cx + dx, cy + dy
-                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                    if self.board[ny][nx] is None and (nx, ny) not in territory:
-                        stack.append((nx, ny))
-                    elif self.board[ny][nx] is not None:
-                        borders.append(self.board[ny][nx])
-                        adjacent_colors.add(self.board[ny][nx])
-
-        is_seki = self.check_seki(territory, adjacent_colors)
-        return territory, borders, is_seki
-
-    def check_seki(self, territory, adjacent_colors):
-        if len(adjacent_colors) != 2:
-            return False
-
-        # Check if both colors have few liberties
-        for color in adjacent_colors:
-            if self.count_liberties(territory, color) > 1:
-                return False
-
-        return True
-
-    def count_liberties(self, territory, color):
-        liberties = set()
-        for x, y in territory:
-            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
-                    if self.board[ny][nx] is None and (nx, ny) not in territory:
-                        liberties.add((nx, ny))
-        return len(liberties)
-
-    def end_game(self):
-        self.game_over = True
-        self.calculate_score()
-        if not self.resigned:
-            self.winner = "B" if self.black_score > self.white_score else "W"
-        logging.info(f"Game Over! {self.winner} wins!")
-        logging.info(f"Final Score - Black: {self.black_score}, White: {self.white_score}")
-
-
-def draw_board():
-    screen.fill(BOARD_COLOR)
+def create_board_layer():
+    """Pre-render the static part of the board: background, grid and coordinate labels"""
+    layer = pygame.Surface((WIDTH, HEIGHT)).convert()
+    layer.fill(BOARD_COLOR)
     for i in range(BOARD_SIZE):
         pygame.draw.line(
-            screen,
+            layer,
             BLACK,
             (MARGIN + CELL_SIZE // 2, MARGIN + i * CELL_SIZE + CELL_SIZE // 2),
             (WIDTH - MARGIN - CELL_SIZE * 2, MARGIN + i * CELL_SIZE + CELL_SIZE // 2),
         )
         pygame.draw.line(
-            screen,
+            layer,
             BLACK,
             (MARGIN + i * CELL_SIZE + CELL_SIZE // 2, MARGIN + CELL_SIZE // 2),
             (
@@ -389,7 +70,7 @@ def draw_board():
     letters = "ABCDEFGHJKLMNOPQRST"
     for i, letter in enumerate(letters):
         text = label_font.render(letter, True, BLACK)
-        screen.blit(
+        layer.blit(
             text,
             (
                 MARGIN + i * CELL_SIZE - text.get_width() // 2 + CELL_SIZE // 2,
@@ -407,54 +88,37 @@ def draw_board():
             - text.get_height() // 2
             - 50
         )
-        screen.blit(text, (MARGIN // 2 - text.get_width() // 2, ytick_position))
-        screen.blit(text, (WIDTH - MARGIN // 2 - text.get_width() // 2, ytick_position))
-
-
-def draw_stones(game):
-    for y in range(BOARD_SIZE):
-        for x in range(BOARD_SIZE):
-            if game.board[y][x]:
-                color = BLACK if game.board[y][x] == "B" else WHITE
-                pygame.draw.circle(
-                    screen,
-                    color,
-                    (
-                        MARGIN + x * CELL_SIZE + CELL_SIZE // 2,
-                        MARGIN + y * CELL_SIZE + CELL_SIZE // 2,
-                    ),
-                    CELL_SIZE // 2 - 2,
-                )
-
-                # Highlight the AI's last move
-                if (x, y) == game.ai_last_move:
-                    highlight_color = (
-                        (255, 0, 0) if game.ai_color == "B" else (0, 255, 0)
-                    )
-                    pygame.draw.circle(
-                        screen,
-                        highlight_color,
-                        (
-                            MARGIN + x * CELL_SIZE + CELL_SIZE // 2,
-                            MARGIN + y * CELL_SIZE + CELL_SIZE // 2,
-                        ),
-                        CELL_SIZE // 4,
-                        2,
-                    )
-
-
-def draw_score(black_score, white_score, komi):
-    score_text = f"Black: {black_score:.1f}  White: {white_score:.1f}  (Komi: {komi})"
-    text_surface = font.render(score_text, True, FONT_COLOR)
-    screen.blit(text_surface, (10, HEIGHT - 40))
-
-
-def draw_turn_indicator(game):
+        layer.blit(text, (MARGIN // 2 - text.get_width() // 2, ytick_position))
+        layer.blit(text, (WIDTH - MARGIN // 2 - text.get_width() // 2, ytick_position))
+    return layer
+
+
+def create_stone_sprite(color, highlight_color=None):
+    """Pre-render a stone, optionally with the ring marking the AI's last move, on a transparent cell"""
+    sprite = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
+    center = (CELL_SIZE // 2, CELL_SIZE // 2)
+    pygame.draw.circle(sprite, color, center, CELL_SIZE // 2 - 2)
+    if highlight_color is not None:
+        pygame.draw.circle(sprite, highlight_color, center, CELL_SIZE // 4, 2)
+    return sprite
+
+
+def cell_rect(x, y):
+    return pygame.Rect(MARGIN + x * CELL_SIZE, MARGIN + y * CELL_SIZE, CELL_SIZE, CELL_SIZE)
+
+
+# The status bar below the board, where the score and indicators are drawn
+STATUS_RECT = pygame.Rect(0, HEIGHT - 90, WIDTH, 90)
+
+
+def score_text(black_score, white_score, komi):
+    return f"Black: {black_score:.1f}  White: {white_score:.1f}  (Komi: {komi})"
+
+
+def turn_indicator_text(game):
     turn_text = "Your Turn" if game.is_player_turn else "AI's Turn"
     color_text = "Black" if game.player_color == 'B' else "White"
-    indicator_text = f"You are {color_text} | {turn_text}"
-    text_surface = font.render(indicator_text, True, FONT_COLOR)
-    screen.blit(text_surface, (WIDTH - text_surface.get_width() - 10, HEIGHT - 40))
+    return f"You are {color_text} | {turn_text}"
 
 
 def draw_button(text, x, y, w, h, inactive_color, active_color):
@@ -557,6 +221,36 @@ def komi_selection_screen():
                     input_text += event.unicode
 
 
+def model_loading_screen(loader):
+    """Shown only if the player is through the selection screens before the model is loaded"""
+    clock = pygame.time.Clock()
+    while not loader.ready:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+
+        screen.fill(BOARD_COLOR)
+        title = large_font.render("Loading GoFormer", True, BLACK)
+        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, HEIGHT // 2 - 75))
+        stage = font.render(f"{loader.stage}{'.' * (int(loader.elapsed * 2) % 4):<3} {loader.elapsed:.0f}s", True,
+                            FONT_COLOR)
+        screen.blit(stage, (WIDTH // 2 - stage.get_width() // 2, HEIGHT // 2))
+
+        # progress through the loading stages, with a block sweeping the current one
+        bar = pygame.Rect(WIDTH // 4, HEIGHT // 2 + 50, WIDTH // 2, 20)
+        stage_width = bar.width // len(ModelLoader.STAGES)
+        done = ModelLoader.STAGES.index(loader.stage) if loader.stage in ModelLoader.STAGES else 0
+        pygame.draw.rect(screen, BUTTON_COLOR, bar, 2)
+        pygame.draw.rect(screen, BUTTON_COLOR, (bar.x, bar.y, done * stage_width, bar.height))
+        sweep = int((loader.elapsed % 1.0) * (stage_width - 20))
+        pygame.draw.rect(screen, BUTTON_HOVER_COLOR, (bar.x + done * stage_width + sweep, bar.y, 20, bar.height))
+
+        pygame.display.flip()
+        clock.tick(30)
+    return loader.get()
+
+
 def show_end_game_screen(game):
     restart = False
     exit_game = False
@@ -604,33 +298,220 @@ def show_end_game_screen(game):
     return restart, exit_game
 
 
-def update_display(game):
-    draw_board()
-    draw_stones(game)
-    draw_score(game.black_score, game.white_score, game.komi)
-    draw_turn_indicator(game)
-    if game.ai_last_move:
-        draw_last_move_indicator(game.ai_last_move)
-    pygame.display.flip()
+class BoardView:
+    """
+    Draws a game incrementally.
+    The board layer and stone sprites are rendered once; afterwards only the cells whose stone or highlight changed,
+    and the status bar when its text changed, are redrawn and pushed to the display.
+    """
+    _board_layer = None
+    _stone_sprites = None
+
+    def __init__(self):
+        if BoardView._board_layer is None:
+            BoardView._board_layer = create_board_layer()
+            BoardView._stone_sprites = {
+                ("B", False): create_stone_sprite(BLACK),
+                ("W", False): create_stone_sprite(WHITE),
+                ("B", True): create_stone_sprite(BLACK, highlight_color=(255, 0, 0)),
+                ("W", True): create_stone_sprite(WHITE, highlight_color=(0, 255, 0)),
+            }
+        self._cells = None  # what is drawn on each cell: None or (color, highlighted)
+        self._status = None
+
+    def _draw_cell(self, x, y, cell):
+        rect = cell_rect(x, y)
+        screen.blit(self._board_layer, rect, rect)
+        if cell is not None:
+            screen.blit(self._stone_sprites[cell], rect)
+        return rect
+
+    def _draw_status(self, status):
+        screen.blit(self._board_layer, STATUS_RECT, STATUS_RECT)
+        score, turn, last_move, thinking = status
+        text_surface = font.render(score, True, FONT_COLOR)
+        screen.blit(text_surface, (10, HEIGHT - 40))
+        text_surface = font.render(turn, True, FONT_COLOR)
+        screen.blit(text_surface, (WIDTH - text_surface.get_width() - 10, HEIGHT - 40))
+        if last_move:
+            text_surface = font.render(last_move, True, FONT_COLOR)
+            screen.blit(text_surface, (10, HEIGHT - 80))
+        if thinking:
+            text_surface = font.render(thinking, True, FONT_COLOR)
+            screen.blit(text_surface, (WIDTH - text_surface.get_width() - 10, HEIGHT - 80))
+        return STATUS_RECT
+
+    def render(self, game, ai_turn=None):
+        cells = [
+            [None if game.board[y][x] is None else (game.board[y][x], (x, y) == game.ai_last_move)
+             for x in range(BOARD_SIZE)]
+            for y in range(BOARD_SIZE)
+        ]
+        status = (
+            score_text(game.black_score, game.white_score, game.komi),
+            turn_indicator_text(game),
+            last_move_indicator_text(game.ai_last_move) if game.ai_last_move else None,
+            thinking_indicator_text(ai_turn.elapsed) if ai_turn is not None else None,
+        )
+
+        if self._cells is None:
+            # First frame of a game: the screen holds whatever the previous screen drew
+            screen.blit(self._board_layer, (0, 0))
+            for y in range(BOARD_SIZE):
+                for x in range(BOARD_SIZE):
+                    if cells[y][x] is not None:
+                        self._draw_cell(x, y, cells[y][x])
+            self._draw_status(status)
+            pygame.display.flip()
+        else:
+            dirty_rects = []
+            for y in range(BOARD_SIZE):
+                for x in range(BOARD_SIZE):
+                    if cells[y][x] != self._cells[y][x]:
+                        dirty_rects.append(self._draw_cell(x, y, cells[y][x]))
+            if status != self._status:
+                dirty_rects.append(self._draw_status(status))
+            if dirty_rects:
+                pygame.display.update(dirty_rects)
+        self._cells = cells
+        self._status = status
+
+
+def thinking_indicator_text(elapsed):
+    dots = "." * (int(elapsed * 2) % 4)
+    return f"AI is thinking{dots:<3} {elapsed:.0f}s"
 
 
-def draw_last_move_indicator(last_move):
+def last_move_indicator_text(last_move):
     if last_move == 'PASS':
-        move_text = "AI passed"
-    else:
-        x, y = last_move
-        move_text = f"AI's last move: {alphabets_wo_I[x]}{BOARD_SIZE - y}"
-    text_surface = font.render(move_text, True, FONT_COLOR)
-    screen.blit(text_surface, (10, HEIGHT - 80))
+        return "AI passed"
+    elif last_move == 'resign':
+        return "AI resigned"
+    x, y = last_move
+    return f"AI's last move: {GTP_COLUMNS[x]}{BOARD_SIZE - y}"
+
+
+def start_pondering(game, ponderer):
+    if ponderer is not None and game.is_player_turn and not game.game_over:
+        ponderer.start(game.get_move_history())
+
+
+class ModelLoader:
+    """
+    Loads GoFormer on a background thread, started with the first window so that the colour and komi selection hide
+    the load. torch and transformers are first imported by this thread.
+    """
+    STAGES = ["Importing PyTorch and transformers", "Loading the model", "Warming up", "Ready"]
+
+    def __init__(self, artifact_dir):
+        self.stage = self.STAGES[0]
+        self._start_time = time.time()
+        self._agent = None
+        self._error = None
+        self._thread = threading.Thread(target=self._load, args=(artifact_dir,), name="model-loader", daemon=True)
+        self._thread.start()
+
+    def _load(self, artifact_dir):
+        try:
+            from goformer.goformer import GoFormer, Round
+            self.stage = self.STAGES[1]
+            agent = GoFormer(artifact_dir, 'b')
+            self.stage = self.STAGES[2]
+            agent.move_distribution([Round(n=1, black_move=None, white_move=None)])  # the first forward pass is slow
+            self._agent = agent
+            logging.info(f"Model loaded in {self.elapsed:.1f}s")
+        except Exception as e:
+            logging.exception("Failed to load the model")
+            self._error = e
+        self.stage = self.STAGES[3]
 
+    @property
+    def elapsed(self):
+        return time.time() - self._start_time
+
+    @property
+    def ready(self):
+        return not self._thread.is_alive()
+
+    def get(self):
+        """The loaded GoFormer, waiting for it if needed"""
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._agent
+
+
+class AITurn:
+    """
+    Computes the AI's move on a worker thread, so the window keeps rendering and processing events.
+    The move is refined in stages (AI_SUGGESTION_WIDTHS); once AI_TURN_TIMEOUT has passed, the best move found so
+    far is played and the remaining stages are abandoned. The turn is timed from its submission: a stage cannot be
+    interrupted, and a turn queued behind the stage of a timed out turn still ends in time, with a legal move.
+    """
+    def __init__(self, executor, game, ai_bot, ponderer=None):
+        from goformer.goformer import GoFormer  # already imported by the model loader
+        self._to_game_move = GoFormer.to_game_move
+        self._start_time = time.time()
+        self._cancelled = threading.Event()
+        self._best_move = None
+        self._game = game
+        move_history = copy.deepcopy(game.get_move_history())
+        self._future = executor.submit(self._compute, ai_bot, ponderer, move_history)
 
-def handle_ai_turn(game, ai_bot):
-    logging.debug("Starting AI turn")
-    ai_move = ai_bot.make_move(game)
+    @property
+    def elapsed(self):
+        return time.time() - self._start_time
+
+    def _compute(self, ai_bot, ponderer, move_history):
+        if ponderer is not None:
+            self._best_move = ponderer.take(move_history)
+            if self._best_move is not None:
+                return self._best_move
+        for stage, n_suggestion in enumerate(AI_SUGGESTION_WIDTHS):
+            if self._cancelled.is_set():
+                break
+            if ponderer is not None:
+                with ponderer.model_lock:
+                    move = ai_bot.predict_next_move_with_leela(move_history, n_suggestion)
+            else:
+                move = ai_bot.predict_next_move_with_leela(move_history, n_suggestion)
+            # GoFormer answers PASS when none of its n_suggestion candidates is legal: only the widest stage's PASS
+            # is its choice, a narrower stage found no move
+            if move != "PASS" or stage == len(AI_SUGGESTION_WIDTHS) - 1:
+                self._best_move = move
+        return self._best_move
+
+    def poll(self):
+        """Return the AI's move in game.py format once it is decided, None while it is still thinking"""
+        if self._future.done():
+            return self._playable(self._to_game_move(self._future.result() or "PASS"))
+        if self.elapsed > AI_TURN_TIMEOUT:
+            self._cancelled.set()
+            logging.warning(f"AI turn timed out after {AI_TURN_TIMEOUT}s, playing the best move found so far: "
+                            f"{self._best_move}")
+            return self._playable(self._to_game_move(self._best_move or "PASS"))
+        return None
+
+    def _playable(self, move):
+        """The move, or a random legal move in place of an illegal move or of a pass when nothing was found"""
+        if move == "resign" or (move != "PASS" and self._game.is_valid_move(*move)):
+            return move
+        if move == "PASS" and self._best_move is not None:
+            return move  # the model chose to pass
+        legal_moves = self._game.legal_moves()
+        if not legal_moves:
+            return "PASS"
+        fallback = random.choice(legal_moves)
+        logging.warning(f"No legal move found by the AI in place of {move}, playing {fallback}")
+        return fallback
+
+
+def handle_ai_turn(game, ai_move, ponderer=None):
     logging.debug(f"AI attempting to place stone at {ai_move}")
     if ai_move == "PASS":
         game.pass_turn()
         game.ai_last_move = "PASS"
+        start_pondering(game, ponderer)
         return
     elif ai_move == "resign":
         game.resign()
@@ -644,9 +525,18 @@ def handle_ai_turn(game, ai_bot):
             logging.error("AI failed to place stone in a legal position, deemed as passing turn")
             game.pass_turn()
             game.ai_last_move = "PASS"
+        start_pondering(game, ponderer)
         return
 
 
+def handle_waiting_events():
+    """Keep the window responsive while the AI is thinking"""
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            pygame.quit()
+            sys.exit()
+
+
 def handle_player_turn(game):
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
@@ -675,10 +565,16 @@ def print_game_state(game):
 
 
 def main():
+    loader = ModelLoader(MODEL_NAME)
+    executor = ThreadPoolExecutor(max_workers=1)  # the model is not used concurrently by AI turns
+    # shared by the ponderers of every game: an abandoned AI turn or ponder call may outlive its game
+    model_lock = threading.Lock()
     while True:
         player_color = color_selection_screen()
         komi = komi_selection_screen()
         logging.info("Player Color:", player_color)
+        ai_bot = model_loading_screen(loader)
+        from goformer.ponder import Ponderer
 
         game_in_progress = True
         while game_in_progress:
@@ -687,25 +583,45 @@ def main():
                 agent_color = "w"
             elif player_color == "W":
                 agent_color = "b"
-            ai_bot = GoFormer("kenhktsui/goformer-v0.1", agent_color)
+            ai_bot.color = agent_color  # the model is loaded once, for every game
+            ponderer = (Ponderer(ai_bot, n_replies=PONDER_REPLIES, budget=AI_TURN_TIMEOUT, model_lock=model_lock)
+                        if PONDER else None)
+            start_pondering(game, ponderer)
 
             clock = pygame.time.Clock()
+            view = BoardView()
+            ai_turn = None
+            checked_state = None
 
             while not game.game_over:
                 game.start_turn()
-                update_display(game)
+                view.render(game, ai_turn)
 
                 if game.is_player_turn:
                     handle_player_turn(game)
                 else:
-                    handle_ai_turn(game, ai_bot)
-
-                if game.consecutive_passes == 2 or not game.can_make_move():
-                    game.end_game()
+                    if ai_turn is None:
+                        logging.debug("Starting AI turn")
+                        ai_turn = AITurn(executor, game, ai_bot, ponderer)
+                    handle_waiting_events()
+                    ai_move = ai_turn.poll()
+                    if ai_move is not None:
+                        ai_turn = None
+                        handle_ai_turn(game, ai_move, ponderer)
+
+                # Only look for the end of the game when a move or pass has been made
+                state = (game.current_player, game.move_count, game.consecutive_passes)
+                if state != checked_state:
+                    checked_state = state
+                    if game.consecutive_passes == 2 or not game.can_make_move():
+                        game.end_game()
 
                 clock.tick(60)
 
             game.end_game()
+            if ponderer is not None:
+                ponderer.stop()
+                logging.info(f"Ponder statistics - {ponderer.stats}")
             print_game_state(game)
             restart, exit_game = show_end_game_screen(game)
             if exit_game:
@@ -1,9 +1,13 @@
-from typing import Dict, Optional, List, Union, Tuple
+from typing import Dict, Optional, List, Union, Tuple, Iterable
 from itertools import product
 from dataclasses import dataclass
 import logging
 import numpy as np
+import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from goformer import tracing
+from goformer.backend import CompiledBackend, EagerBackend, crop_past_key_values
+from goformer.threads import apply_thread_config
 
 
 # Set up logging
@@ -65,44 +69,169 @@ class Round:
         return f"{LEELA_ENCODE_MAP_X[move[0]]}{LEELA_ENCODE_MAP_Y[move[1:]]}"
 
 
+def bound_context(memory_of_moves: List[Round], window: int, hop: int = 8) -> List[Round]:
+    """
+    Bound the history fed to the model to its last `window` to `window + hop` rounds, which keep their round
+    numbers; the earlier rounds are dropped. The cut only moves every `hop` rounds, so consecutive inputs share a
+    prefix between two cuts and KV caches of that prefix stay valid.
+    The input length is bounded whatever the length of the game, at the cost of accuracy: the model no longer sees
+    the stones played before the window (measure it with goformer.context_window).
+    """
+    if len(memory_of_moves) <= window + hop:
+        return memory_of_moves
+    cut = ((len(memory_of_moves) - window) // hop) * hop
+    return memory_of_moves[cut:]
+
+
+DEFAULT_CONTEXT_WINDOW = 64
+
+
+def model_rounds(leela_move_history: Dict[int, dict], color: str) -> List[Round]:
+    """Rounds to prompt the move of `color` after a move history"""
+    memory_of_moves = GoFormer.history_to_rounds(leela_move_history)
+    if color == 'b' and memory_of_moves[-1].white_move is not None:
+        # game.py only opens a round when black moves, so prompt black's move explicitly
+        memory_of_moves.append(Round(n=memory_of_moves[-1].n + 1, black_move=None, white_move=None))
+    return memory_of_moves
+
+
+def model_input_string(memory_of_moves: List[Round], version: str, color: str, context_window: Optional[int] = None,
+                       context_hop: int = 8, max_positions: Optional[int] = None) -> str:
+    """The model input of a history for `color`, bounded as described in GoFormer's context_window"""
+    if context_window is not None:
+        memory_of_moves = bound_context(memory_of_moves, context_window, context_hop)
+    memory_of_moves_string = " ".join([m.to_string(version, color) for m in memory_of_moves])
+    # The tokenizer is character level; keep room for the generated move
+    if max_positions is not None and len(memory_of_moves_string) + 3 > max_positions:
+        logging.warning(f"Model input of {len(memory_of_moves_string)} tokens exceeds the model's "
+                        f"{max_positions} positions, bounding its context")
+        memory_of_moves = bound_context(memory_of_moves, context_window or DEFAULT_CONTEXT_WINDOW, context_hop)
+        memory_of_moves_string = " ".join([m.to_string(version, color) for m in memory_of_moves])
+        while len(memory_of_moves_string) + 3 > max_positions and len(memory_of_moves) > 1:
+            # the window alone can be too long, drop the oldest rounds
+            memory_of_moves = memory_of_moves[context_hop:] or memory_of_moves[-1:]
+            memory_of_moves_string = " ".join([m.to_string(version, color) for m in memory_of_moves])
+    logging.debug(f"Goformer input: {memory_of_moves_string}")
+    return memory_of_moves_string
+
+
 class GoFormer:
-    def __init__(self, artifact_dir: str, color: str, version: str = '2'):
+    def __init__(self, artifact_dir: str, color: str, version: str = '2', context_window: Optional[int] = None,
+                 context_hop: int = 8, backend: str = "eager", exact_scoring: bool = False):
+        """
+        :param artifact_dir: model name on the Hugging Face Hub or local directory
+        :param color: colour played, 'b' or 'w'
+        :param version: model input format
+        :param context_window: rounds kept in the model input, the earlier ones are dropped (see bound_context).
+            None feeds the whole history. An input that would not fit in the
+            model's positions is bounded (with DEFAULT_CONTEXT_WINDOW if None), then its oldest rounds are dropped.
+        :param context_hop: rounds between two moves of the window cut
+        :param backend: "eager" runs the model in PyTorch, "compiled" through TorchScript graphs traced for
+            fixed shapes (see goformer.backend)
+        :param exact_scoring: suggest_moves ranks every unplayed point by its exact log-probability from a prefill
+            and a column decode step through the backend, instead of a beam search with `generate`
+        """
+        apply_thread_config()
         self._tokenizer = AutoTokenizer.from_pretrained(artifact_dir, trust_remote_code=True)
         self._model = AutoModelForCausalLM.from_pretrained(artifact_dir)
         self._version = version
         self._color = color
+        self._context_window = context_window
+        self._context_hop = context_hop
+        self._exact_scoring = exact_scoring
+        self._max_positions = (getattr(self._model.config, "n_positions", None)
+                               or getattr(self._model.config, "max_position_embeddings", None))
         assert isinstance(self._version, str), f"Invalid version: {self._version}"
 
         self._all_possible_move = [f"{i}{j.lower()}" for i, j in list(product(alphabets, alphabets.lower()))]
+        # A move is a column token followed by a row token, a pass is a single token
+        self._column_token_ids = self._tokenizer.convert_tokens_to_ids(list(alphabets))
+        self._row_token_ids = self._tokenizer.convert_tokens_to_ids(list(alphabets.lower()))
+        self._pass_token_id = self._tokenizer.convert_tokens_to_ids("X")
+        self._pad_token_id = self._tokenizer.pad_token_id or 0
+        if backend == "eager":
+            self._backend = EagerBackend(self._model, self._column_token_ids)
+        elif backend == "compiled":
+            self._backend = CompiledBackend(self._model, self._column_token_ids, self._pad_token_id,
+                                            max_positions=self._max_positions)
+        else:
+            raise ValueError(f"Invalid backend: {backend}")
 
-    def _create_model_input_string(self, memory_of_moves: List[Round]):
-        memory_of_moves_string = " ".join([m.to_string(self._version, self._color) for m in memory_of_moves])
-        logging.debug(f"Goformer input: {memory_of_moves_string}")
-        return memory_of_moves_string
+    @property
+    def color(self) -> str:
+        return self._color
 
-    def make_move(self, game, n_suggestion: Optional[int] = 19) -> Union[str, Tuple[int, int]]:
-        """Output format compatible with game.py"""
-        move = self.predict_next_move_with_leela(game.get_move_history(), n_suggestion)
+    @color.setter
+    def color(self, color: str):
+        """The same model plays either colour, so a loaded GoFormer can be reused for the other side"""
+        assert color in ('b', 'w'), f"Invalid color: {color}"
+        self._color = color
+
+    def _create_model_input_string(self, memory_of_moves: List[Round], color: Optional[str] = None):
+        return model_input_string(memory_of_moves, self._version, color or self._color, self._context_window,
+                                  self._context_hop, self._max_positions)
+
+    @staticmethod
+    def to_game_move(move: str) -> Union[str, Tuple[int, int]]:
+        """Convert a GTP move into the format of game.py"""
         if move in ['resign', 'PASS']:
-            logging.debug(f"GoFormer plays: {move}")
-            return move
-        else:
-            move = alphabets_wo_I.index(move[0]), 19 - int(move[1:])
-            logging.debug(f"GoFormer plays: {move}")
             return move
+        return alphabets_wo_I.index(move[0]), 19 - int(move[1:])
 
-    def predict_next_move_with_leela(self, leela_move_history: Dict[str, dict], n_suggestion: Optional[int] = 19) -> str:
-        """Output format compatible with GTP protocol, mainly used for simulation"""
-        memory_of_moves = []
+    @staticmethod
+    def to_gtp_move(x: int, y: int) -> str:
+        """Convert a point of game.py's board into a GTP move"""
+        return f"{alphabets_wo_I[x]}{19 - y}"
 
+    @staticmethod
+    def history_to_rounds(leela_move_history: Dict[int, dict]) -> List[Round]:
+        memory_of_moves = []
         for i in range(1, max(leela_move_history)+1):
             memory_of_moves.append(Round(n=i, black_move=leela_move_history[i].get("black"), white_move=leela_move_history[i].get("white")))
-        return self.predict_next_move(memory_of_moves, n_suggestion=n_suggestion)
+        return memory_of_moves
+
+    def make_move(self, game, n_suggestion: Optional[int] = 19) -> Union[str, Tuple[int, int]]:
+        """Output format compatible with game.py"""
+        move = self.to_game_move(self.predict_next_move_with_leela(game.get_move_history(), n_suggestion))
+        logging.debug(f"GoFormer plays: {move}")
+        return move
+
+    def predict_next_move_with_leela(self, leela_move_history: Dict[int, dict], n_suggestion: Optional[int] = 19,
+                                     color: Optional[str] = None) -> str:
+        """Output format compatible with GTP protocol, mainly used for simulation"""
+        return self.predict_next_move(self.history_to_model_rounds(leela_move_history, color),
+                                      n_suggestion=n_suggestion, color=color)
+
+    def history_to_model_rounds(self, leela_move_history: Dict[int, dict], color: Optional[str] = None) -> List[Round]:
+        """Rounds to prompt the move of `color` (default: GoFormer's colour) after a move history"""
+        return model_rounds(leela_move_history, color or self._color)
 
-    def predict_next_move(self, memory_of_moves: List[Round], n_suggestion: Optional[int] = 10) -> str:
+    def predict_next_move(self, memory_of_moves: List[Round], n_suggestion: Optional[int] = 10,
+                          color: Optional[str] = None) -> str:
         """Output format compatible with GTP protocol"""
+        suggested_moves = self.suggest_moves(memory_of_moves, n_suggestion=n_suggestion, color=color)
+        if not suggested_moves:
+            return "PASS"
+        return suggested_moves[0][0]
+
+    def suggest_moves(self, memory_of_moves: List[Round], n_suggestion: Optional[int] = 10,
+                      color: Optional[str] = None) -> List[Tuple[str, float]]:
+        """
+        Legal moves in GTP format with their log-probabilities, most likely first.
+        `color` defaults to the colour GoFormer plays, and can be set to the opponent's to predict its replies.
+        """
+        if self._exact_scoring:
+            legal_suggestions = self._exact_suggestions(memory_of_moves, n_suggestion, color)
+        else:
+            legal_suggestions = self._generate_suggestions(memory_of_moves, n_suggestion, color)
+        if legal_suggestions:
+            logging.debug(f"Goformer output: {legal_suggestions[0][0]} at {np.exp(legal_suggestions[0][1])}")
+        return legal_suggestions
 
-        memory_of_moves_string = self._create_model_input_string(memory_of_moves)
+    def _generate_suggestions(self, memory_of_moves: List[Round], n_suggestion: int,
+                              color: Optional[str]) -> List[Tuple[str, float]]:
+        """The legal sequences of a 3-token beam search with `generate`"""
+        memory_of_moves_string = self._create_model_input_string(memory_of_moves, color)
 
         previous_moves = [m.black_move for m in memory_of_moves if m.black_move is not None] + [
                 m.white_move for m in memory_of_moves if m.white_move is not None]
@@ -131,17 +260,126 @@ class GoFormer:
         zip_output = sorted(zip(generated_tokens, transition_scores), key=lambda x: x[1])[::-1]
         suggested_moves = [(self._tokenizer.decode(o, skip_special_tokens=True).strip(), p.item())
                            for o, p in zip_output]
-        gen_move = None
-        gen_move_p = None
+        legal_suggestions = []
         for s, p in suggested_moves:
             if s in legal_move_set:
-                gen_move = s
-                gen_move_p = p
-                break
-        if gen_move is None:
-            return "PASS"
+                legal_suggestions.append((self._decode_move(s), p))
+        return legal_suggestions
+
+    def _exact_suggestions(self, memory_of_moves: List[Round], n_suggestion: int,
+                           color: Optional[str]) -> List[Tuple[str, float]]:
+        """The unplayed points with the highest exact log-probabilities, from the backend's two passes"""
+        previous_moves = {m for r in memory_of_moves for m in (r.black_move, r.white_move) if m is not None}
+        move_logprobs, _ = self._move_logprobs([self.tokenize(memory_of_moves, color)])
+        legal_moves = [m for m in self.all_gtp_moves if m not in previous_moves]
+        logprobs = [move_logprobs[0, alphabets_wo_I.index(m[0]), int(m[1:]) - 1] for m in legal_moves]
+        return [(legal_moves[i], float(logprobs[i])) for i in np.argsort(logprobs)[::-1][:n_suggestion]]
+
+    def tokenize(self, memory_of_moves: List[Round], color: Optional[str] = None) -> List[int]:
+        """Token ids of the model input for `color` (default: GoFormer's colour)"""
+        return self._tokenizer(self._create_model_input_string(memory_of_moves, color),
+                               add_special_tokens=False)["input_ids"]
+
+    def move_distribution(self, memory_of_moves: List[Round], color: Optional[str] = None,
+                          legal_moves: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """Exact probability of every legal move in GTP format, see move_distribution_batch"""
+        return self.move_distribution_batch([memory_of_moves], [color],
+                                            None if legal_moves is None else [legal_moves])[0]
+
+    @torch.no_grad()
+    def _move_logprobs(self, encoded: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Log-probabilities of every point [batch, column, row] and of a pass [batch] after each token sequence.
+        A move is a column token followed by a row token, so one padded prefill gives the column (and pass)
+        distribution, and one decode step over every column gives the row distributions.
+        """
+        max_length = max(len(e) for e in encoded)
+        # Left padding, so that the next token is predicted at the last position of every sequence
+        input_ids = torch.tensor([[self._pad_token_id] * (max_length - len(e)) + e for e in encoded])
+        attention_mask = torch.tensor([[0] * (max_length - len(e)) + [1] * len(e) for e in encoded])
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        with tracing.span("goformer.forward", "model", batch=len(encoded), tokens=max_length):
+            return self._logits_to_logprobs(*self._backend.move_logits(input_ids, attention_mask, position_ids))
 
-        logging.debug(f"Goformer output: {gen_move} at {np.exp(gen_move_p)}")
+    def point_logprobs(self, encoded: List[List[int]]) -> np.ndarray:
+        """
+        [batch, 362] log-probabilities of the next move after each token sequence: the point of column c (in
+        alphabets_wo_I) and GTP row r + 1 at c * 19 + r, and a pass last
+        """
+        move_logprobs, pass_logprobs = self._move_logprobs(encoded)
+        return np.concatenate([move_logprobs.reshape(len(encoded), -1), pass_logprobs[:, None]], axis=1)
+
+    def _logits_to_logprobs(self, first_logits: torch.Tensor,
+                            row_logits: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        first_logprobs = torch.log_softmax(first_logits.float(), dim=-1)
+        row_logprobs = torch.log_softmax(row_logits.float(), dim=-1)[:, self._row_token_ids]
+        move_logprobs = (first_logprobs[:, self._column_token_ids].unsqueeze(-1)
+                         + row_logprobs.view(first_logits.shape[0], len(self._column_token_ids), -1))
+        return move_logprobs.numpy(), first_logprobs[:, self._pass_token_id].numpy()
+
+    def move_distribution_batch(self, batch_of_moves: List[List[Round]], colors: Optional[List[Optional[str]]] = None,
+                                legal_moves: Optional[List[Iterable[str]]] = None) -> List[Dict[str, float]]:
+        """
+        Exact probability of every legal move in GTP format, for a batch of histories.
+        Probabilities are renormalised over `legal_moves` (GTP moves, "PASS" included), which defaults to the
+        points not played yet and PASS.
+        """
+        colors = colors or [None] * len(batch_of_moves)
+        encoded = [self.tokenize(m, c) for m, c in zip(batch_of_moves, colors)]
+        move_logprobs, pass_logprobs = self._move_logprobs(encoded)
+        legal_moves = legal_moves or [None] * len(batch_of_moves)
+        return [self._distribution(m, move_logprobs[i], pass_logprobs[i], legal_moves[i])
+                for i, m in enumerate(batch_of_moves)]
+
+    def _distribution(self, memory_of_moves: List[Round], move_logprobs: np.ndarray, pass_logprob: float,
+                      legal_moves: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        if legal_moves is None:
+            played = {m for r in memory_of_moves for m in (r.black_move, r.white_move) if m is not None}
+            candidates = [m for m in self.all_gtp_moves if m not in played] + ["PASS"]
+        else:
+            candidates = list(legal_moves)
+        logprobs = np.array([
+            pass_logprob if m == "PASS" else move_logprobs[alphabets_wo_I.index(m[0]), int(m[1:]) - 1]
+            for m in candidates
+        ])
+        probs = np.exp(logprobs - logprobs.max())
+        probs /= probs.sum()
+        return dict(zip(candidates, probs.tolist()))
+
+    @torch.no_grad()
+    def move_distribution_cached(self, memory_of_moves: List[Round], color: Optional[str] = None,
+                                 legal_moves: Optional[Iterable[str]] = None, past_tokens: Optional[List[int]] = None,
+                                 past_key_values=None) -> Tuple[Dict[str, float], List[int], tuple, int]:
+        """
+        Same as move_distribution, reusing the KV cache `past_key_values` of a previous model input `past_tokens`
+        for their common prefix. Returns the distribution, the tokens of this input, their KV cache and the number
+        of tokens reused.
+        """
+        tokens = self.tokenize(memory_of_moves, color)
+        n_reused = 0
+        if past_key_values is not None:
+            # at least one token is computed, it predicts the next move
+            limit = min(len(past_tokens), len(tokens) - 1)
+            while n_reused < limit and past_tokens[n_reused] == tokens[n_reused]:
+                n_reused += 1
+        past_key_values = crop_past_key_values(past_key_values, n_reused) if n_reused else None
+        attention_mask = torch.ones(1, len(tokens), dtype=torch.long)
+        position_ids = torch.arange(n_reused, len(tokens)).unsqueeze(0)
+        with tracing.span("goformer.forward", "model", batch=1, tokens=len(tokens) - n_reused):
+            first_logits, past_key_values = self._backend.prefill(torch.tensor([tokens[n_reused:]]), attention_mask,
+                                                                  position_ids, past_key_values)
+            row_logits = self._backend.decode(past_key_values, attention_mask, position_ids)
+        move_logprobs, pass_logprobs = self._logits_to_logprobs(first_logits, row_logits)
+        distribution = self._distribution(memory_of_moves, move_logprobs[0], pass_logprobs[0], legal_moves)
+        return distribution, tokens, past_key_values, n_reused
+
+    @property
+    def all_gtp_moves(self) -> List[str]:
+        """Every point of the board in GTP format"""
+        return [f"{x}{y}" for x in alphabets_wo_I for y in range(1, 20)]
+
+    @staticmethod
+    def _decode_move(gen_move: str) -> str:
         if gen_move in ['B+R', "W+R"]:
             return "resign"
         elif gen_move == 'X':
@@ -0,0 +1,246 @@
+from typing import Dict, List, Optional
+import argparse
+import logging
+import random
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from goformer import tracing
+from goformer.rules import GoGame, BOARD_SIZE, GTP_COLUMNS
+
+
+PLAYERS = ("random", "heuristic")
+KNOWN_COMMANDS = ["protocol_version", "name", "version", "known_command", "list_commands", "quit", "boardsize",
+                  "clear_board", "komi", "time_settings", "play", "genmove", "undo", "final_score"]
+
+
+def _neighbours(x: int, y: int):
+    for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+        nx, ny = x + dx, y + dy
+        if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+            yield nx, ny
+
+
+def is_own_eye(game: GoGame, x: int, y: int) -> bool:
+    """Whether every neighbour of (x, y) is a stone of the player to move; filling it is never useful"""
+    return all(game.board[ny][nx] == game.current_player for nx, ny in _neighbours(x, y))
+
+
+def captures(game: GoGame, x: int, y: int) -> int:
+    """Number of stones the player to move captures by playing at (x, y)"""
+    enemy_color = 'W' if game.current_player == 'B' else 'B'
+    game.board[y][x] = game.current_player
+    captured = game.check_captures(x, y, enemy_color, dryrun=True)
+    game.board[y][x] = None
+    return len(captured)
+
+
+def choose_move(game: GoGame, player: str, rng: random.Random) -> str:
+    """
+    Move in GTP format of a stand-in player: `random` plays uniformly among the legal moves that do not fill its own
+    eyes, `heuristic` captures the largest group it can and plays randomly otherwise. Both pass when nothing is left.
+    """
+    moves = [(x, y) for x, y in game.legal_moves() if not is_own_eye(game, x, y)]
+    if not moves:
+        return "pass"
+    if player == "heuristic":
+        n_captures = [captures(game, x, y) for x, y in moves]
+        if max(n_captures) > 0:
+            moves = [m for m, n in zip(moves, n_captures) if n == max(n_captures)]
+    x, y = rng.choice(moves)
+    return f"{GTP_COLUMNS[x]}{BOARD_SIZE - y}"
+
+
+class GTPEngine:
+    """
+    A stand-in for Leela Zero speaking GTP on the local rules, to test and benchmark arenas offline.
+    Failures of a real engine can be injected: a command may hang or get a malformed reply.
+    """
+    def __init__(self,
+                 player: str = "random",
+                 think_time: float = 0.0,
+                 hang_rate: float = 0.0,
+                 hang_time: float = 3600.0,
+                 malformed_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        """
+        :param player: "random" or "heuristic", see choose_move
+        :param think_time: seconds slept before answering genmove
+        :param hang_rate: probability that a command hangs
+        :param hang_time: seconds a hanging command sleeps before answering
+        :param malformed_rate: probability that a command gets a reply outside the protocol
+        :param seed: random seed of the moves and the failures
+        """
+        assert player in PLAYERS, f"Invalid player: {player}"
+        self._player = player
+        self._think_time = think_time
+        self._hang_rate = hang_rate
+        self._hang_time = hang_time
+        self._malformed_rate = malformed_rate
+        self._rng = random.Random(seed)
+        self._komi = 7.5
+        self._game = GoGame("B", self._komi)
+
+    def _play(self, color: str, move: str) -> bool:
+        color = color[0].upper()
+        if color != self._game.current_player:
+            self._game.pass_turn()  # GTP lets the same colour play twice
+        return self._game.play(move)
+
+    def handle(self, command: str) -> str:
+        """Response to a GTP command, without the trailing blank line"""
+        parts = command.split()
+        name, args = parts[0], parts[1:]
+        if name == "protocol_version":
+            return "= 2"
+        if name == "name":
+            return "= GoFormer stand-in"
+        if name == "version":
+            return "= 0.1"
+        if name == "known_command":
+            return f"= {'true' if args and args[0] in KNOWN_COMMANDS else 'false'}"
+        if name == "list_commands":
+            return "= " + "\n".join(KNOWN_COMMANDS)
+        if name == "boardsize":
+            return "=" if args and int(args[0]) == BOARD_SIZE else "? unacceptable size"
+        if name == "clear_board":
+            self._game = GoGame("B", self._komi)
+            return "="
+        if name == "komi":
+            self._komi = float(args[0])
+            self._game.komi = self._game.white_score = self._komi
+            return "="
+        if name == "time_settings":
+            return "="
+        if name == "play":
+            return "=" if self._play(args[0], args[1]) else "? illegal move"
+        if name == "genmove":
+            time.sleep(self._think_time)
+            if args[0][0].upper() != self._game.current_player:
+                self._game.pass_turn()
+            move = choose_move(self._game, self._player, self._rng)
+            self._game.play(move)
+            return f"= {move}"
+        if name == "undo":
+            return "=" if self._game.undo() else "? cannot undo"
+        if name == "final_score":
+            self._game.calculate_score()
+            margin = self._game.black_score - self._game.white_score
+            return "= 0" if margin == 0 else f"= {'B' if margin > 0 else 'W'}+{abs(margin)}"
+        return "? unknown command"
+
+    def run(self, stdin=sys.stdin, stdout=sys.stdout):
+        for line in stdin:
+            command = line.split("#")[0].strip()
+            if not command:
+                continue
+            if command == "quit":
+                stdout.write("=\n\n")
+                stdout.flush()
+                break
+            if self._rng.random() < self._hang_rate:
+                time.sleep(self._hang_time)
+            if self._rng.random() < self._malformed_rate:
+                response = self._rng.choice(["garbage", "=", "= Z99", "?"])
+            else:
+                with tracing.span(f"engine.{command.split()[0]}", "engine"):
+                    response = self.handle(command)
+            stdout.write(response + "\n\n")
+            stdout.flush()
+
+
+def engine_command(player: str = "random", think_time: float = 0.0, hang_rate: float = 0.0,
+                   hang_time: float = 3600.0, malformed_rate: float = 0.0, seed: Optional[int] = None) -> List[str]:
+    """Command line of a stand-in engine, for LeelaZeroWrapper(command=...)"""
+    command = [sys.executable, "-m", "goformer.gtp_engine", "--player", player, "--think-time", str(think_time),
+               "--hang-rate", str(hang_rate), "--hang-time", str(hang_time), "--malformed-rate", str(malformed_rate)]
+    if seed is not None:
+        command += ["--seed", str(seed)]
+    return command
+
+
+class StandInAgent:
+    """A stand-in for GoFormer with the same interface as the simulation, playing like the stand-in engine"""
+    def __init__(self, player: str = "random", seed: Optional[int] = None):
+        self._player = player
+        self._rng = random.Random(seed)
+        self._game = GoGame("B", 7.5)
+        self._moves: List[str] = []
+
+    def predict_next_move_with_leela(self, leela_move_history: Dict[int, dict]) -> str:
+        moves = [leela_move_history[i][color] for i in sorted(leela_move_history)
+                 for color in ("black", "white") if leela_move_history[i].get(color) is not None]
+        if moves[:len(self._moves)] != self._moves:
+            self._game = GoGame("B", 7.5)  # a new game
+            self._moves = []
+        for move in moves[len(self._moves):]:
+            if self._game.current_player != ("B" if len(self._moves) % 2 == 0 else "W"):
+                self._game.pass_turn()
+            self._game.play(move)
+            self._moves.append(move)
+        return choose_move(self._game, self._player, self._rng).upper()
+
+
+def _arena_game(options: dict) -> dict:
+    from goformer.simulation import LeelaZeroWrapper, play_game
+    logging.getLogger().setLevel(logging.ERROR)
+    leela = LeelaZeroWrapper(command=engine_command(**options["engine"]), timeout=options["timeout"])
+    agent = StandInAgent(options["agent_player"], options["engine"].get("seed"))
+    try:
+        with tracing.game(options["engine"].get("seed")):
+            record = play_game(leela, agent, options["agent_color"], max_moves=options["max_moves"])
+    finally:
+        leela.close()
+    record["engine_failed"] = leela.failed
+    return record
+
+
+def benchmark(n_games: int = 20, workers: int = 1, max_moves: Optional[int] = 400, timeout: float = 10,
+              agent_player: str = "random", **engine_options) -> Dict[str, float]:
+    """Play games of the simulation between a stand-in agent and stand-in engines, and measure the throughput"""
+    games = [{"engine": {**engine_options, "seed": i}, "agent_player": agent_player, "timeout": timeout,
+              "max_moves": max_moves, "agent_color": "black" if i % 2 == 0 else "white"}
+             for i in range(n_games)]
+    start_time = time.time()
+    with ProcessPoolExecutor(workers) as executor:
+        records = list(executor.map(_arena_game, games))
+    seconds = time.time() - start_time
+    n_moves = sum(r["moves"] for r in records)
+    return {"games": n_games, "seconds": seconds, "games_per_second": n_games / seconds,
+            "moves_per_second": n_moves / seconds, "engine_failures": sum(r["engine_failed"] for r in records),
+            "engine_seconds": sum(r["leela_seconds"] for r in records)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stand-in GTP engine on the local rules, or its arena benchmark")
+    parser.add_argument("--player", choices=PLAYERS, default="random")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds slept before every genmove answer")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="probability that a command hangs")
+    parser.add_argument("--hang-time", type=float, default=3600.0, help="seconds a hanging command sleeps")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="probability of a malformed reply")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--benchmark", type=int, default=None, metavar="GAMES",
+                        help="instead of speaking GTP, play this many arena games against stand-in engines")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-moves", type=int, default=400)
+    parser.add_argument("--timeout", type=float, default=10, help="seconds before a silent engine resigns")
+    parser.add_argument("--trace", default=None, metavar="DIR",
+                        help="record a timeline of the arena, its workers and engines into DIR, see goformer.tracing")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.trace:
+        tracing.enable(args.trace)
+    if tracing.enabled():
+        # the arena terminates its engines; exit cleanly so that the buffered events are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.benchmark is None:
+        GTPEngine(args.player, args.think_time, args.hang_rate, args.hang_time, args.malformed_rate, args.seed).run()
+    else:
+        result = benchmark(args.benchmark, args.workers, args.max_moves, args.timeout, player=args.player,
+                           think_time=args.think_time, hang_rate=args.hang_rate, hang_time=args.hang_time,
+                           malformed_rate=args.malformed_rate)
+        print(f"{result['games']} games in {result['seconds']:.1f}s: {result['games_per_second']:.2f} games/s, "
+              f"{result['moves_per_second']:.0f} moves/s, {result['engine_failures']} engine failures, "
+              f"engine time {result['engine_seconds']:.1f}s")
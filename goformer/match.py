@@ -0,0 +1,259 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import argparse
+import json
+import logging
+import math
+import os
+import time
+import numpy as np
+from goformer import tracing
+from goformer.goformer import GoFormer, model_rounds
+from goformer.rules import GoGame
+
+
+def elo_to_score(elo: float) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def score_to_elo(score: float) -> float:
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+
+@dataclass
+class MatchStats:
+    wins: int = 0
+    draws: int = 0
+    losses: int = 0
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.draws + self.losses
+
+    @property
+    def score(self) -> float:
+        return (self.wins + self.draws / 2) / self.games if self.games else 0.5
+
+    @property
+    def variance(self) -> float:
+        """Variance of a single game's score"""
+        if not self.games:
+            return 0.0
+        s = self.score
+        return (self.wins * (1 - s) ** 2 + self.draws * (0.5 - s) ** 2 + self.losses * s ** 2) / self.games
+
+    def add(self, score: float):
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    def llr(self, elo0: float, elo1: float) -> float:
+        """
+        Log-likelihood ratio of H1 (Elo difference elo1) against H0 (elo0), with the normal approximation of the
+        score used by the generalised SPRT of chess engine testing.
+        The variance has a prior of one win and one loss, so that a one-sided match still reaches a bound.
+        """
+        if not self.games:
+            return 0.0
+        variance = MatchStats(self.wins + 1, self.draws, self.losses + 1).variance
+        s0, s1 = elo_to_score(elo0), elo_to_score(elo1)
+        return self.games * (s1 - s0) * (2 * self.score - s0 - s1) / (2 * variance)
+
+    def elo(self, z: float = 1.96) -> Tuple[float, float, float]:
+        """Elo difference estimate with the bounds of its confidence interval (95% by default)"""
+        margin = z * math.sqrt(self.variance / self.games) if self.games else 0.5
+        return score_to_elo(self.score), score_to_elo(self.score - margin), score_to_elo(self.score + margin)
+
+    def __str__(self):
+        elo, low, high = self.elo()
+        return (f"{self.games} games (+{self.wins} ={self.draws} -{self.losses}), score {self.score:.1%}, "
+                f"Elo {elo:+.1f} [{low:+.1f}, {high:+.1f}]")
+
+
+class SPRT:
+    """Sequential probability ratio test of H0: Elo difference = elo0 against H1: Elo difference = elo1"""
+    def __init__(self, elo0: float = 0.0, elo1: float = 10.0, alpha: float = 0.05, beta: float = 0.05):
+        """
+        :param elo0: Elo difference of the null hypothesis
+        :param elo1: Elo difference of the alternative hypothesis
+        :param alpha: probability of accepting H1 when H0 holds
+        :param beta: probability of accepting H0 when H1 holds
+        """
+        assert elo0 < elo1, f"Invalid Elo bounds: {elo0} {elo1}"
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+
+    def status(self, stats: MatchStats) -> Optional[str]:
+        """'H1' when the candidate is accepted as stronger, 'H0' when rejected, None to keep playing"""
+        llr = stats.llr(self.elo0, self.elo1)
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+
+def agent_move(agent, game: GoGame) -> str:
+    """Move in GTP format of any of the agents (GoFormer, PUCTSearch, SymmetryEnsemble...) for the player to move"""
+    if isinstance(agent, GoFormer):
+        return agent.predict_next_move_with_leela(game.get_move_history(), color=game.current_player.lower())
+    move = agent.make_move(game)
+    return move if isinstance(move, str) else GoFormer.to_gtp_move(*move)
+
+
+def opening_move(agent, game: GoGame, temperature: float, rng: np.random.Generator) -> str:
+    """
+    Move in GTP format sampled with `temperature` from the move distribution of the agent, or uniformly among the
+    legal moves for an agent without one
+    """
+    legal_moves = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+    if not hasattr(agent, "move_distribution"):
+        return legal_moves[rng.integers(len(legal_moves))]
+    color = game.current_player.lower()
+    distribution = agent.move_distribution(model_rounds(game.get_move_history(), color), color, legal_moves)
+    moves = list(distribution)
+    probs = np.array([distribution[m] for m in moves], dtype=np.float64)
+    if temperature <= 0:
+        return moves[int(np.argmax(probs))]
+    logits = np.log(np.maximum(probs, 1e-12)) / temperature
+    probs = np.exp(logits - logits.max())
+    return moves[rng.choice(len(moves), p=probs / probs.sum())]
+
+
+def play_match_game(candidate, baseline, candidate_color: str, komi: float = 7.5, max_moves: int = 400,
+                    opening_plies: int = 8, opening_temperature: float = 1.0, seed=None) -> dict:
+    """
+    Play one game on the local rules and return its record, with the score from the candidate's view.
+    The first `opening_plies` plies are sampled (see opening_move) with a numpy generator seeded by `seed`, so that
+    deterministic agents do not replay the same games.
+    """
+    game = GoGame("B", komi)
+    players = {candidate_color: candidate, "W" if candidate_color == "B" else "B": baseline}
+    rng = np.random.default_rng(seed)
+    moves = []
+    while not game.game_over and len(moves) < max_moves:
+        with tracing.span("move", "agent", color=game.current_player):
+            if len(moves) < opening_plies:
+                move = opening_move(players[game.current_player], game, opening_temperature, rng)
+            else:
+                move = agent_move(players[game.current_player], game)
+        if move == "resign":
+            game.resign()
+            break
+        if not game.play(move):
+            logging.debug(f"Illegal move {move} by {game.current_player}, passing instead")
+            move = "PASS"
+            game.play(move)
+        moves.append(move)
+    with tracing.span("score.calculate", "scoring"):
+        game.calculate_score()
+    if game.resigned:
+        winner = game.winner
+    elif game.black_score == game.white_score:
+        winner = None
+    else:
+        winner = "B" if game.black_score > game.white_score else "W"
+    return {
+        "candidate_color": candidate_color,
+        "moves": moves,
+        "black_score": game.black_score,
+        "white_score": game.white_score,
+        "winner": winner,
+        "score": 0.5 if winner is None else float(winner == candidate_color),
+        "seed": seed,
+    }
+
+
+def load_results(path: str) -> List[dict]:
+    """The game records of a results file, which is truncated after its last complete line"""
+    results = []
+    if os.path.exists(path):
+        with open(path, "rb+") as f:
+            # a line cut by an interruption: its game is played again
+            f.truncate(f.read().rfind(b"\n") + 1)
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping a malformed record of {path}: {line.strip()[:80]}")
+    return results
+
+
+def run_match(play_game: Callable[[int, str], dict], results_path: str, sprt: SPRT, max_games: int = 1000) -> Dict:
+    """
+    Play games until the SPRT accepts or rejects, or `max_games` is reached.
+    `play_game(game_index, candidate_color)` returns the record of a game with its "score" for the candidate.
+    Colours alternate. Every record is appended to `results_path`, and the games already there are counted first,
+    so an interrupted match resumes where it stopped.
+    """
+    stats = MatchStats()
+    results = load_results(results_path)
+    for result in results:
+        stats.add(result["score"])
+    if results:
+        logging.info(f"Resuming from {results_path}: {stats}")
+
+    status = sprt.status(stats)
+    start_time = time.time()
+    with open(results_path, "a") as f:
+        while status is None and stats.games < max_games:
+            game_index = stats.games
+            candidate_color = "B" if game_index % 2 == 0 else "W"
+            with tracing.game(game_index):
+                result = play_game(game_index, candidate_color)
+            result["game"] = game_index
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            stats.add(result["score"])
+            status = sprt.status(stats)
+            logging.info(f"{stats}, LLR {stats.llr(sprt.elo0, sprt.elo1):.2f} "
+                         f"[{sprt.lower:.2f}, {sprt.upper:.2f}], {time.time() - start_time:.0f}s")
+
+    elo, low, high = stats.elo()
+    return {"status": status, "games": stats.games, "wins": stats.wins, "draws": stats.draws,
+            "losses": stats.losses, "llr": stats.llr(sprt.elo0, sprt.elo1), "elo": elo, "elo_low": low,
+            "elo_high": high}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SPRT match between two GoFormer checkpoints")
+    parser.add_argument("--candidate", required=True, help="model name or directory of the candidate")
+    parser.add_argument("--baseline", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--results", required=True, help="results JSONL, appended to and resumed from")
+    parser.add_argument("--elo0", type=float, default=0.0)
+    parser.add_argument("--elo1", type=float, default=10.0)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--max-games", type=int, default=1000)
+    parser.add_argument("--max-moves", type=int, default=400, help="plies after which a game is scored")
+    parser.add_argument("--komi", type=float, default=7.5)
+    parser.add_argument("--opening-plies", type=int, default=8,
+                        help="plies sampled from the move distributions at the start of every game")
+    parser.add_argument("--opening-temperature", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0, help="the opening of game i is seeded by (seed, i)")
+    parser.add_argument("--trace", default=None, metavar="DIR",
+                        help="record a timeline of every stage into DIR, see goformer.tracing")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    if args.trace:
+        tracing.enable(args.trace)
+    candidate = GoFormer(args.candidate, 'b')
+    baseline = GoFormer(args.baseline, 'b')
+    result = run_match(lambda i, color: play_match_game(candidate, baseline, color, args.komi, args.max_moves,
+                                                        args.opening_plies, args.opening_temperature,
+                                                        seed=[args.seed, i]),
+                       args.results, SPRT(args.elo0, args.elo1, args.alpha, args.beta), args.max_games)
+    verdict = {"H1": "candidate is stronger", "H0": "candidate is not stronger", None: "inconclusive"}[result["status"]]
+    print(f"{verdict} after {result['games']} games (+{result['wins']} ={result['draws']} -{result['losses']}), "
+          f"LLR {result['llr']:.2f}, Elo {result['elo']:+.1f} [{result['elo_low']:+.1f}, {result['elo_high']:+.1f}]")
@@ -0,0 +1,161 @@
+from typing import Dict, Optional, Tuple, Union
+from dataclasses import dataclass
+import copy
+import logging
+import threading
+import time
+from goformer.goformer import GoFormer
+
+
+@dataclass
+class PonderStats:
+    pondered_turns: int = 0
+    speculative_answers: int = 0
+    hits: int = 0
+    misses: int = 0
+    ponder_seconds: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return (f"pondered turns: {self.pondered_turns}, speculative answers: {self.speculative_answers}, "
+                f"hits: {self.hits}, misses: {self.misses}, hit rate: {self.hit_rate:.1%}, "
+                f"ponder time: {self.ponder_seconds:.1f}s")
+
+
+def extend_move_history(move_history: Dict[int, dict], move: str, color: str) -> Dict[int, dict]:
+    """Return a copy of a move history (game.py format) with `move` played by `color` ('b' or 'w')"""
+    extended = copy.deepcopy(move_history)
+    last_round = max(extended)
+    if color == 'w':
+        extended[last_round]["white"] = move
+    elif last_round == 1 and extended[1].get("black") is None and extended[1].get("white") is None:
+        # get_move_history() returns a placeholder round before the first move
+        extended[1] = {"black": move}
+    else:
+        extended[last_round + 1] = {"black": move}
+    return extended
+
+
+class Ponderer:
+    """
+    Thinks on the opponent's time.
+    While the opponent is to move, GoFormer predicts its most likely replies from the same move distribution and
+    computes its own answer to each of them in a background thread. If the opponent then plays one of them, the
+    answer is returned instantly, without waiting for the model call in progress.
+    """
+    def __init__(self, agent: GoFormer, n_replies: int = 4, budget: float = 10.0,
+                 model_lock: Optional[threading.Lock] = None):
+        """
+        :param agent: the GoFormer to ponder with
+        :param n_replies: number of the opponent's most likely replies to answer speculatively
+        :param budget: maximum seconds spent pondering per opponent turn
+        :param model_lock: lock of the agent shared with other users of it, a new one by default
+        """
+        self._agent = agent
+        self._n_replies = n_replies
+        self._budget = budget
+        self._opponent_color = 'w' if agent.color == 'b' else 'b'
+        # the model is shared between the ponder thread and the caller
+        self._model_lock = model_lock or threading.Lock()
+        # the answers and statistics are written by the ponder thread, which may outlive stop()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._base_history: Optional[Dict[int, dict]] = None
+        self._answers: Dict[str, str] = {}
+        self.stats = PonderStats()
+
+    @property
+    def model_lock(self) -> threading.Lock:
+        """Hold this lock to use the agent while the ponderer may be running"""
+        return self._model_lock
+
+    @property
+    def is_pondering(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, move_history: Dict[int, dict]):
+        """Start pondering on a position where the opponent is to move"""
+        self.stop()
+        self._base_history = copy.deepcopy(move_history)
+        # a stopped thread may still be finishing a model call: it keeps its own answers and stop event
+        self._answers = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._ponder,
+                                        args=(self._base_history, self._answers, self._stop_event), daemon=True)
+        self._thread.start()
+        with self._lock:
+            self.stats.pondered_turns += 1
+
+    def stop(self, wait: bool = False):
+        """
+        Stop pondering. The model call in progress, if any, finishes in the background while holding model_lock,
+        unless `wait`.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            if wait:
+                self._thread.join()
+            self._thread = None
+
+    def _ponder(self, move_history: Dict[int, dict], answers: Dict[str, str], stop_event: threading.Event):
+        start_time = time.time()
+        with self._model_lock:
+            replies = [] if stop_event.is_set() else self._agent.suggest_moves(
+                self._agent.history_to_rounds(move_history), n_suggestion=max(self._n_replies, 1),
+                color=self._opponent_color)
+        for reply, logprob in replies[:self._n_replies]:
+            if stop_event.is_set() or time.time() - start_time > self._budget:
+                break
+            with self._model_lock:
+                if stop_event.is_set():
+                    break
+                answer = self._agent.predict_next_move_with_leela(
+                    extend_move_history(move_history, reply, self._opponent_color))
+            with self._lock:
+                answers[reply] = answer
+                self.stats.speculative_answers += 1
+            logging.debug(f"Pondered {reply} (log-probability {logprob:.2f}), answer: {answer}")
+        with self._lock:
+            self.stats.ponder_seconds += time.time() - start_time
+
+    def lookup(self, move_history: Dict[int, dict]) -> Optional[str]:
+        """Return the pondered answer (GTP format) if the opponent played one of the predicted replies"""
+        if self._base_history is None:
+            return None
+        with self._lock:
+            answers = list(self._answers.items())
+        for reply, answer in answers:
+            if extend_move_history(self._base_history, reply, self._opponent_color) == move_history:
+                with self._lock:
+                    self.stats.hits += 1
+                logging.debug(f"Ponder hit on {reply}")
+                return answer
+        with self._lock:
+            self.stats.misses += 1
+        return None
+
+    def take(self, move_history: Dict[int, dict]) -> Optional[str]:
+        """Stop pondering and return the pondered answer to the opponent's move, if any, without waiting"""
+        self.stop()
+        answer = self.lookup(move_history)
+        self._base_history = None
+        return answer
+
+    def predict_next_move_with_leela(self, leela_move_history: Dict[int, dict], n_suggestion: Optional[int] = 19) -> str:
+        """Same as GoFormer.predict_next_move_with_leela, answering from the ponder cache on a hit"""
+        answer = self.take(leela_move_history)
+        if answer is not None:
+            return answer
+        with self._model_lock:
+            return self._agent.predict_next_move_with_leela(leela_move_history, n_suggestion)
+
+    def make_move(self, game) -> Union[str, Tuple[int, int]]:
+        """Same as GoFormer.make_move, answering from the ponder cache on a hit"""
+        move = GoFormer.to_game_move(self.predict_next_move_with_leela(game.get_move_history()))
+        logging.debug(f"GoFormer plays: {move}")
+        return move
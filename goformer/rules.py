@@ -0,0 +1,570 @@
+from typing import List, Optional, Tuple
+from dataclasses import dataclass, field
+import copy
+import logging
+import random
+
+
+BOARD_SIZE = 19
+GTP_COLUMNS = "ABCDEFGHJKLMNOPQRST"  # I is skipped
+
+N_SYMMETRIES = 8
+# The 8 symmetries of the board on (column, row) indices in [0, 18]: 4 rotations, then 4 reflections
+_LAST = BOARD_SIZE - 1
+SYMMETRIES = [
+    lambda i, j: (i, j),
+    lambda i, j: (j, _LAST - i),
+    lambda i, j: (_LAST - i, _LAST - j),
+    lambda i, j: (_LAST - j, i),
+    lambda i, j: (_LAST - i, j),
+    lambda i, j: (j, i),
+    lambda i, j: (i, _LAST - j),
+    lambda i, j: (_LAST - j, _LAST - i),
+]
+INVERSE_SYMMETRIES = [0, 3, 2, 1, 4, 5, 6, 7]
+
+logger = logging.getLogger(__name__)
+
+# Zobrist keys for incremental position hashing
+_zobrist_random = random.Random(BOARD_SIZE)
+ZOBRIST_STONES = {
+    (x, y, color): _zobrist_random.getrandbits(64)
+    for x in range(BOARD_SIZE) for y in range(BOARD_SIZE) for color in ('B', 'W')
+}
+ZOBRIST_WHITE_TO_PLAY = _zobrist_random.getrandbits(64)
+
+
+@dataclass
+class MoveDelta:
+    """What a move changes, with the state it replaces, so that it can be undone and redone without a board copy"""
+    player: str
+    point: Optional[Tuple[int, int]]  # None for a pass
+    captured: List[Tuple[int, int]]
+    black_score: float
+    white_score: float
+    stones_hash: int
+    previous_stones_hash: Optional[int]
+    passed: bool
+    consecutive_passes: int
+    last_move: Optional[Tuple[int, int]]
+    ai_last_move: Optional[Tuple[int, int]]
+    resigned: bool = False
+    winner: Optional[str] = None  # set by the end of the game
+    ends_game: bool = False  # the second consecutive pass
+    resigns: bool = False
+
+
+@dataclass(eq=False)
+class GameTreeNode:
+    """A position of the variation tree, reached from its parent by `delta`"""
+    delta: Optional[MoveDelta] = None
+    parent: Optional["GameTreeNode"] = None
+    children: List["GameTreeNode"] = field(default_factory=list)
+    selected: Optional["GameTreeNode"] = None  # the child redo() follows
+    ply: int = 0
+
+
+class GoGame:
+    """Go rules and game state, without any rendering"""
+    def __init__(self, player_color, komi):
+        self.board = [[None for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)]
+        self._player_color = player_color
+        self._ai_color = "W" if player_color == "B" else "B"
+        self._current_player = "B"  # Black always starts
+        self.last_move = None
+        self.ai_last_move = None
+        self.passed = False
+        self.game_over = False
+        self.black_score = 0
+        self.white_score = komi
+        self.komi = komi
+        self.move_history = {}
+        self.move_count = 0
+        self.consecutive_passes = 0
+        self.stones_hash = 0  # Zobrist hash of the stones on the board
+        self.previous_stones_hash = None  # For Ko rule checking: the stones before the opponent's last move
+        self.territory = {'B': 0, 'W': 0}
+        self.resigned = False
+        self.winner = None
+        self.tree_root = GameTreeNode()
+        self.current_node = self.tree_root
+
+    @property
+    def player_color(self):
+        return self._player_color
+
+    @property
+    def ai_color(self):
+        return self._ai_color
+
+    @property
+    def current_player(self):
+        return self._current_player
+
+    @property
+    def position_hash(self):
+        """Zobrist hash of the stones and the player to move"""
+        return self.stones_hash ^ ZOBRIST_WHITE_TO_PLAY if self._current_player == 'W' else self.stones_hash
+
+    def switch_player(self):
+        self._current_player = 'W' if self.current_player == 'B' else 'B'
+
+    @property
+    def is_player_turn(self):
+        return self.current_player == self.player_color
+
+    def start_turn(self):
+        """Prepare for the start of a new turn."""
+        pass
+
+    def end_turn(self):
+        """End the current turn and switch to the next player."""
+        self._current_player = 'W' if self._current_player == 'B' else 'B'
+        logger.debug(f"Ending turn. Next player: {self.current_player} (Player's turn: {self.is_player_turn})")
+
+    def place_stone(self, x, y):
+        if self.board[y][x] is None and not self.is_ko_violation(x, y):
+            # Check if the move is legal (has liberties or captures opponent stones)
+            if self.is_legal_move(x, y):
+                enemy_color = 'W' if self.current_player == 'B' else 'B'
+                self.board[y][x] = self.current_player
+                captured_stones = self.check_captures(x, y, enemy_color, dryrun=True)
+                self.board[y][x] = None
+                delta = self._delta((x, y), captured_stones)
+                self._apply(delta)
+                self._push(delta)
+                logger.debug(f"Stone placed at ({x}, {y}) by {delta.player}")
+                return True
+            else:
+                logger.debug(f"Illegal move attempted at ({x}, {y})")
+                return False
+        return False
+
+    def _delta(self, point, captured, ends_game=False, resigns=False):
+        return MoveDelta(player=self.current_player, point=point, captured=list(captured),
+                         black_score=self.black_score, white_score=self.white_score, stones_hash=self.stones_hash,
+                         previous_stones_hash=self.previous_stones_hash,
+                         passed=self.passed, consecutive_passes=self.consecutive_passes, last_move=self.last_move,
+                         ai_last_move=self.ai_last_move, resigned=self.resigned, winner=self.winner,
+                         ends_game=ends_game, resigns=resigns)
+
+    def _apply(self, delta):
+        """Play a move from its delta, which is computed from this position"""
+        if delta.resigns:
+            self.game_over = True
+            self.resigned = True
+            self.winner = 'W' if delta.player == 'B' else 'B'
+            return
+        if delta.ends_game:
+            self.game_over = True
+            return
+        if delta.point is None:
+            self.passed = True
+            self.consecutive_passes += 1
+            self.previous_stones_hash = None  # a pass lifts the Ko
+            self.record_move(None, None)  # Record a pass
+            self.end_turn()
+            return
+
+        x, y = delta.point
+        enemy_color = 'W' if delta.player == 'B' else 'B'
+        self.previous_stones_hash = self.stones_hash
+        self.board[y][x] = delta.player
+        self.stones_hash ^= ZOBRIST_STONES[x, y, delta.player]
+        self.last_move = (x, y)
+        if delta.player == self.ai_color:
+            self.ai_last_move = (x, y)
+        self.passed = False
+        self.consecutive_passes = 0
+        for cx, cy in delta.captured:
+            self.board[cy][cx] = None
+            self.stones_hash ^= ZOBRIST_STONES[cx, cy, enemy_color]
+        self.update_score(len(delta.captured))
+        self.record_move(x, y)
+        self.end_turn()
+
+    def _revert(self, delta):
+        if not (delta.ends_game or delta.resigns):
+            self._current_player = delta.player
+            if delta.player == "B":
+                del self.move_history[self.move_count]
+                self.move_count -= 1
+            else:
+                del self.move_history[self.move_count]["white"]
+        if delta.point is not None:
+            x, y = delta.point
+            enemy_color = 'W' if delta.player == 'B' else 'B'
+            self.board[y][x] = None
+            for cx, cy in delta.captured:
+                self.board[cy][cx] = enemy_color
+        self.game_over = False
+        self.resigned = delta.resigned
+        self.winner = delta.winner
+        self.black_score = delta.black_score  # also undoes a calculate_score() since the move
+        self.white_score = delta.white_score
+        self.stones_hash = delta.stones_hash
+        self.previous_stones_hash = delta.previous_stones_hash
+        self.passed = delta.passed
+        self.consecutive_passes = delta.consecutive_passes
+        self.last_move = delta.last_move
+        self.ai_last_move = delta.ai_last_move
+
+    def _push(self, delta):
+        """Move down the variation tree, to the existing variation if this move was already played here"""
+        for child in self.current_node.children:
+            if ((child.delta.player, child.delta.point, child.delta.ends_game, child.delta.resigns)
+                    == (delta.player, delta.point, delta.ends_game, delta.resigns)):
+                break
+        else:
+            child = GameTreeNode(delta=delta, parent=self.current_node, ply=self.current_node.ply + 1)
+            self.current_node.children.append(child)
+        self.current_node.selected = child
+        self.current_node = child
+
+    @property
+    def ply(self):
+        return self.current_node.ply
+
+    def undo(self, forget=False):
+        """
+        Take back the last move, keeping it as a variation to redo unless `forget`.
+        Costs the stones the move changed, not a board copy. Returns False at the start of the game.
+        """
+        node = self.current_node
+        if node.parent is None:
+            return False
+        self._revert(node.delta)
+        self.current_node = node.parent
+        if forget:
+            node.parent.children.remove(node)
+            if node.parent.selected is node:
+                node.parent.selected = None
+        return True
+
+    def redo(self, variation=None):
+        """
+        Replay a move taken back: the variation at index `variation` of the current position, by default the one
+        last played. Returns False if there is none.
+        """
+        node = self.current_node
+        if variation is not None:
+            child = node.children[variation]
+        else:
+            child = node.selected or (node.children[-1] if node.children else None)
+        if child is None:
+            return False
+        self._apply(child.delta)
+        node.selected = child
+        self.current_node = child
+        return True
+
+    def goto(self, target):
+        """Jump to any position of the variation tree, through the closest common ancestor"""
+        path = []
+        node = target
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        if path[-1] is not self.tree_root:
+            raise ValueError("The target position is not in the variation tree of this game")
+        ancestors = set(map(id, path))
+        while id(self.current_node) not in ancestors:
+            self.undo()
+        for node in reversed(path[:path.index(next(n for n in path if n is self.current_node))]):
+            self._apply(node.delta)
+            node.parent.selected = node
+            self.current_node = node
+
+    def goto_ply(self, ply):
+        """Jump to a ply of the current line, undoing or redoing the selected variations"""
+        while self.ply > ply and self.undo():
+            pass
+        while self.ply < ply and self.redo():
+            pass
+        return self.ply == ply
+
+    def copy(self):
+        """The same position, with the move history but without the variation tree"""
+        game = copy.copy(self)
+        game.board = [row[:] for row in self.board]
+        game.move_history = {k: dict(v) for k, v in self.move_history.items()}
+        game.territory = dict(self.territory)
+        game.tree_root = GameTreeNode(ply=self.ply)
+        game.current_node = game.tree_root
+        return game
+
+    def is_legal_move(self, x, y):
+        # Temporarily place the stone
+        self.board[y][x] = self.current_player
+
+        # Check if the move captures any opponent stones
+        enemy_color = 'W' if self.current_player == 'B' else 'B'
+        captures = self.check_captures(x, y, enemy_color, dryrun=True)
+
+        # Check if the placed stone has liberties
+        has_liberties = self.has_liberties([(x, y)])
+
+        # Remove the temporary stone
+        self.board[y][x] = None
+
+        # The move is legal if it either captures stones or has liberties
+        return len(captures) > 0 or has_liberties
+
+    def check_captures(self, x, y, color_to_capture, dryrun=False):
+        captured_stones = []
+        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+                # A group touching the new stone on several sides is only captured once
+                if self.board[ny][nx] == color_to_capture and (nx, ny) not in captured_stones:
+                    group = self.find_group(nx, ny)
+                    if not self.has_liberties(group):
+                        captured_stones.extend(group)
+
+        if dryrun:
+            return captured_stones
+
+        # Remove captured stones from the board
+        for cx, cy in captured_stones:
+            self.board[cy][cx] = None
+
+        return captured_stones
+
+    def is_ko_violation(self, x, y):
+        if self.previous_stones_hash is None:
+            return False
+
+        # Hash of the stones after the new move and its captures
+        self.board[y][x] = self.current_player
+        enemy_color = 'W' if self.current_player == 'B' else 'B'
+        captures = self.check_captures(x, y, enemy_color, dryrun=True)
+        self.board[y][x] = None
+        stones_hash = self.stones_hash ^ ZOBRIST_STONES[x, y, self.current_player]
+        for cx, cy in captures:
+            stones_hash ^= ZOBRIST_STONES[cx, cy, enemy_color]
+
+        # The move may not recreate the position before the opponent's last move
+        return stones_hash == self.previous_stones_hash
+
+    def is_valid_move(self, x, y):
+        """Whether the current player may play at (x, y)"""
+        return self.board[y][x] is None and not self.is_ko_violation(x, y) and self.is_legal_move(x, y)
+
+    def legal_moves(self):
+        """All points where the current player may play, as (x, y)"""
+        return [(x, y) for y in range(BOARD_SIZE) for x in range(BOARD_SIZE) if self.is_valid_move(x, y)]
+
+    def would_capture(self, x, y, board):
+        captured = []
+        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+                if board[ny][nx] == ('W' if self.current_player == 'B' else 'B'):
+                    group = self.find_group(nx, ny, board)
+                    if not self.has_liberties(group, board):
+                        captured.extend(group)
+        return captured
+
+    def find_group(self, x, y):
+        color = self.board[y][x]
+        group = set()
+        stack = [(x, y)]
+        while stack:
+            cx, cy = stack.pop()
+            if (cx, cy) not in group:
+                group.add((cx, cy))
+                for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+                    nx, ny = cx + dx, cy + dy
+                    if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE and self.board[ny][nx] == color:
+                        stack.append((nx, ny))
+        return group
+
+    def pass_turn(self):
+        if self.passed:
+            logger.info("Both players have passed. Ending game.")
+        delta = self._delta(None, [], ends_game=self.passed)
+        self._apply(delta)
+        self._push(delta)
+
+    def resign(self):
+        delta = self._delta(None, [], resigns=True)
+        self._apply(delta)
+        self._push(delta)
+        logger.info(f"Player {self.current_player} has resigned. {self.winner} wins.")
+
+    def can_make_move(self):
+        """Check if the current player can make any legal move."""
+        for y in range(BOARD_SIZE):
+            for x in range(BOARD_SIZE):
+                if self.board[y][x] is None and not self.is_ko_violation(x, y):
+                    if self.is_legal_move(x, y):
+                        return True
+        return False
+
+    def remove_captured_stones(self, x, y):
+        captured = []
+        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+                if self.board[ny][nx] == ('W' if self.current_player == 'B' else 'B'):
+                    group = self.find_group(nx, ny, self.board)
+                    if not self.has_liberties(group, self.board):
+                        captured.extend(group)
+                        for cx, cy in group:
+                            self.board[cy][cx] = None
+        return len(captured)
+
+    def has_liberties(self, group):
+        for x, y in group:
+            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+                    if self.board[ny][nx] is None:
+                        return True
+        return False
+
+    def update_score(self, captured_stones):
+        if self.current_player == 'B':
+            self.black_score += captured_stones
+        else:
+            self.white_score += captured_stones
+
+    def get_score(self):
+        return self.black_score, self.white_score
+
+    def record_move(self, x, y):
+        if self.current_player == "B":
+            self.move_count += 1
+        if x is None and y is None:
+            move = "PASS"
+        else:
+            col = chr(x + 65)  # Convert to letter (A-T, skipping I)
+            if col >= "I":
+                col = chr(ord(col) + 1)
+            row = str(BOARD_SIZE - y)
+            move = col + row
+
+        if self.current_player == "B":
+            self.move_history[self.move_count] = {"black": move}
+        else:
+            self.move_history[self.move_count]["white"] = move
+
+    def get_move_history(self):
+        if not self.move_history:
+            return {1: {"black": None, "white": None}}
+        return self.move_history
+
+    def play(self, move):
+        """Play a move in GTP format for the current player; None or PASS passes"""
+        if move is None or move.upper() == "PASS":
+            self.pass_turn()
+            return True
+        x = GTP_COLUMNS.index(move[0].upper())
+        y = BOARD_SIZE - int(move[1:])
+        return self.place_stone(x, y)
+
+    @classmethod
+    def from_move_history(cls, move_history, player_color="B", komi=7.5):
+        """Replay a move history, as returned by get_move_history() or kept by the simulation"""
+        game = cls(player_color, komi)
+        for i in sorted(move_history):
+            for color in ("black", "white"):
+                if color not in move_history[i]:
+                    continue
+                if i == 1 and color == "black" and move_history[i][color] is None and not move_history[i].get("white"):
+                    break  # placeholder of an empty history
+                if not game.play(move_history[i][color]):
+                    raise ValueError(f"Illegal move in history: {i}. {color} {move_history[i][color]}")
+        return game
+
+    def calculate_score(self):
+        if self.resigned:
+            # In case of resignation, the winner gets all points on the board plus komi
+            if self.winner == 'B':
+                self.black_score = BOARD_SIZE * BOARD_SIZE
+                self.white_score = self.komi
+            else:
+                self.black_score = 0
+                self.white_score = BOARD_SIZE * BOARD_SIZE + self.komi
+        else:
+            self.territory = {'B': 0, 'W': 0}
+            visited = set()
+            seki_points = set()
+
+            for y in range(BOARD_SIZE):
+                for x in range(BOARD_SIZE):
+                    if (x, y) not in visited and self.board[y][x] is None:
+                        territory, borders, is_seki = self.find_territory(x, y)
+                        visited.update(territory)
+                        if is_seki:
+                            seki_points.update(territory)
+                        elif len(set(borders)) == 1:  # Territory is surrounded by one color
+                            self.territory[borders[0]] += len(territory)
+
+            # Count stones on the board
+            black_stones = sum(row.count('B') for row in self.board)
+            white_stones = sum(row.count('W') for row in self.board)
+
+            # Calculate final scores
+            self.black_score = self.territory['B'] + black_stones
+            self.white_score = self.territory['W'] + white_stones + self.komi
+
+            logger.info(f"Final Score - Black: {self.black_score}, White: {self.white_score}")
+            if not self.resigned:
+                logger.info(f"Territory - Black: {self.territory['B']}, White: {self.territory['W']}")
+                logger.info(f"Stones - Black: {black_stones}, White: {white_stones}")
+                logger.info(f"Seki points: {len(seki_points)}")
+
+    def find_territory(self, x, y):
+        color = self.board[y][x]
+        territory = set()
+        borders = []
+        stack = [(x, y)]
+        adjacent_colors = set()
+
+        while stack:
+            cx, cy = stack.pop()
+            if (cx, cy) in territory:
+                continue
+            territory.add((cx, cy))
+
+            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+                    if self.board[ny][nx] is None and (nx, ny) not in territory:
+                        stack.append((nx, ny))
+                    elif self.board[ny][nx] is not None:
+                        borders.append(self.board[ny][nx])
+                        adjacent_colors.add(self.board[ny][nx])
+
+        is_seki = self.check_seki(territory, adjacent_colors)
+        return territory, borders, is_seki
+
+    def check_seki(self, territory, adjacent_colors):
+        if len(adjacent_colors) != 2:
+            return False
+
+        # Check if both colors have few liberties
+        for color in adjacent_colors:
+            if self.count_liberties(territory, color) > 1:
+                return False
+
+        return True
+
+    def count_liberties(self, territory, color):
+        liberties = set()
+        for x, y in territory:
+            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE:
+                    if self.board[ny][nx] is None and (nx, ny) not in territory:
+                        liberties.add((nx, ny))
+        return len(liberties)
+
+    def end_game(self):
+        self.game_over = True
+        self.calculate_score()
+        if not self.resigned:
+            self.winner = "B" if self.black_score > self.white_score else "W"
+        logger.info(f"Game Over! {self.winner} wins!")
+        logger.info(f"Final Score - Black: {self.black_score}, White: {self.white_score}")
@@ -0,0 +1,330 @@
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+import math
+import time
+import numpy as np
+from goformer.goformer import GoFormer, alphabets_wo_I
+from goformer.rules import GoGame, BOARD_SIZE
+
+
+PASS_INDEX = BOARD_SIZE * BOARD_SIZE
+N_MOVES = PASS_INDEX + 1
+
+
+def index_to_gtp(index: int) -> str:
+    if index == PASS_INDEX:
+        return "PASS"
+    y, x = divmod(int(index), BOARD_SIZE)
+    return f"{alphabets_wo_I[x]}{BOARD_SIZE - y}"
+
+
+def gtp_to_index(move: str) -> int:
+    if move.upper() == "PASS":
+        return PASS_INDEX
+    return (BOARD_SIZE - int(move[1:])) * BOARD_SIZE + alphabets_wo_I.index(move[0].upper())
+
+
+def area_score_value(game: GoGame) -> float:
+    """
+    Value in [-1, 1] of a position for the player to move, from its area score.
+    GoFormer has no value head, so this is the default leaf evaluation; it is crude until the territory is settled.
+    """
+    game.calculate_score()
+    value = math.tanh((game.black_score - game.white_score) / 10)
+    return value if game.current_player == 'B' else -value
+
+
+def terminal_value(game: GoGame) -> float:
+    """Value of a finished game for the player to move: 1 for a win, -1 for a loss"""
+    game.calculate_score()
+    black_wins = game.black_score > game.white_score
+    return 1.0 if black_wins == (game.current_player == 'B') else -1.0
+
+
+class SearchTree:
+    """Search nodes in flat arrays. The children of a node are stored contiguously, node 0 is the root."""
+    def __init__(self, capacity: int = 4096):
+        self.move = np.full(capacity, -1, dtype=np.int16)
+        self.prior = np.zeros(capacity, dtype=np.float32)
+        self.visits = np.zeros(capacity, dtype=np.int32)
+        self.value_sum = np.zeros(capacity, dtype=np.float32)  # from the view of the player who made the move
+        self.virtual_loss = np.zeros(capacity, dtype=np.int32)
+        self.first_child = np.full(capacity, -1, dtype=np.int32)
+        self.n_children = np.zeros(capacity, dtype=np.int16)
+        self.size = 1
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, n: int):
+        capacity = len(self.move)
+        if self.size + n <= capacity:
+            return
+        new_capacity = max(capacity * 2, self.size + n)
+        for name, fill in [("move", -1), ("prior", 0), ("visits", 0), ("value_sum", 0), ("virtual_loss", 0),
+                           ("first_child", -1), ("n_children", 0)]:
+            array = getattr(self, name)
+            grown = np.full(new_capacity, fill, dtype=array.dtype)
+            grown[:capacity] = array
+            setattr(self, name, grown)
+
+    def is_expanded(self, node: int) -> bool:
+        return self.n_children[node] > 0
+
+    def children(self, node: int) -> range:
+        return range(self.first_child[node], self.first_child[node] + self.n_children[node])
+
+    def expand(self, node: int, moves: np.ndarray, priors: np.ndarray):
+        self._reserve(len(moves))
+        start = self.size
+        self.move[start:start + len(moves)] = moves
+        self.prior[start:start + len(moves)] = priors
+        self.first_child[node] = start
+        self.n_children[node] = len(moves)
+        self.size += len(moves)
+
+
+@dataclass
+class SearchResult:
+    move: str
+    visits: Dict[str, int]
+    simulations: int
+    seconds: float
+    evaluations: int = 0
+    transposition_hits: int = 0
+    batches: int = 0
+    tree_size: int = 0
+
+    @property
+    def nodes_per_second(self) -> float:
+        return self.simulations / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        top = ", ".join(f"{m}: {n}" for m, n in sorted(self.visits.items(), key=lambda x: -x[1])[:5])
+        return (f"{self.move} after {self.simulations} simulations in {self.seconds:.2f}s "
+                f"({self.nodes_per_second:.1f} nodes/s, {self.evaluations} evaluations in {self.batches} batches, "
+                f"{self.transposition_hits} transposition hits, {self.tree_size} nodes) - visits {top}")
+
+
+@dataclass
+class _Leaf:
+    """What the evaluation needs from the position of a leaf, read before the selection undoes its moves"""
+    node: int
+    path: List[int]
+    key: Tuple[int, Optional[int]]
+    game_over: bool
+    value: Optional[float] = None  # None when the position is in the transposition table
+    legal_moves: Optional[np.ndarray] = None
+    rounds: Optional[list] = None
+    color: Optional[str] = None
+
+
+class PUCTSearch:
+    """
+    Optional lookahead on top of GoFormer.
+    A PUCT search that takes its priors from GoFormer's exact move distribution and its legality from GoGame.
+    Leaves are collected with virtual loss and evaluated in batched forward passes; a transposition table keyed by
+    the position hash and the ko state avoids evaluating a position twice, within a search and across searches.
+    GoFormer's priors depend on the moves that led to a position: a transposition reuses the priors of the first
+    move order evaluated, while the legal moves are always those of the leaf.
+    """
+    def __init__(self,
+                 agent: GoFormer,
+                 max_nodes: Optional[int] = 200,
+                 max_time: Optional[float] = None,
+                 batch_size: int = 8,
+                 c_puct: float = 1.5,
+                 fpu_reduction: float = 0.2,
+                 value_fn: Callable[[GoGame], float] = area_score_value,
+                 max_table_size: int = 100_000):
+        """
+        :param agent: the GoFormer providing the priors
+        :param max_nodes: simulations per search, None for no limit
+        :param max_time: seconds per search, None for no limit
+        :param batch_size: leaves evaluated per forward pass
+        :param c_puct: exploration constant
+        :param fpu_reduction: unvisited moves are valued at the parent's value minus this
+        :param value_fn: value in [-1, 1] of a position for the player to move
+        :param max_table_size: entries kept in the transposition table, the least recently used are evicted
+        """
+        assert max_nodes is not None or max_time is not None, "A node or time budget is required"
+        self._agent = agent
+        self.max_nodes = max_nodes
+        self.max_time = max_time
+        self._batch_size = batch_size
+        self._c_puct = c_puct
+        self._fpu_reduction = fpu_reduction
+        self._value_fn = value_fn
+        self._max_table_size = max_table_size
+        # (position hash, ko state) -> (prior of every move index, value for the player to move),
+        # least recently used first
+        self._table: Dict[Tuple[int, Optional[int]], Tuple[np.ndarray, float]] = OrderedDict()
+
+    def search(self, game: GoGame, max_nodes: Optional[int] = None, max_time: Optional[float] = None) -> SearchResult:
+        """Search from the position of `game`, which is left untouched"""
+        max_nodes = max_nodes or self.max_nodes
+        max_time = max_time or self.max_time
+        rules_logger = logging.getLogger("goformer.rules")
+        rules_level = rules_logger.level
+        rules_logger.setLevel(logging.WARNING)  # the rules log every move at DEBUG
+        try:
+            return self._search(game, max_nodes, max_time)
+        finally:
+            rules_logger.setLevel(rules_level)
+
+    def _search(self, game: GoGame, max_nodes: Optional[int], max_time: Optional[float]) -> SearchResult:
+        start_time = time.time()
+        tree = SearchTree()
+        result = SearchResult(move="PASS", visits={}, simulations=0, seconds=0.0)
+        if game.game_over:
+            return result  # nothing to search, and no legal moves to expand the root with
+        game = game.copy()  # moves are played and undone on this copy
+        tree.virtual_loss[0] += 1
+        self._evaluate(tree, [self._leaf(game, 0, [0])], result)
+
+        while ((max_nodes is None or result.simulations < max_nodes)
+               and (max_time is None or time.time() - start_time < max_time)):
+            leaves = []
+            pending = set()
+            for _ in range(self._batch_size):
+                leaf = self._select(tree, game)
+                if leaf.game_over:
+                    self._backup(tree, leaf.path, leaf.value)
+                    result.simulations += 1
+                    continue
+                if leaf.node in pending:
+                    break  # the tree is saturated with virtual loss, evaluate what we have
+                pending.add(leaf.node)
+                tree.virtual_loss[leaf.path] += 1
+                leaves.append(leaf)
+            if leaves:
+                self._evaluate(tree, leaves, result)
+                result.simulations += len(leaves)
+
+        children = tree.children(0)
+        result.visits = {index_to_gtp(tree.move[c]): int(tree.visits[c]) for c in children if tree.visits[c] > 0}
+        best_child = max(children, key=lambda c: (tree.visits[c], tree.prior[c]))
+        result.move = index_to_gtp(tree.move[best_child])
+        result.seconds = time.time() - start_time
+        result.tree_size = len(tree)
+        logging.debug(f"Search: {result}")
+        return result
+
+    def _select(self, tree: SearchTree, game: GoGame) -> _Leaf:
+        """Walk down the tree playing the moves on `game`, then undo them: a leaf costs no board copy"""
+        node = 0
+        path = [0]
+        while tree.is_expanded(node) and not game.game_over:
+            node = self._select_child(tree, node)
+            path.append(node)
+            self._play(game, int(tree.move[node]))
+        leaf = self._leaf(game, node, path)
+        for _ in range(len(path) - 1):
+            game.undo(forget=True)
+        return leaf
+
+    def _leaf(self, game: GoGame, node: int, path: List[int]) -> _Leaf:
+        # the stones before the opponent's last move decide the Ko, None after a pass
+        key = (game.position_hash, game.previous_stones_hash)
+        if game.game_over:
+            return _Leaf(node, path, key, True, terminal_value(game))
+        leaf = _Leaf(node, path, key, False)
+        leaf.legal_moves = np.array([y * BOARD_SIZE + x for x, y in game.legal_moves()] + [PASS_INDEX],
+                                    dtype=np.int16)
+        if key not in self._table:
+            leaf.color = game.current_player.lower()
+            leaf.rounds = self._agent.history_to_model_rounds(game.get_move_history(), leaf.color)
+            leaf.value = self._value_fn(game)
+        return leaf
+
+    def _select_child(self, tree: SearchTree, node: int) -> int:
+        start, end = tree.first_child[node], tree.first_child[node] + tree.n_children[node]
+        visits = tree.visits[start:end] + tree.virtual_loss[start:end]
+        # The parent's value, from the view of the player choosing among the children
+        parent_q = -tree.value_sum[node] / max(tree.visits[node], 1)
+        # virtual loss counts as a lost visit
+        q = np.where(visits > 0,
+                     (tree.value_sum[start:end] - tree.virtual_loss[start:end]) / np.maximum(visits, 1),
+                     parent_q - self._fpu_reduction)
+        parent_visits = tree.visits[node] + tree.virtual_loss[node]
+        u = self._c_puct * tree.prior[start:end] * math.sqrt(parent_visits + 1) / (1 + visits)
+        return start + int(np.argmax(q + u))
+
+    @staticmethod
+    def _play(game: GoGame, index: int):
+        if index == PASS_INDEX:
+            game.pass_turn()  # ends the game after a pass
+        else:
+            y, x = divmod(index, BOARD_SIZE)
+            game.place_stone(x, y)
+
+    def _evaluate(self, tree: SearchTree, leaves: List[_Leaf], result: SearchResult):
+        # Evaluate the positions missing from the transposition table in one batch
+        to_evaluate = {}
+        for leaf in leaves:
+            if leaf.key in self._table:
+                result.transposition_hits += 1
+                self._table.move_to_end(leaf.key)
+            elif leaf.key not in to_evaluate:
+                to_evaluate[leaf.key] = leaf
+        if to_evaluate:
+            batch = list(to_evaluate.values())
+            distributions = self._agent.move_distribution_batch(
+                [leaf.rounds for leaf in batch],
+                [leaf.color for leaf in batch],
+                [[index_to_gtp(m) for m in leaf.legal_moves] for leaf in batch],
+            )
+            for leaf, distribution in zip(batch, distributions):
+                priors = np.zeros(N_MOVES, dtype=np.float32)
+                priors[leaf.legal_moves] = [distribution[index_to_gtp(m)] for m in leaf.legal_moves]
+                self._table[leaf.key] = (priors, leaf.value)
+            result.evaluations += len(batch)
+            result.batches += 1
+
+        for leaf in leaves:
+            priors, value = self._table[leaf.key]
+            moves = leaf.legal_moves
+            if not tree.is_expanded(leaf.node):
+                move_priors = priors[moves]
+                total = move_priors.sum()
+                move_priors = move_priors / total if total > 0 else np.full(len(moves), 1 / len(moves))
+                tree.expand(leaf.node, moves, move_priors)
+            tree.virtual_loss[leaf.path] -= 1
+            self._backup(tree, leaf.path, value)
+        while len(self._table) > self._max_table_size:
+            self._table.popitem(last=False)
+
+    @staticmethod
+    def _backup(tree: SearchTree, path: List[int], value: float):
+        """`value` is for the player to move at the end of the path"""
+        for node in reversed(path):
+            value = -value  # the move into this node was made by the other player
+            tree.visits[node] += 1
+            tree.value_sum[node] += value
+
+    def make_move(self, game: GoGame, n_suggestion: Optional[int] = None) -> Union[str, Tuple[int, int]]:
+        """Output format compatible with game.py, n_suggestion is ignored"""
+        result = self.search(game)
+        logging.info(f"GoFormer search: {result}")
+        return GoFormer.to_game_move(result.move)
+
+    def predict_next_move_with_leela(self, leela_move_history: Dict[int, dict], n_suggestion: Optional[int] = None,
+                                     color: Optional[str] = None) -> str:
+        """
+        Output format compatible with GTP protocol, mainly used for simulation.
+        Same signature as GoFormer's: the search plays the player to move, and n_suggestion and color are ignored.
+        """
+        result = self.search(GoGame.from_move_history(leela_move_history))
+        logging.info(f"GoFormer search: {result}")
+        return result.move
+
+
+if __name__ == '__main__':
+    agent = GoFormer("kenhktsui/goformer-v0.1", 'b')
+    searcher = PUCTSearch(agent, max_nodes=400, batch_size=16)
+    game = GoGame("W", 7.5)
+    for move in ["D16", "Q4", "Q16", "D4"]:
+        game.play(move)
+    print(searcher.search(game))
@@ -0,0 +1,286 @@
+from typing import Dict, List, Optional
+import argparse
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+from goformer.goformer import GoFormer
+from goformer.rules import GoGame
+from goformer.threads import load_thread_config, set_threads
+
+
+CHECKPOINT_FILE = "checkpoint.json"
+OPEN_SHARD_FILE = "shard-{index:05d}.open"  # JSONL games of the shard being filled, with their tokens
+
+_worker_agent: Optional[GoFormer] = None
+_worker_config: Dict = {}
+
+
+def _init_worker(artifact_dir: str, threads_per_worker: int, config: Dict):
+    global _worker_agent, _worker_config
+    set_threads(threads_per_worker)
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    _worker_agent = GoFormer(artifact_dir, 'b')
+    _worker_config = config
+
+
+def sample_move(distribution: Dict[str, float], temperature: float, rng: np.random.Generator) -> str:
+    moves = list(distribution)
+    probs = np.array([distribution[m] for m in moves], dtype=np.float64)
+    if temperature <= 0:
+        return moves[int(np.argmax(probs))]
+    logits = np.log(np.maximum(probs, 1e-12)) / temperature
+    probs = np.exp(logits - logits.max())
+    return moves[rng.choice(len(moves), p=probs / probs.sum())]
+
+
+def play_games(game_ids: List[int]) -> List[dict]:
+    """Play one game per id concurrently in this worker, batching the positions of all unfinished games"""
+    agent = _worker_agent
+    config = _worker_config
+    games = {i: GoGame("B", config["komi"]) for i in game_ids}
+    moves = {i: [] for i in game_ids}
+    rngs = {i: np.random.default_rng([config["seed"], i]) for i in game_ids}
+    active = list(game_ids)
+
+    while active:
+        colors = [games[i].current_player.lower() for i in active]
+        legal_moves = [[GoFormer.to_gtp_move(x, y) for x, y in games[i].legal_moves()] + ["PASS"] for i in active]
+        distributions = agent.move_distribution_batch(
+            [agent.history_to_model_rounds(games[i].get_move_history(), c) for i, c in zip(active, colors)],
+            colors,
+            legal_moves,
+        )
+        still_active = []
+        for i, distribution in zip(active, distributions):
+            game = games[i]
+            temperature = config["temperature"] if len(moves[i]) < config["temperature_moves"] else 0.0
+            move = sample_move(distribution, temperature, rngs[i])
+            game.play(move)
+            moves[i].append(move)
+            if not game.game_over and len(moves[i]) < config["max_moves"]:
+                still_active.append(i)
+        active = still_active
+
+    records = []
+    for i in game_ids:
+        game = games[i]
+        game.calculate_score()
+        margin = game.black_score - game.white_score
+        winner = "b" if margin > 0 else "w"
+        rounds = agent.history_to_rounds(game.get_move_history())
+        if rounds[-1].white_move is None:
+            rounds[-1].white_move = "PASS"  # close the last round, an open round is a prompt
+        records.append({
+            "game_id": i,
+            "moves": moves[i],
+            "komi": game.komi,
+            "black_score": game.black_score,
+            "white_score": game.white_score,
+            "result": f"{winner.upper()}+{abs(margin)}",
+            "winner": winner,
+            # the game as model input, from the winner's side
+            "tokens": agent.tokenize(rounds, winner),
+        })
+    return records
+
+
+class ShardWriter:
+    """
+    Writes games to rotating compressed shards: gzip JSONL (`jsonl`) or numpy token shards (`tokens`).
+    The games of the shard being filled are appended to shard-<n>.open and recorded in the checkpoint after
+    every chunk, so an interrupted run only plays its last chunk again. A full shard is written under a temporary name
+    and renamed, the games left over go to the open file of the next shard, and both are recorded in one checkpoint.
+    """
+    def __init__(self, output_dir: str, shard_size: int, output_format: str = "jsonl"):
+        assert output_format in ("jsonl", "tokens"), f"Invalid output format: {output_format}"
+        self._output_dir = output_dir
+        self._shard_size = shard_size
+        self._format = output_format
+        os.makedirs(output_dir, exist_ok=True)
+        self.checkpoint = self._load_checkpoint()
+        self._buffer: List[dict] = []
+        path = self._open_shard_path()
+        for name in os.listdir(output_dir):
+            if name.endswith(".tmp") or (name.endswith(".open") and name != os.path.basename(path)):
+                os.remove(os.path.join(output_dir, name))  # incomplete shard of an interrupted run
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                # games appended after the last checkpoint are played again
+                f.truncate(self.checkpoint.get("open_shard_bytes", 0))
+            with open(path) as f:
+                self._buffer = [json.loads(line) for line in f]
+
+    @property
+    def completed_game_ids(self) -> set:
+        return set(self.checkpoint["completed_game_ids"])
+
+    def _load_checkpoint(self) -> dict:
+        path = os.path.join(self._output_dir, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {"shards": [], "completed_game_ids": [], "open_shard_bytes": 0}
+
+    def _open_shard_path(self) -> str:
+        return os.path.join(self._output_dir, OPEN_SHARD_FILE.format(index=len(self.checkpoint["shards"])))
+
+    def _save_checkpoint(self):
+        path = os.path.join(self._output_dir, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.checkpoint, f)
+        os.replace(path + ".tmp", path)
+
+    def write(self, records: List[dict]):
+        """Record the games of a completed chunk, and write the shards they fill"""
+        path = self._open_shard_path()
+        with open(path, "a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self._buffer.extend(records)
+        self.checkpoint["completed_game_ids"].extend(r["game_id"] for r in records)
+        self.checkpoint["open_shard_bytes"] = os.path.getsize(path)
+        self._save_checkpoint()
+        if len(self._buffer) >= self._shard_size:
+            while len(self._buffer) >= self._shard_size:
+                self._write_shard(self._buffer[:self._shard_size])
+                self._buffer = self._buffer[self._shard_size:]
+            self._reset_open_shard(path)
+
+    def flush(self):
+        """Write the games of the open shard, even if it is not full"""
+        if not self._buffer:
+            return
+        path = self._open_shard_path()
+        self._write_shard(self._buffer)
+        self._buffer = []
+        self._reset_open_shard(path)
+
+    def _reset_open_shard(self, previous_path: str):
+        """Move the games not written to a shard yet to the open file of the next shard, and checkpoint"""
+        path = self._open_shard_path()
+        self.checkpoint["open_shard_bytes"] = 0
+        if self._buffer:
+            with open(path + ".tmp", "w") as f:
+                f.write("".join(json.dumps(r) + "\n" for r in self._buffer))
+            os.replace(path + ".tmp", path)
+            self.checkpoint["open_shard_bytes"] = os.path.getsize(path)
+        self._save_checkpoint()
+        if os.path.exists(previous_path):
+            os.remove(previous_path)
+
+    def _write_shard(self, records: List[dict]):
+        extension = "jsonl.gz" if self._format == "jsonl" else "npz"
+        name = f"shard-{len(self.checkpoint['shards']):05d}.{extension}"
+        path = os.path.join(self._output_dir, name)
+        if self._format == "jsonl":
+            with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps({k: v for k, v in record.items() if k != "tokens"}) + "\n")
+        else:
+            with open(path + ".tmp", "wb") as f:
+                np.savez_compressed(
+                    f,
+                    tokens=np.concatenate([np.asarray(r["tokens"], dtype=np.uint8) for r in records]),
+                    offsets=np.cumsum([0] + [len(r["tokens"]) for r in records]),
+                    game_ids=np.array([r["game_id"] for r in records]),
+                    winners=np.array([r["winner"] for r in records]),
+                )
+        os.replace(path + ".tmp", path)
+        self.checkpoint["shards"].append(name)
+
+
+def run_selfplay(artifact_dir: str,
+                 n_games: int,
+                 output_dir: str,
+                 workers: int = 1,
+                 games_per_batch: int = 8,
+                 threads_per_worker: int = 1,
+                 temperature: float = 1.0,
+                 temperature_moves: int = 30,
+                 max_moves: int = 400,
+                 komi: float = 7.5,
+                 seed: int = 0,
+                 shard_size: int = 1000,
+                 output_format: str = "jsonl"):
+    """
+    GoFormer plays `n_games` against itself across a pool of `workers` processes. Each worker plays
+    `games_per_batch` games at once, sampling every move from the exact move distribution, so that its games share
+    one batched forward pass per ply. Games already recorded in the checkpoint of `output_dir` are skipped.
+    """
+    writer = ShardWriter(output_dir, shard_size, output_format)
+    completed = writer.completed_game_ids
+    remaining = [i for i in range(n_games) if i not in completed]
+    if completed:
+        logging.info(f"Resuming: {len(completed)} games already generated, {len(remaining)} to go")
+    chunks = [remaining[i:i + games_per_batch] for i in range(0, len(remaining), games_per_batch)]
+    config = {"komi": komi, "seed": seed, "temperature": temperature, "temperature_moves": temperature_moves,
+              "max_moves": max_moves}
+
+    start_time = time.time()
+    n_done = 0
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker,
+                      initargs=(artifact_dir, threads_per_worker, config)) as pool:
+        for records in pool.imap_unordered(play_games, chunks):
+            writer.write(records)
+            n_done += len(records)
+            hours = (time.time() - start_time) / 3600
+            games_per_hour = n_done / hours
+            cores = workers * threads_per_worker
+            logging.info(f"{n_done}/{len(remaining)} games, {games_per_hour:.0f} games/hour, "
+                         f"{games_per_hour / cores:.0f} games/hour/core, "
+                         f"ETA {(len(remaining) - n_done) / games_per_hour * 60:.1f} min")
+    writer.flush()
+    return n_done
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Generate self-play games with GoFormer")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--games", type=int, required=True, help="total number of games, including resumed ones")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="default: from the thread config of goformer.threads, else the number of cores")
+    parser.add_argument("--games-per-batch", type=int, default=None,
+                        help="games played concurrently by a worker (default: from the thread config, else 8)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch intra-op threads per worker (default: from the thread config, else 1)")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--temperature-moves", type=int, default=30,
+                        help="plies sampled with the temperature, the following ones are played greedily")
+    parser.add_argument("--max-moves", type=int, default=400, help="plies after which a game is scored")
+    parser.add_argument("--komi", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard-size", type=int, default=1000, help="games per output shard")
+    parser.add_argument("--format", choices=["jsonl", "tokens"], default="jsonl")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+    thread_config = load_thread_config() or {}
+    if thread_config:
+        logging.info(f"Thread config: {thread_config['workers']} workers x {thread_config['intra_op_threads']} "
+                     f"threads, batch size {thread_config['batch_size']}")
+    args.workers = args.workers or thread_config.get("workers") or os.cpu_count()
+    args.threads_per_worker = args.threads_per_worker or thread_config.get("intra_op_threads") or 1
+    args.games_per_batch = args.games_per_batch or thread_config.get("batch_size") or 8
+    run_selfplay(args.model, args.games, args.output_dir,
+                 workers=args.workers,
+                 games_per_batch=args.games_per_batch,
+                 threads_per_worker=args.threads_per_worker,
+                 temperature=args.temperature,
+                 temperature_moves=args.temperature_moves,
+                 max_moves=args.max_moves,
+                 komi=args.komi,
+                 seed=args.seed,
+                 shard_size=args.shard_size,
+                 output_format=args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import logging
+import threading
+import torch
+from goformer.goformer import GoFormer, Round
+
+
+def past_key_values_nbytes(past_key_values) -> int:
+    return sum(t.element_size() * t.nelement() for layer in past_key_values for t in layer)
+
+
+@dataclass(eq=False)
+class _PrefixNode:
+    tokens: Tuple[int, ...]  # the block of tokens from the parent to this node
+    past_key_values: Optional[tuple]  # KV cache of the block
+    parent: Optional["_PrefixNode"] = None
+    children: Dict[Tuple[int, ...], "_PrefixNode"] = field(default_factory=dict)
+    depth: int = 0  # tokens from the root
+    ref_count: int = 0
+    nbytes: int = 0
+
+
+@dataclass
+class PrefixCacheStats:
+    lookups: int = 0
+    lookup_tokens: int = 0
+    hit_tokens: int = 0
+    inserted_blocks: int = 0
+    evicted_blocks: int = 0
+    blocks: int = 0
+    resident_bytes: int = 0
+
+    @property
+    def prefix_hit_token_ratio(self) -> float:
+        return self.hit_tokens / self.lookup_tokens if self.lookup_tokens else 0.0
+
+    def __str__(self):
+        return (f"prefix hits: {self.prefix_hit_token_ratio:.1%} of {self.lookup_tokens} tokens, blocks: {self.blocks}"
+                f", evicted blocks: {self.evicted_blocks}, resident: {self.resident_bytes / 2 ** 20:.1f} MiB")
+
+
+class PrefixCache:
+    """
+    KV caches of token prefixes shared by every game of a process, in a radix tree of fixed-size token blocks: games
+    with the same opening share the blocks of their common prefix, and a new position only computes the tokens after
+    its longest cached prefix.
+    A node is pinned while referenced (match and insert take a reference, release returns it); beyond the byte budget,
+    the least recently used unpinned leaves are evicted.
+    """
+    def __init__(self, block_size: int = 16, max_bytes: int = 2 ** 30):
+        """
+        :param block_size: tokens per block; a prefix is reused in whole blocks
+        :param max_bytes: budget of the KV caches of all blocks
+        """
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.root = _PrefixNode(tokens=(), past_key_values=None)
+        self._lru: Dict[int, _PrefixNode] = OrderedDict()  # every node but the root, most recently used last
+        self._lock = threading.RLock()
+        self.stats = PrefixCacheStats()
+
+    def match(self, tokens: List[int], max_length: Optional[int] = None) -> Tuple[_PrefixNode, int, Optional[tuple]]:
+        """
+        Longest cached prefix of `tokens`, of at most `max_length` tokens: its deepest node, which is pinned until
+        released, its length and its KV cache (None when empty)
+        """
+        max_length = len(tokens) if max_length is None else min(max_length, len(tokens))
+        with self._lock:
+            node = self.root
+            path = []
+            while node.depth + self.block_size <= max_length:
+                child = node.children.get(tuple(tokens[node.depth:node.depth + self.block_size]))
+                if child is None:
+                    break
+                node = child
+                path.append(node)
+                self._lru.move_to_end(id(node))
+            node.ref_count += 1
+            self.stats.lookups += 1
+            self.stats.lookup_tokens += len(tokens)
+            self.stats.hit_tokens += node.depth
+        if not path:
+            return node, 0, None
+        past_key_values = tuple(
+            tuple(torch.cat([n.past_key_values[layer][i] for n in path], dim=2) for i in range(2))
+            for layer in range(len(path[0].past_key_values)))
+        return node, node.depth, past_key_values
+
+    def insert(self, tokens: List[int], past_key_values, node: Optional[_PrefixNode] = None) -> _PrefixNode:
+        """
+        Cache the whole blocks of `tokens` from their KV cache `past_key_values`, continuing from `node` (the root by
+        default), which must be a prefix of them. Returns the deepest node, pinned until released.
+        Blocks that do not fit in the budget are not cached.
+        """
+        with self._lock:
+            node = node or self.root
+            while node.depth + self.block_size <= len(tokens):
+                start, end = node.depth, node.depth + self.block_size
+                block = tuple(tokens[start:end])
+                child = node.children.get(block)
+                if child is None:
+                    block_past_key_values = tuple(tuple(t[:, :, start:end].clone() for t in layer)
+                                                  for layer in past_key_values)
+                    nbytes = past_key_values_nbytes(block_past_key_values)
+                    node.ref_count += 1  # the node may become a leaf to evict
+                    self._evict(self.max_bytes - nbytes)
+                    node.ref_count -= 1
+                    if self.stats.resident_bytes + nbytes > self.max_bytes:
+                        break
+                    child = _PrefixNode(block, block_past_key_values, parent=node, depth=end, nbytes=nbytes)
+                    node.children[block] = child
+                    self._lru[id(child)] = child
+                    self.stats.inserted_blocks += 1
+                    self.stats.blocks += 1
+                    self.stats.resident_bytes += nbytes
+                else:
+                    self._lru.move_to_end(id(child))
+                node = child
+            node.ref_count += 1
+            return node
+
+    def release(self, node: _PrefixNode):
+        with self._lock:
+            node.ref_count -= 1
+            assert node.ref_count >= 0, "Released a prefix node more often than it was referenced"
+
+    def evict(self, max_bytes: Optional[int] = None):
+        """Evict the least recently used unpinned leaves until the blocks fit in `max_bytes` (default: the budget)"""
+        with self._lock:
+            self._evict(self.max_bytes if max_bytes is None else max_bytes)
+
+    def _evict(self, max_bytes: int):
+        while self.stats.resident_bytes > max_bytes:
+            victim = next((n for n in self._lru.values() if not n.children and n.ref_count == 0), None)
+            if victim is None:
+                return  # every block is pinned
+            del self._lru[id(victim)]
+            del victim.parent.children[victim.tokens]
+            self.stats.evicted_blocks += 1
+            self.stats.blocks -= 1
+            self.stats.resident_bytes -= victim.nbytes
+
+
+@dataclass
+class Session:
+    tokens: List[int]
+    past_key_values: Optional[tuple]
+    nbytes: int
+    prefix_node: Optional[_PrefixNode] = None  # pinned in the shared prefix cache
+
+
+@dataclass
+class SessionStats:
+    requests: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    reused_tokens: int = 0
+    computed_tokens: int = 0
+    resident_bytes: int = 0
+    sessions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.requests if self.requests else 0.0
+
+    @property
+    def reused_token_ratio(self) -> float:
+        total = self.reused_tokens + self.computed_tokens
+        return self.reused_tokens / total if total else 0.0
+
+    def __str__(self):
+        return (f"requests: {self.requests}, hit rate: {self.hit_rate:.1%}, reused tokens: "
+                f"{self.reused_token_ratio:.1%}, evictions: {self.evictions}, sessions: {self.sessions}, "
+                f"resident: {self.resident_bytes / 2 ** 20:.1f} MiB")
+
+
+class SessionManager:
+    """
+    Keeps the KV cache of each game's last model input, keyed by game id, so that the next move of a game only
+    computes the tokens added since.
+    The caches share a global byte budget: the least recently used sessions are evicted beyond it, and an evicted
+    game is recomputed from scratch on its next request.
+    With a shared prefix cache, sessions keep no KV cache of their own: a game pins its prefix in the prefix cache,
+    where games with the same opening share it, and the least recently used sessions are unpinned when the prefix
+    cache is full.
+    """
+    def __init__(self, agent: GoFormer, max_bytes: int = 2 ** 30, prefix_cache: Optional[PrefixCache] = None):
+        """
+        :param agent: the GoFormer evaluating the games
+        :param max_bytes: budget of the KV caches of all sessions, unused with a prefix cache
+        :param prefix_cache: a PrefixCache to share the KV caches of common prefixes, possibly with other managers
+        """
+        self._agent = agent
+        self._max_bytes = max_bytes
+        self.prefix_cache = prefix_cache
+        self._sessions: Dict[Hashable, Session] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = SessionStats()
+
+    def move_distribution(self, game_id: Hashable, memory_of_moves: List[Round], color: Optional[str] = None,
+                          legal_moves: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """Same as GoFormer.move_distribution, reusing the cache of the game's previous request"""
+        with self._lock:
+            session = self._sessions.pop(game_id, None)
+            if session is not None:
+                self.stats.resident_bytes -= session.nbytes
+            if self.prefix_cache is not None:
+                return self._prefix_move_distribution(game_id, session, memory_of_moves, color, legal_moves)
+            distribution, tokens, past_key_values, n_reused = self._agent.move_distribution_cached(
+                memory_of_moves, color, legal_moves,
+                None if session is None else session.tokens,
+                None if session is None else session.past_key_values,
+            )
+            self._count(len(tokens), n_reused)
+
+            session = Session(tokens, past_key_values, past_key_values_nbytes(past_key_values))
+            self._evict(self._max_bytes - session.nbytes)
+            if session.nbytes <= self._max_bytes:
+                self._sessions[game_id] = session  # most recently used last
+                self.stats.resident_bytes += session.nbytes
+            else:
+                self.stats.evictions += 1
+            self.stats.sessions = len(self._sessions)
+            return distribution
+
+    def _prefix_move_distribution(self, game_id: Hashable, session: Optional[Session], memory_of_moves: List[Round],
+                                  color: Optional[str], legal_moves: Optional[Iterable[str]]) -> Dict[str, float]:
+        tokens = self._agent.tokenize(memory_of_moves, color)
+        # at least one token is computed, it predicts the next move
+        node, n_cached, past_key_values = self.prefix_cache.match(tokens, len(tokens) - 1)
+        try:
+            distribution, tokens, past_key_values, n_reused = self._agent.move_distribution_cached(
+                memory_of_moves, color, legal_moves, tokens[:n_cached], past_key_values)
+            new_node = self.prefix_cache.insert(tokens, past_key_values, node)
+        finally:
+            self.prefix_cache.release(node)
+        if session is not None:
+            self.prefix_cache.release(session.prefix_node)
+        block_size = self.prefix_cache.block_size
+        while new_node.depth < len(tokens) // block_size * block_size and self._sessions:
+            # the blocks pinned by other games fill the budget, unpin the least recently used one
+            evicted_id, evicted = self._sessions.popitem(last=False)
+            self.prefix_cache.release(evicted.prefix_node)
+            self.stats.evictions += 1
+            logging.debug(f"Unpinned session {evicted_id}")
+            deeper_node = self.prefix_cache.insert(tokens, past_key_values, new_node)
+            self.prefix_cache.release(new_node)
+            new_node = deeper_node
+        self._count(len(tokens), n_reused)
+        self._sessions[game_id] = Session(tokens, None, 0, prefix_node=new_node)
+        self.stats.sessions = len(self._sessions)
+        return distribution
+
+    def _count(self, n_tokens: int, n_reused: int):
+        self.stats.requests += 1
+        if n_reused:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+        self.stats.reused_tokens += n_reused
+        self.stats.computed_tokens += n_tokens - n_reused
+
+    def _evict(self, max_bytes: int):
+        while self._sessions and self.stats.resident_bytes > max_bytes:
+            game_id, session = self._sessions.popitem(last=False)
+            self.stats.resident_bytes -= session.nbytes
+            self.stats.evictions += 1
+            logging.debug(f"Evicted session {game_id} ({session.nbytes} bytes)")
+
+    def close(self, game_id: Hashable):
+        """Drop the session of a finished game"""
+        with self._lock:
+            session = self._sessions.pop(game_id, None)
+            if session is not None:
+                self.stats.resident_bytes -= session.nbytes
+                if session.prefix_node is not None:
+                    self.prefix_cache.release(session.prefix_node)  # its blocks stay cached for other games
+            self.stats.sessions = len(self._sessions)
+
+    def __contains__(self, game_id: Hashable) -> bool:
+        return game_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import time
+    from goformer.rules import GoGame
+
+    parser = argparse.ArgumentParser(description="Concurrent games served through the session manager")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--games", type=int, default=64, help="concurrent games")
+    parser.add_argument("--moves", type=int, default=60, help="plies per game")
+    parser.add_argument("--max-mib", type=float, default=64, help="KV cache budget in MiB")
+    parser.add_argument("--prefix-cache", action="store_true", help="share the KV caches of common prefixes")
+    parser.add_argument("--block-size", type=int, default=16, help="tokens per block of the prefix cache")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    agent = GoFormer(args.model, 'b')
+    max_bytes = int(args.max_mib * 2 ** 20)
+    prefix_cache = PrefixCache(args.block_size, max_bytes) if args.prefix_cache else None
+    manager = SessionManager(agent, max_bytes, prefix_cache)
+    rng = random.Random(0)
+    games = {i: GoGame("B", 7.5) for i in range(args.games)}
+    start_time = time.time()
+    n_moves = 0
+    for ply in range(args.moves):
+        # games request moves in a random order, as clients of a server would; each side is a session
+        for i in rng.sample(list(games), len(games)):
+            game = games[i]
+            color = game.current_player.lower()
+            legal_moves = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+            distribution = manager.move_distribution(
+                (i, color), agent.history_to_model_rounds(game.get_move_history(), color), color, legal_moves)
+            moves = list(distribution)
+            game.play(rng.choices(moves, weights=[distribution[m] for m in moves])[0])
+            n_moves += 1
+        logging.info(f"ply {ply + 1}: {manager.stats}" + (f", {prefix_cache.stats}" if prefix_cache else ""))
+    print(f"{n_moves / (time.time() - start_time):.1f} moves/s, {manager.stats}"
+          + (f", {prefix_cache.stats}" if prefix_cache else ""))
@@ -1,48 +1,97 @@
+import argparse
+import logging
 import os
+import queue
+import threading
 import time
 import subprocess
 import random
-from goformer.goformer import GoFormer
+from goformer import tracing
+from goformer.rules import GoGame
+# goformer.goformer imports torch and transformers: only the command line loads it, not the arena workers
+
+
+LEELA_ZERO_PATH = "/usr/local/bin/leelaz"
+FAILED_RESPONSE = ["= resign"]
 
 
 class LeelaZeroWrapper:
     def __init__(self,
-                 leela_zero_path,
+                 leela_zero_path=LEELA_ZERO_PATH,
                  weight_path='~/.local/share/leela-zero/best-network',
                  board_size=19,
                  komi=7.5,
-                 time_limit=3):
+                 time_limit=3,
+                 command=None,
+                 timeout=10):
+        """
+        :param command: full command line of the GTP engine, replacing the Leela Zero one, e.g. the stand-in engine
+            of goformer.gtp_engine
+        :param timeout: seconds to wait for a response before the engine is deemed to resign
+        """
+        if command is None:
+            command = [leela_zero_path, '--gtp', '--cpu-only', '--noponder', '-w', weight_path,
+                       '-r', '1', '-t', '1', '-s', '1']
         self.process = subprocess.Popen(
-            [leela_zero_path, '--gtp', '--cpu-only', '--noponder', '-w', weight_path, '-r', '1', '-t', '1', '-s', '1'],
+            command,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,  # an unread stderr pipe blocks a chatty engine once full
             text=True
         )
+        # Lines are read in a thread, so that a hung engine can be timed out
+        self._lines = queue.Queue()
+        self._reader = threading.Thread(target=self._read_lines, daemon=True)
+        self._reader.start()
         self.move_history = []
         self.board_size = board_size
         self.komi = komi
         self.time_limit = time_limit
+        self.timeout = timeout
+        self.failed = False
         self._board = [['.'] * self.board_size for _ in range(self.board_size)]
 
-    def send_command(self, command, timeout=10):
-        self.process.stdin.write(command + '\n')
-        self.process.stdin.flush()
-        return self.get_response(timeout=timeout)
-
+    def _read_lines(self):
+        for line in self.process.stdout:
+            self._lines.put(line)
+        self._lines.put(None)  # end of output
+
+    def send_command(self, command, timeout=None):
+        if self.failed:
+            return FAILED_RESPONSE
+        with tracing.span("gtp.command", "gtp", command=command.split()[0]):
+            try:
+                self.process.stdin.write(command + '\n')
+                self.process.stdin.flush()
+            except OSError:
+                logging.warning("GTP engine exited, deem resigning.")
+                self.failed = True
+                return FAILED_RESPONSE
+            return self.get_response(timeout=timeout or self.timeout)
+
+    @tracing.traced("gtp.wait", "gtp")
     def get_response(self, timeout):
         response = []
         start_time = time.time()
         while True:
-            line = self.process.stdout.readline().strip()
+            try:
+                line = self._lines.get(timeout=max(start_time + timeout - time.time(), 0))
+            except queue.Empty:
+                logging.warning(f"Command timed out after {timeout} seconds, deem resigning.")
+                # A late answer would be taken for the answer to the next command, the engine is out of the game
+                self.failed = True
+                return FAILED_RESPONSE
+            if line is None:
+                logging.warning("GTP engine exited, deem resigning.")
+                self.failed = True
+                return FAILED_RESPONSE
+            line = line.strip()
             if line == '':
-                break
+                if response:
+                    break
+                continue  # blank line before a response
             response.append(line)
 
-            if time.time() - start_time > timeout:
-                print(f"Command timed out after {timeout} seconds, deem resigning.")
-                return "resign"
-
         return response
 
     def start_game(self):
@@ -70,17 +119,20 @@ class LeelaZeroWrapper:
 
     def play_move(self, color, move):
         response = self.send_command(f"play {color} {move}")
-        print(f"play {color} {move}")
         if response[0].startswith('='):
-            self.move_history[self._n][color] = move
+            self.move_history[self._n][color] = 'PASS' if move.lower() == 'pass' else move
             self.update_internal_board(color, move)
         return response
 
+    @tracing.traced("leela.genmove", "leela")
     def get_leela_move(self, color):
         response = self.send_command(f"genmove {color}")
         move = response[0].split()[-1]
+        if not response[0].startswith('=') or not self._is_valid_move(move):
+            logging.warning(f"Malformed genmove response: {response}, deem resigning.")
+            return 'resign'
         if move.lower() == 'pass':
-            self.move_history[self._n][color] = None
+            self.move_history[self._n][color] = 'PASS'
         elif move.lower() == 'resign':
             return 'resign'
         else:
@@ -88,6 +140,12 @@ class LeelaZeroWrapper:
             self.update_internal_board(color, move)
         return move
 
+    def _is_valid_move(self, move):
+        if move.lower() in ('pass', 'resign'):
+            return True
+        return (len(move) in (2, 3) and move[0].upper() in 'ABCDEFGHJKLMNOPQRST'[:self.board_size]
+                and move[1:].isdigit() and 1 <= int(move[1:]) <= self.board_size)
+
     def is_game_over(self):
         flattened_history = []
         for i in range(1, self.n+1):
@@ -95,10 +153,15 @@ class LeelaZeroWrapper:
 
         if len(flattened_history) < 2:
             return False
-        return flattened_history[-1].lower() is None and flattened_history[-2].lower() is None
+        return flattened_history[-1] == 'PASS' and flattened_history[-2] == 'PASS'
 
+    @tracing.traced("leela.final_score", "scoring")
     def get_final_score(self):
-        return self.send_command("final_score")[0].split()[-1]
+        response = self.send_command("final_score")
+        if self.failed or not response[0].startswith('='):
+            logging.warning(f"No final score from the engine: {response}")
+            return '?'
+        return response[0].split()[-1]
 
     def show_internal_board(self):
         # Column labels (skipping 'I')
@@ -120,65 +183,189 @@ class LeelaZeroWrapper:
         self.process.wait()
 
 
-def play_game(leela, agent, agent_color):
+@tracing.traced("score.estimate", "scoring")
+def estimate_margin(game: GoGame) -> float:
+    """Black's lead by area count on the local rules, cheap but only meaningful once the territory is settled"""
+    game.calculate_score()
+    return game.black_score - game.white_score
+
+
+def play_game(leela, agent, agent_color,
+              score_interval=None,
+              resign_margin=None,
+              resign_plies=10,
+              max_moves=None,
+              move_limit_result='score',
+              verbose=False):
+    """
+    Play one game between the agent and Leela Zero, and return its record.
+    :param score_interval: plies between two `final_score` queries to Leela during the game, None to score at the
+        end only
+    :param resign_margin: the game is adjudicated as resigned when the estimated margin (see estimate_margin) stays
+        at least this decisive for `resign_plies` consecutive plies, None to disable
+    :param resign_plies: plies the margin must stay decisive for
+    :param max_moves: plies after which the game stops, None for no limit
+    :param move_limit_result: 'score' to score a game stopped by the move limit, 'draw' to declare it drawn
+    :param verbose: print the board and every move
+    """
+    assert move_limit_result in ('score', 'draw'), f"Invalid move limit result: {move_limit_result}"
     leela.start_game()
+    # The local rules keep track of the position for adjudication, Leela stays the reference for the final score
+    game = GoGame("B", leela.komi)
     current_color = 'black'
-    is_resign = False
+    opponent_color = 'white' if agent_color == 'black' else 'black'
+    result = None
+    adjudication = None
+    decisive_plies = 0
+    n_moves = 0
+    start_time = time.time()
+    engine_seconds = {agent_color: 0.0, opponent_color: 0.0}
+    scoring_seconds = 0.0
 
     while True:
-        print("\nCurrent board state:")
-        print(f"Agent: {agent_color}")
-        print(f"Leela: {oppenent_color}")
-        print(leela.show_internal_board())
+        if verbose:
+            print("\nCurrent board state:")
+            print(f"Agent: {agent_color}")
+            print(f"Leela: {opponent_color}")
+            print(leela.show_internal_board())
 
         if current_color == 'black':
             leela.next_round()
+        move_start_time = time.time()
         if current_color == agent_color:
-            move = agent.predict_next_move_with_leela(leela.move_history)
-            print(f"GoFormer plays: {move}")
-
-            if move.lower() == 'pass':
-                leela.move_history[leela.n][current_color] = None
-            elif move.lower() == 'resign':
-                print(f"Agent resigns. Game over!")
-                is_resign = True
+            with tracing.span("goformer.move", "agent"):
+                move = agent.predict_next_move_with_leela(leela.move_history)
+            engine_seconds[current_color] += time.time() - move_start_time
+            if move.lower() == 'resign':
+                adjudication = 'resign'
+                result = f"{opponent_color[0].upper()}+R"
+                if verbose:
+                    print("Agent resigns. Game over!")
                 break
-            else:
-                leela.play_move(current_color, move)
+            if move.lower() != 'pass' and not leela.play_move(current_color, move)[0].startswith('='):
+                logging.warning(f"Leela rejected GoFormer's move {move}, passing instead")
+                move = 'pass'
+            if move.lower() == 'pass':
+                leela.play_move(current_color, 'pass')
+            if verbose:
+                print(f"GoFormer plays: {move}")
         else:
             move = leela.get_leela_move(current_color)
+            engine_seconds[current_color] += time.time() - move_start_time
             if move == 'resign':
-                print(f"Leela resigns. Game over!")
-                is_resign = True
+                adjudication = 'resign'
+                result = f"{agent_color[0].upper()}+R"
+                if verbose:
+                    print("Leela resigns. Game over!")
                 break
-            print(f"Leela Zero plays: {move}")
-
-        final_score = leela.get_final_score()
-        print(f"Final score: {final_score}")
-
-        if leela.is_game_over() or is_resign:
-            print("Both players passed. Game over!")
-            final_score = leela.get_final_score()
-            print(f"Final score: {final_score}")
+            if verbose:
+                print(f"Leela Zero plays: {move}")
+        if not game.play(move):
+            logging.warning(f"Move {move} rejected by the local rules, the margin estimate may drift")
+            game.pass_turn()
+        n_moves += 1
+
+        if leela.is_game_over():
+            if verbose:
+                print("Both players passed. Game over!")
+            break
+        if max_moves is not None and n_moves >= max_moves:
+            adjudication = 'move_limit'
+            if move_limit_result == 'draw':
+                result = '0'
             break
 
-        current_color = 'white' if current_color == 'black' else 'black'
-
-    leela.close()
-
-# Usage
-leela_path = "/usr/local/bin/leelaz"  # Replace with your actual path
-leela = LeelaZeroWrapper(leela_path,
-                         weight_path=os.path.expanduser('~/.local/share/leela-zero/weights.txt'),
-                         )
-
-
-colors = ['black', 'white']
-random.shuffle(colors)
-agent_color = colors[0]
-oppenent_color = colors[1]
-agent = GoFormer("kenhktsui/goformer-v0.1", 'b' if agent_color == 'black' else 'w')
+        if score_interval and n_moves % score_interval == 0:
+            scoring_start_time = time.time()
+            score = leela.get_final_score()
+            scoring_seconds += time.time() - scoring_start_time
+            if verbose:
+                print(f"Score after {n_moves} moves: {score}")
+
+        if resign_margin is not None:
+            scoring_start_time = time.time()
+            margin = estimate_margin(game)
+            scoring_seconds += time.time() - scoring_start_time
+            # consecutive plies with the same side decisively ahead
+            if abs(margin) >= resign_margin and (decisive_plies == 0 or (margin > 0) == (previous_margin > 0)):
+                decisive_plies += 1
+            else:
+                decisive_plies = int(abs(margin) >= resign_margin)
+            previous_margin = margin
+            if decisive_plies >= resign_plies:
+                adjudication = 'margin'
+                result = f"{'B' if margin > 0 else 'W'}+R"
+                break
 
-print(f"GoFormer are playing as {agent_color}")
+        current_color = 'white' if current_color == 'black' else 'black'
 
-play_game(leela, agent, agent_color)
+    if result is None:
+        scoring_start_time = time.time()
+        result = leela.get_final_score()
+        scoring_seconds += time.time() - scoring_start_time
+    if verbose:
+        print(f"Final score: {result}")
+    winner = {'B': 'black', 'W': 'white'}.get(result[0].upper())
+    return {
+        "agent_color": agent_color,
+        "moves": n_moves,
+        "result": result,
+        "winner": winner,
+        "agent_score": 0.5 if winner is None else float(winner == agent_color),
+        "adjudication": adjudication,
+        "seconds": time.time() - start_time,
+        "agent_seconds": engine_seconds[agent_color],
+        "leela_seconds": engine_seconds[opponent_color],
+        "scoring_seconds": scoring_seconds,
+    }
+
+
+if __name__ == '__main__':
+    from goformer.goformer import GoFormer
+
+    parser = argparse.ArgumentParser(description="Play GoFormer against Leela Zero")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--leelaz", default=LEELA_ZERO_PATH, help="path of the Leela Zero binary")
+    parser.add_argument("--weights", default=os.path.expanduser('~/.local/share/leela-zero/weights.txt'))
+    parser.add_argument("--games", type=int, default=1)
+    parser.add_argument("--score-interval", type=int, default=None,
+                        help="plies between two score queries to Leela, scored at the end only by default")
+    parser.add_argument("--resign-margin", type=float, default=None,
+                        help="adjudicate a game as resigned when the estimated margin stays this decisive")
+    parser.add_argument("--resign-plies", type=int, default=10)
+    parser.add_argument("--max-moves", type=int, default=None)
+    parser.add_argument("--move-limit-result", choices=["score", "draw"], default="score")
+    parser.add_argument("--verbose", action="store_true", help="print the board and every move")
+    parser.add_argument("--trace", default=None, metavar="DIR",
+                        help="record a timeline of every stage into DIR, see goformer.tracing")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    logging.getLogger("goformer.rules").setLevel(logging.WARNING)
+    if args.trace:
+        tracing.enable(args.trace)
+    agents = {}
+    for game_index in range(args.games):
+        colors = ['black', 'white']
+        random.shuffle(colors)
+        agent_color = colors[0]
+        if agent_color not in agents:
+            agents[agent_color] = GoFormer(args.model, 'b' if agent_color == 'black' else 'w')
+        print(f"GoFormer is playing as {agent_color}")
+
+        leela = LeelaZeroWrapper(args.leelaz, weight_path=args.weights)
+        try:
+            with tracing.game(game_index):
+                record = play_game(leela, agents[agent_color], agent_color,
+                                   score_interval=args.score_interval,
+                                   resign_margin=args.resign_margin,
+                                   resign_plies=args.resign_plies,
+                                   max_moves=args.max_moves,
+                                   move_limit_result=args.move_limit_result,
+                                   verbose=args.verbose)
+        finally:
+            leela.close()
+        print(f"Result: {record['result']} ({record['moves']} moves"
+              f"{', adjudicated: ' + record['adjudication'] if record['adjudication'] else ''}), "
+              f"{record['seconds']:.1f}s of which GoFormer {record['agent_seconds']:.1f}s, "
+              f"Leela {record['leela_seconds']:.1f}s, scoring {record['scoring_seconds']:.1f}s")
@@ -0,0 +1,131 @@
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import argparse
+import logging
+import random
+import time
+import numpy as np
+from goformer.goformer import GoFormer, Round, alphabets_wo_I
+from goformer.rules import INVERSE_SYMMETRIES, N_SYMMETRIES, SYMMETRIES
+
+
+def transform_move(move: Optional[str], symmetry: int) -> Optional[str]:
+    """Apply one of the 8 board symmetries to a GTP move; PASS, resign and None are unchanged"""
+    if move is None or move in ("PASS", "resign"):
+        return move
+    i, j = SYMMETRIES[symmetry](alphabets_wo_I.index(move[0]), int(move[1:]) - 1)
+    return f"{alphabets_wo_I[i]}{j + 1}"
+
+
+def transform_rounds(memory_of_moves: List[Round], symmetry: int) -> List[Round]:
+    return [Round(n=r.n, black_move=transform_move(r.black_move, symmetry),
+                  white_move=transform_move(r.white_move, symmetry))
+            for r in memory_of_moves]
+
+
+class SymmetryEnsemble:
+    """
+    Averages GoFormer's move distribution over board symmetries.
+    The move text is a pure coordinate encoding, so every history can be rotated or reflected; the transformed
+    histories are evaluated as one padded batch and each distribution is mapped back to the original orientation.
+    """
+    def __init__(self, agent: GoFormer, n_symmetries: int = N_SYMMETRIES, randomize: bool = False):
+        """
+        :param agent: the GoFormer to ensemble
+        :param n_symmetries: number of symmetries averaged, from 1 (plain GoFormer) to 8
+        :param randomize: draw a random subset of symmetries for every position instead of the first n_symmetries
+        """
+        assert 1 <= n_symmetries <= N_SYMMETRIES, f"Invalid number of symmetries: {n_symmetries}"
+        self._agent = agent
+        self._n_symmetries = n_symmetries
+        self._randomize = randomize
+
+    def _symmetries(self) -> List[int]:
+        if self._randomize:
+            return random.sample(range(N_SYMMETRIES), self._n_symmetries)
+        return list(range(self._n_symmetries))
+
+    def move_distribution(self, memory_of_moves: List[Round], color: Optional[str] = None,
+                          legal_moves: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """Same as GoFormer.move_distribution, averaged over the symmetries"""
+        symmetries = self._symmetries()
+        if legal_moves is not None:
+            legal_moves = list(legal_moves)
+        distributions = self._agent.move_distribution_batch(
+            [transform_rounds(memory_of_moves, s) for s in symmetries],
+            [color] * len(symmetries),
+            None if legal_moves is None else [[transform_move(m, s) for m in legal_moves] for s in symmetries],
+        )
+        ensemble = {}
+        for s, distribution in zip(symmetries, distributions):
+            inverse = INVERSE_SYMMETRIES[s]
+            for move, p in distribution.items():
+                original = transform_move(move, inverse)
+                ensemble[original] = ensemble.get(original, 0.0) + p / len(symmetries)
+        return ensemble
+
+    def predict_next_move(self, memory_of_moves: List[Round], color: Optional[str] = None,
+                          legal_moves: Optional[Iterable[str]] = None) -> str:
+        """Output format compatible with GTP protocol"""
+        distribution = self.move_distribution(memory_of_moves, color, legal_moves)
+        move = max(distribution, key=distribution.get)
+        logging.debug(f"GoFormer ensemble output: {move} at {distribution[move]}")
+        return move
+
+    def predict_next_move_with_leela(self, leela_move_history: Dict[int, dict]) -> str:
+        """Output format compatible with GTP protocol, mainly used for simulation"""
+        return self.predict_next_move(self._agent.history_to_model_rounds(leela_move_history))
+
+    def make_move(self, game) -> Union[str, Tuple[int, int]]:
+        """Output format compatible with game.py"""
+        legal_moves = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+        move = self.predict_next_move(self._agent.history_to_model_rounds(game.get_move_history()),
+                                      legal_moves=legal_moves)
+        return GoFormer.to_game_move(move)
+
+
+def benchmark(agent: GoFormer, memory_of_moves: List[Round], n_symmetries: int = N_SYMMETRIES,
+              repeats: int = 10) -> Dict[str, float]:
+    """Median latency in seconds of n_symmetries histories evaluated as one batch versus one after another"""
+    histories = [transform_rounds(memory_of_moves, s) for s in range(n_symmetries)]
+    agent.move_distribution(memory_of_moves)  # warm up
+
+    single, batched, sequential = [], [], []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        agent.move_distribution(memory_of_moves)
+        single.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        agent.move_distribution_batch(histories)
+        batched.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        for history in histories:
+            agent.move_distribution(history)
+        sequential.append(time.perf_counter() - start_time)
+    return {"single": float(np.median(single)), "batched": float(np.median(batched)),
+            "sequential": float(np.median(sequential))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the symmetry ensemble: batched versus sequential")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[1, 25, 50], help="game lengths to benchmark")
+    parser.add_argument("--symmetries", type=int, default=N_SYMMETRIES)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    agent = GoFormer(args.model, 'b')
+    rng = random.Random(0)
+    points = [f"{x}{y}" for x in alphabets_wo_I for y in range(1, 20)]
+    for n_rounds in args.rounds:
+        moves = rng.sample(points, 2 * (n_rounds - 1))
+        history = [Round(n=i + 1, black_move=moves[2 * i], white_move=moves[2 * i + 1]) for i in range(n_rounds - 1)]
+        history.append(Round(n=n_rounds, black_move=None, white_move=None))
+        result = benchmark(agent, history, args.symmetries, args.repeats)
+        print(f"{n_rounds} rounds: single {result['single'] * 1000:.1f}ms, "
+              f"{args.symmetries} batched {result['batched'] * 1000:.1f}ms "
+              f"(+{(result['batched'] / result['single'] - 1):.0%}), "
+              f"{args.symmetries} sequential {result['sequential'] * 1000:.1f}ms "
+              f"(+{(result['sequential'] / result['single'] - 1):.0%})")
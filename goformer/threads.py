@@ -0,0 +1,185 @@
+from typing import Dict, List, Optional
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+import torch
+
+
+THREAD_CONFIG_ENV = "GOFORMER_THREAD_CONFIG"
+DEFAULT_THREAD_CONFIG_PATH = os.path.expanduser("~/.config/goformer/threads.json")
+
+_threads_configured = False
+
+
+def thread_config_path() -> str:
+    return os.environ.get(THREAD_CONFIG_ENV, DEFAULT_THREAD_CONFIG_PATH)
+
+
+def set_threads(intra_op_threads: int, interop_threads: Optional[int] = None):
+    """Set torch's thread pools of this process; a thread config file is not applied afterwards"""
+    global _threads_configured
+    torch.set_num_threads(intra_op_threads)
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # it can only be set once, before any inter-op parallel work
+            logging.debug("Inter-op threads already set, keeping them")
+    _threads_configured = True
+
+
+def load_thread_config(path: Optional[str] = None) -> Optional[dict]:
+    path = path or thread_config_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_thread_config(path: Optional[str] = None) -> Optional[dict]:
+    """
+    Apply the thread layout recommended by the tuner, once per process, unless threads were set explicitly.
+    Returns the config applied, if any.
+    """
+    if _threads_configured:
+        return None
+    config = load_thread_config(path)
+    if config is None:
+        return None
+    set_threads(config["intra_op_threads"], config.get("interop_threads"))
+    logging.debug(f"Applied thread config {thread_config_path() if path is None else path}: "
+                  f"{config['intra_op_threads']} intra-op threads")
+    return config
+
+
+_bench_agent = None
+_bench_barrier = None
+
+
+def _init_bench_worker(artifact_dir: str, intra_op_threads: int, barrier):
+    global _bench_agent, _bench_barrier
+    from goformer.goformer import GoFormer
+    from goformer.threads import set_threads  # this module may run as __main__, mark the imported one configured
+    set_threads(intra_op_threads, 1)
+    logging.getLogger().setLevel(logging.WARNING)
+    _bench_agent = GoFormer(artifact_dir, 'b')
+    _bench_barrier = barrier
+
+
+def _bench(task: dict) -> dict:
+    from goformer.goformer import Round, alphabets_wo_I
+    rng = random.Random(task["seed"])
+    points = [f"{x}{y}" for x in alphabets_wo_I for y in range(1, 20)]
+    histories = []
+    for _ in range(task["batch_size"]):
+        n_rounds = rng.randint(1, task["max_rounds"])
+        moves = rng.sample(points, 2 * (n_rounds - 1))
+        history = [Round(n=i + 1, black_move=moves[2 * i], white_move=moves[2 * i + 1]) for i in range(n_rounds - 1)]
+        histories.append(history + [Round(n=n_rounds, black_move=None, white_move=None)])
+    _bench_agent.move_distribution_batch(histories)  # warm up
+    _bench_barrier.wait(timeout=task["barrier_timeout"])  # every worker measures at the same time
+
+    # time.monotonic is shared by the processes of a machine, so the batches of every worker can be lined up
+    batches = []
+    start_time = time.monotonic()
+    while time.monotonic() - start_time < task["duration"]:
+        batch_start_time = time.monotonic()
+        _bench_agent.move_distribution_batch(histories)
+        batches.append((batch_start_time, time.monotonic()))
+    return {"batch_size": task["batch_size"], "batches": batches}
+
+
+def benchmark_layout(artifact_dir: str, workers: int, intra_op_threads: int, batch_size: int,
+                     duration: float = 5.0, max_rounds: int = 40) -> Dict[str, float]:
+    """
+    Moves per second of `workers` processes evaluating batches at once, and the p99 latency of a batch.
+    The workers start together on a barrier, and the throughput counts the batches run while all of them were
+    running, over that window of wall time.
+    """
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    with context.Pool(workers, initializer=_init_bench_worker,
+                      initargs=(artifact_dir, intra_op_threads, barrier)) as pool:
+        results = pool.map(_bench, [{"seed": i, "batch_size": batch_size, "duration": duration,
+                                     "max_rounds": max_rounds, "barrier_timeout": 60 + 10 * duration}
+                                    for i in range(workers)], chunksize=1)
+    window_start = max(r["batches"][0][0] for r in results)
+    window_end = min(r["batches"][-1][1] for r in results)
+    moves = sum(batch_size for r in results for start, end in r["batches"]
+                if start >= window_start and end <= window_end)
+    latencies = np.array([end - start for r in results for start, end in r["batches"]])
+    return {"workers": workers, "intra_op_threads": intra_op_threads, "batch_size": batch_size,
+            "moves_per_second": moves / (window_end - window_start) if window_end > window_start else 0.0,
+            "p99_latency": float(np.percentile(latencies, 99))}
+
+
+def tune(artifact_dir: str,
+         worker_counts: List[int],
+         thread_counts: List[int],
+         batch_sizes: List[int],
+         duration: float = 5.0,
+         objective: str = "throughput",
+         oversubscribe: bool = False) -> List[Dict[str, float]]:
+    """
+    Benchmark every layout of workers x intra-op threads x batch size, best first according to `objective`
+    ("throughput" for moves per second, "latency" for p99 batch latency). Layouts using more threads than cores are
+    skipped unless `oversubscribe`.
+    """
+    assert objective in ("throughput", "latency"), f"Invalid objective: {objective}"
+    cores = os.cpu_count()
+    results = []
+    for workers, threads, batch_size in itertools.product(worker_counts, thread_counts, batch_sizes):
+        if workers * threads > cores and not oversubscribe:
+            logging.info(f"Skipping {workers} workers x {threads} threads, more than {cores} cores")
+            continue
+        result = benchmark_layout(artifact_dir, workers, threads, batch_size, duration)
+        logging.info(f"{workers} workers x {threads} threads, batch size {batch_size}: "
+                     f"{result['moves_per_second']:.1f} moves/s, p99 {result['p99_latency'] * 1000:.1f}ms")
+        results.append(result)
+    if not results:
+        raise ValueError(f"Every layout uses more threads than the {cores} cores, pass smaller worker and thread "
+                         f"counts or oversubscribe")
+    if objective == "throughput":
+        return sorted(results, key=lambda r: -r["moves_per_second"])
+    return sorted(results, key=lambda r: r["p99_latency"])
+
+
+def write_thread_config(result: Dict[str, float], path: Optional[str] = None, **extra) -> str:
+    path = path or thread_config_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    config = {**result, "interop_threads": 1, "cpu_count": os.cpu_count(), **extra}
+    with open(path + ".tmp", "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the torch thread layout with the best throughput or latency")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="worker processes (default: 1 to cores)")
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="intra-op threads per worker (default: 1 to cores)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per layout")
+    parser.add_argument("--objective", choices=["throughput", "latency"], default="throughput")
+    parser.add_argument("--oversubscribe", action="store_true", help="also try more threads than cores")
+    parser.add_argument("--output", default=None, help=f"config file (default: ${THREAD_CONFIG_ENV} or "
+                                                        f"{DEFAULT_THREAD_CONFIG_PATH})")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    powers_of_two = [n for n in (1, 2, 4, 8, 16, 32, 64, 128) if n <= os.cpu_count()]
+    results = tune(args.model, args.workers or powers_of_two, args.threads or powers_of_two, args.batch_sizes,
+                   args.duration, args.objective, args.oversubscribe)
+    best = results[0]
+    path = write_thread_config(best, args.output, model=args.model, objective=args.objective)
+    print(f"Recommended: {best['workers']} workers x {best['intra_op_threads']} intra-op threads, batch size "
+          f"{best['batch_size']} ({best['moves_per_second']:.1f} moves/s, p99 {best['p99_latency'] * 1000:.1f}ms), "
+          f"written to {path}")
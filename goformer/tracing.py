@@ -0,0 +1,224 @@
+from typing import Dict, List, Optional
+import argparse
+import atexit
+import contextlib
+import functools
+import glob
+import json
+import logging
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+
+
+TRACE_ENV = "GOFORMER_TRACE"  # trace directory, inherited by worker and engine processes
+TRACE_FILE = "trace-{pid}.json"
+
+_writer: Optional["TraceWriter"] = None
+_local = threading.local()
+
+
+class TraceWriter:
+    """
+    Chrome trace events of this process, buffered in memory and appended to <directory>/trace-<pid>.json.
+    A file is a JSON array left open, which trace viewers accept; `merge` joins the files of every process.
+    """
+    def __init__(self, directory: str, buffer_size: int = 4096):
+        """
+        :param directory: where every process of a run writes its file
+        :param buffer_size: events kept in memory between two writes
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, TRACE_FILE.format(pid=self.pid))
+        self._buffer_size = buffer_size
+        self._events: List[dict] = []
+        self._threads = set()
+        self._lock = threading.Lock()
+        with open(self.path, "w") as f:
+            f.write("[\n")
+        self._events.append({"name": "process_name", "ph": "M", "pid": self.pid,
+                             "args": {"name": f"{os.path.basename(sys.argv[0]) or 'python'} {self.pid}"}})
+
+    def add(self, name: str, category: str, start_ns: int, end_ns: int, args: Optional[dict] = None):
+        """A complete event; timestamps are of time.monotonic_ns, shared by the processes of a machine"""
+        thread_id = threading.get_ident()
+        event = {"name": name, "cat": category, "ph": "X", "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000,
+                 "pid": self.pid, "tid": thread_id}
+        if args:
+            event["args"] = args
+        with self._lock:
+            if thread_id not in self._threads:
+                self._threads.add(thread_id)
+                self._events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread_id,
+                                     "args": {"name": threading.current_thread().name}})
+            self._events.append(event)
+            full = len(self._events) >= self._buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+            if events:
+                with open(self.path, "a") as f:
+                    f.write("".join(json.dumps(e) + ",\n" for e in events))
+
+
+class _Span:
+    __slots__ = ("name", "category", "args", "start_ns")
+
+    def __init__(self, name: str, category: str, args: dict):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start_ns = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        writer = _writer
+        if writer is not None:
+            game_id = getattr(_local, "game", None)
+            if game_id is not None:
+                self.args["game"] = game_id
+            writer.add(self.name, self.category, self.start_ns, time.monotonic_ns(), self.args)
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def enable(directory: str, buffer_size: int = 4096):
+    """Trace this process, and the processes it starts, into `directory`"""
+    global _writer
+    if _writer is not None and _writer.directory == directory and _writer.pid == os.getpid():
+        return
+    _writer = TraceWriter(directory, buffer_size)
+    os.environ[TRACE_ENV] = directory
+
+
+def disable():
+    global _writer
+    if _writer is not None:
+        _writer.flush()
+    _writer = None
+    os.environ.pop(TRACE_ENV, None)
+
+
+def enabled() -> bool:
+    return _writer is not None
+
+
+def flush():
+    if _writer is not None:
+        _writer.flush()
+
+
+def span(name: str, category: str = "goformer", **args):
+    """
+    Context manager timing a stage, with the game id of the thread (see `game`) and `args`.
+    A no-op unless tracing is enabled.
+    """
+    if _writer is None:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+
+def traced(name: str, category: str = "goformer"):
+    """Decorator timing every call of a function with `span`"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _writer is None:
+                return function(*args, **kwargs)
+            with _Span(name, category, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def game(game_id):
+    """Tag the spans of this thread with a game id, time the whole game, and write the events when it ends"""
+    previous = getattr(_local, "game", None)
+    _local.game = game_id
+    try:
+        with span("game", "game"):
+            yield
+    finally:
+        _local.game = previous
+        flush()
+
+
+def _after_fork_in_child():
+    global _writer
+    if _writer is not None:
+        # the events buffered by the parent are the parent's to write
+        _writer = TraceWriter(_writer.directory, _writer._buffer_size)
+
+
+def _flush_at_exit_of_forked_process(_):
+    # a forked multiprocessing worker leaves through os._exit, skipping atexit, but runs multiprocessing's finalizers
+    multiprocessing.util.Finalize(None, flush, exitpriority=10)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+multiprocessing.util.register_after_fork(_local, _flush_at_exit_of_forked_process)
+atexit.register(flush)
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
+
+
+def load_events(directory: str) -> List[dict]:
+    """The events of every process traced into `directory`; the last line of a killed process may be cut"""
+    events = []
+    for path in sorted(glob.glob(os.path.join(directory, TRACE_FILE.format(pid="*")))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line in ("", "["):
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping a truncated event of {path}")
+    return events
+
+
+def merge(directory: str, output: str) -> List[dict]:
+    """Write the events of every process into one Chrome trace-event JSON file"""
+    events = load_events(directory)
+    with open(output, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return events
+
+
+def summarize(events: List[dict]) -> Dict[str, Dict[str, float]]:
+    """Count, total and longest duration in seconds of every span name"""
+    summary: Dict[str, Dict[str, float]] = {}
+    for event in events:
+        if event.get("ph") != "X":
+            continue
+        stats = summary.setdefault(event["name"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        stats["count"] += 1
+        stats["seconds"] += event["dur"] / 1e6
+        stats["max_seconds"] = max(stats["max_seconds"], event["dur"] / 1e6)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the trace files of a run into one Chrome trace")
+    parser.add_argument("directory", help="directory given to --trace")
+    parser.add_argument("--output", default="trace.json", help="open it in chrome://tracing or ui.perfetto.dev")
+    args = parser.parse_args()
+
+    events = merge(args.directory, args.output)
+    processes = {e["pid"] for e in events}
+    print(f"{len(events)} events of {len(processes)} processes written to {args.output}")
+    for name, stats in sorted(summarize(events).items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{name:<24} {stats['count']:>8} spans {stats['seconds']:>10.2f}s total "
+              f"{stats['max_seconds'] * 1000:>10.1f}ms max")
@@ -0,0 +1,392 @@
+from typing import Dict, List, Optional, Tuple
+import argparse
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from transformers import AutoConfig, AutoTokenizer
+from goformer.goformer import GoFormer, Round, alphabets_wo_I, model_input_string
+from goformer.rules import BOARD_SIZE, GoGame
+
+
+N_MOVES = BOARD_SIZE * BOARD_SIZE + 1  # the layout of GoFormer.point_logprobs: column * 19 + row, then a pass
+PASS_INDEX = N_MOVES - 1
+MOVES = [f"{alphabets_wo_I[i // BOARD_SIZE]}{i % BOARD_SIZE + 1}" for i in range(N_MOVES - 1)] + ["PASS"]
+
+# slot states
+FREE, REQUEST, BUSY, DONE = 0, 1, 2, 3
+DEFAULT_MAX_TOKENS = 512  # for a model config without its number of positions
+
+
+def max_positions(artifact_dir: str) -> int:
+    """Longest model input of a model, which bounds the prompts and sizes the transport slots"""
+    config = AutoConfig.from_pretrained(artifact_dir)
+    return (getattr(config, "n_positions", None) or getattr(config, "max_position_embeddings", None)
+            or DEFAULT_MAX_TOKENS)
+
+
+def legal_mask(game: GoGame) -> np.ndarray:
+    """[362] the legal moves of the current player in the layout of MOVES, a pass included"""
+    mask = np.zeros(N_MOVES, dtype=bool)
+    for x, y in game.legal_moves():
+        mask[x * BOARD_SIZE + BOARD_SIZE - 1 - y] = True
+    mask[PASS_INDEX] = True
+    return mask
+
+
+class MoveEncoder:
+    """GoFormer's model input of a game, with the tokenizer and config only, for processes without the model"""
+    def __init__(self, artifact_dir: str, version: str = '2', context_window: Optional[int] = None,
+                 context_hop: int = 8):
+        """
+        :param artifact_dir: model name on the Hugging Face Hub or local directory
+        :param version: model input format
+        :param context_window: see GoFormer
+        :param context_hop: see GoFormer
+        """
+        self._tokenizer = AutoTokenizer.from_pretrained(artifact_dir, trust_remote_code=True)
+        self.max_positions = max_positions(artifact_dir)
+        self._version = version
+        self._context_window = context_window
+        self._context_hop = context_hop
+
+    def encode(self, game: GoGame) -> List[int]:
+        """Token ids prompting the move of the current player, as GoFormer.history_to_model_rounds and tokenize"""
+        color = game.current_player.lower()
+        rounds = GoFormer.history_to_rounds(game.get_move_history())
+        if color == 'b' and rounds[-1].white_move is not None:
+            rounds.append(Round(n=rounds[-1].n + 1, black_move=None, white_move=None))
+        text = model_input_string(rounds, self._version, color, self._context_window, self._context_hop,
+                                  self.max_positions)
+        return self._tokenizer(text, add_special_tokens=False)["input_ids"]
+
+
+class SharedMemoryTransport:
+    """
+    A ring of request slots in one shared memory block, between game workers and a model process.
+    A worker owns some slots; it writes a position's token ids and legal-move mask into a slot (submit) and blocks
+    until the model process has written the move distribution back into the same slot (wait). The model process
+    takes the pending slots in ring order (collect), reads them in place and answers a whole batch (respond).
+    Nothing is serialised per move: the slot state lives in the shared block, and two semaphores (the requests
+    pending, and one per slot for its answer) only wake the processes up.
+    The transport is picklable, so it can be given to the worker processes, which attach to the same block.
+    """
+    def __init__(self, n_slots: int, max_tokens: int = DEFAULT_MAX_TOKENS, context=None):
+        """
+        :param n_slots: requests in flight at most, e.g. the games played at once
+        :param max_tokens: longest model input, the max_positions of the model
+        :param context: multiprocessing context of the worker processes
+        """
+        context = context or multiprocessing.get_context("spawn")
+        self.n_slots = n_slots
+        self.max_tokens = max_tokens
+        self._memory = shared_memory.SharedMemory(create=True, size=self._size(n_slots, max_tokens))
+        self._owner = True
+        self._requests = context.Semaphore(0)
+        self._responses = [context.Semaphore(0) for _ in range(n_slots)]
+        self._cursor = 0
+        self._attach()
+        self._state[:] = FREE
+
+    @staticmethod
+    def _layout(n_slots: int, max_tokens: int) -> List[Tuple[str, tuple, type]]:
+        return [("_state", (n_slots,), np.int32), ("_lengths", (n_slots,), np.int32),
+                ("_tokens", (n_slots, max_tokens), np.uint8), ("_legal", (n_slots, N_MOVES), np.bool_),
+                ("_probs", (n_slots, N_MOVES), np.float32)]
+
+    @classmethod
+    def _size(cls, n_slots: int, max_tokens: int) -> int:
+        # every array starts on an 8-byte boundary
+        return sum(-(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+                   for _, shape, dtype in cls._layout(n_slots, max_tokens))
+
+    def _attach(self):
+        offset = 0
+        for name, shape, dtype in self._layout(self.n_slots, self.max_tokens):
+            array = np.ndarray(shape, dtype=dtype, buffer=self._memory.buf, offset=offset)
+            setattr(self, name, array)
+            offset += -(-array.nbytes // 8) * 8
+
+    def __getstate__(self):
+        return {"name": self._memory.name, "n_slots": self.n_slots, "max_tokens": self.max_tokens,
+                "requests": self._requests, "responses": self._responses}
+
+    def __setstate__(self, state):
+        self.n_slots = state["n_slots"]
+        self.max_tokens = state["max_tokens"]
+        self._memory = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._requests = state["requests"]
+        self._responses = state["responses"]
+        self._cursor = 0
+        self._attach()
+
+    # worker side
+    def submit(self, slot: int, tokens: List[int], legal: np.ndarray):
+        """Write a request into a slot owned by the calling worker"""
+        if len(tokens) > self.max_tokens:
+            raise ValueError(f"Model input of {len(tokens)} tokens exceeds the transport's {self.max_tokens}")
+        assert self._state[slot] == FREE, f"Slot {slot} has a request in flight"
+        self._lengths[slot] = len(tokens)
+        self._tokens[slot, :len(tokens)] = tokens
+        self._legal[slot] = legal
+        self._state[slot] = REQUEST
+        self._requests.release()
+
+    def wait(self, slot: int, timeout: Optional[float] = None) -> np.ndarray:
+        """
+        Block until the slot is answered, and return its move distribution in the layout of MOVES.
+        The array is the slot's memory: it is valid until the next submit to this slot.
+        """
+        if not self._responses[slot].acquire(timeout=timeout):
+            raise TimeoutError(f"No answer for slot {slot} after {timeout}s")
+        self._state[slot] = FREE
+        return self._probs[slot]
+
+    # model side
+    def collect(self, max_batch: int, timeout: Optional[float] = None) -> List[int]:
+        """Wait for a request, then take up to `max_batch` pending slots in ring order"""
+        if not self._requests.acquire(timeout=timeout):
+            return []
+        n_requests = 1
+        while n_requests < max_batch and self._requests.acquire(block=False):
+            n_requests += 1
+        # every request acquired has set its state before releasing the semaphore
+        order = np.roll(np.arange(self.n_slots), -self._cursor)
+        slots = order[self._state[order] == REQUEST][:n_requests]
+        self._state[slots] = BUSY
+        self._cursor = (int(slots[-1]) + 1) % self.n_slots
+        return slots.tolist()
+
+    def request(self, slot: int) -> Tuple[List[int], np.ndarray]:
+        return self._tokens[slot, :self._lengths[slot]].tolist(), self._legal[slot]
+
+    def respond(self, slots: List[int], probs: np.ndarray):
+        """Write the distributions [len(slots), 362] of collected slots and wake their workers"""
+        self._probs[slots] = probs
+        self._state[slots] = DONE
+        for slot in slots:
+            self._responses[slot].release()
+
+    def close(self):
+        for name, _, _ in self._layout(self.n_slots, self.max_tokens):
+            setattr(self, name, None)  # the block cannot be closed while arrays view it
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+class PickleTransport:
+    """
+    The same interface over multiprocessing queues, pickling every request and answer, to compare with
+    SharedMemoryTransport. Slot i belongs to worker i // slots_per_worker.
+    """
+    def __init__(self, n_slots: int, slots_per_worker: int, context=None):
+        context = context or multiprocessing.get_context("spawn")
+        self.n_slots = n_slots
+        self._slots_per_worker = slots_per_worker
+        self._requests = context.Queue()
+        self._responses = [context.Queue() for _ in range(-(-n_slots // slots_per_worker))]
+        self._answers: Dict[int, np.ndarray] = {}
+        self._collected: Dict[int, Tuple[List[int], np.ndarray]] = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_answers"], state["_collected"] = {}, {}
+        return state
+
+    def submit(self, slot: int, tokens: List[int], legal: np.ndarray):
+        self._requests.put((slot, tokens, legal))
+
+    def wait(self, slot: int, timeout: Optional[float] = None) -> np.ndarray:
+        responses = self._responses[slot // self._slots_per_worker]
+        while slot not in self._answers:
+            try:
+                answered_slot, probs = responses.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No answer for slot {slot} after {timeout}s")
+            self._answers[answered_slot] = probs
+        return self._answers.pop(slot)
+
+    def collect(self, max_batch: int, timeout: Optional[float] = None) -> List[int]:
+        requests = []
+        try:
+            requests.append(self._requests.get(timeout=timeout))
+            while len(requests) < max_batch:
+                requests.append(self._requests.get_nowait())
+        except queue.Empty:
+            pass
+        for slot, tokens, legal in requests:
+            self._collected[slot] = (tokens, legal)
+        return [slot for slot, _, _ in requests]
+
+    def request(self, slot: int) -> Tuple[List[int], np.ndarray]:
+        return self._collected.pop(slot)
+
+    def respond(self, slots: List[int], probs: np.ndarray):
+        for slot, p in zip(slots, probs):
+            self._responses[slot // self._slots_per_worker].put((slot, p))
+
+    def close(self):
+        pass
+
+
+def distributions(logprobs: np.ndarray, legal: np.ndarray) -> np.ndarray:
+    """[batch, 362] probabilities renormalised over the legal moves"""
+    logprobs = np.where(legal, logprobs, -np.inf)
+    probs = np.exp(logprobs - logprobs.max(axis=1, keepdims=True))
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
+def serve(agent: Optional[GoFormer], transport, max_batch: int = 64, stop=None) -> Dict[str, float]:
+    """
+    The model process: answer batches of requests until `stop` (a multiprocessing Event) is set.
+    Without an agent, every answer is the uniform distribution over the legal moves, to measure the transport alone.
+    """
+    n_batches = n_requests = 0
+    model_seconds = 0.0
+    while stop is None or not stop.is_set():
+        slots = transport.collect(max_batch, timeout=0.1)
+        if not slots:
+            continue
+        requests = [transport.request(slot) for slot in slots]
+        legal = np.stack([r[1] for r in requests])
+        start_time = time.perf_counter()
+        if agent is None:
+            logprobs = np.zeros(legal.shape, dtype=np.float32)
+        else:
+            logprobs = agent.point_logprobs([r[0] for r in requests])
+        transport.respond(slots, distributions(logprobs, legal))
+        model_seconds += time.perf_counter() - start_time
+        n_batches += 1
+        n_requests += len(slots)
+    return {"batches": n_batches, "requests": n_requests, "model_seconds": model_seconds}
+
+
+def sample(probs: np.ndarray, temperature: float, rng: np.random.Generator) -> int:
+    if temperature <= 0:
+        return int(np.argmax(probs))
+    logits = np.log(np.maximum(probs, 1e-12)) / temperature
+    probs = np.exp(logits - logits.max())
+    return int(rng.choice(len(probs), p=probs / probs.sum()))
+
+
+def play_games(transport, slots: List[int], artifact_dir: str, config: dict, results):
+    """
+    A headless game worker: one game per slot, played concurrently. All the unfinished games submit their
+    position, then the worker waits for their answers, so that the model process can batch them.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    encoder = MoveEncoder(artifact_dir, context_window=config["context_window"])
+    games = {slot: GoGame("B", config["komi"]) for slot in slots}
+    rngs = {slot: np.random.default_rng([config["seed"], slot]) for slot in slots}
+    n_moves = {slot: 0 for slot in slots}
+    wait_seconds = 0.0
+    active = list(slots)
+    while active:
+        for slot in active:
+            transport.submit(slot, encoder.encode(games[slot]), legal_mask(games[slot]))
+        still_active = []
+        for slot in active:
+            start_time = time.perf_counter()
+            probs = transport.wait(slot)
+            wait_seconds += time.perf_counter() - start_time
+            temperature = config["temperature"] if n_moves[slot] < config["temperature_moves"] else 0.0
+            games[slot].play(MOVES[sample(probs, temperature, rngs[slot])])
+            n_moves[slot] += 1
+            if not games[slot].game_over and n_moves[slot] < config["max_moves"]:
+                still_active.append(slot)
+        active = still_active
+    results.put({"moves": sum(n_moves.values()), "games": len(slots), "wait_seconds": wait_seconds})
+
+
+def run_arena(artifact_dir: str, n_games: int, workers: int = 4, transport: str = "shm", max_batch: int = 64,
+              max_moves: int = 100, temperature: float = 1.0, temperature_moves: int = 30,
+              context_window: Optional[int] = None, uniform: bool = False, komi: float = 7.5,
+              seed: int = 0) -> Dict[str, float]:
+    """
+    Play `n_games` headless games spread over `workers` processes, with this process as the model process,
+    and measure the throughput of the transport ("shm" or "pickle")
+    """
+    context = multiprocessing.get_context("spawn")
+    games_per_worker = -(-n_games // workers)
+    if transport == "shm":
+        # the workers' MoveEncoder bounds the prompts to the same number of positions
+        channel = SharedMemoryTransport(n_games, max_positions(artifact_dir), context=context)
+    elif transport == "pickle":
+        channel = PickleTransport(n_games, games_per_worker, context=context)
+    else:
+        raise ValueError(f"Invalid transport: {transport}")
+    processes = []
+    try:
+        agent = None if uniform else GoFormer(artifact_dir, 'b', context_window=context_window)
+        config = {"komi": komi, "seed": seed, "temperature": temperature, "temperature_moves": temperature_moves,
+                  "max_moves": max_moves, "context_window": context_window}
+        results = context.Queue()
+        stop = context.Event()
+        processes = [context.Process(target=play_games,
+                                     args=(channel, list(range(i, min(i + games_per_worker, n_games))),
+                                           artifact_dir, config, results))
+                     for i in range(0, n_games, games_per_worker)]
+        for process in processes:
+            process.start()
+        collector = []
+        failed = []
+
+        def _collect_results():
+            # a worker that died would never answer, and the model process would wait for it forever
+            while len(collector) < len(processes):
+                try:
+                    collector.append(results.get(timeout=1.0))
+                except queue.Empty:
+                    failed.extend(p for p in processes if p.exitcode not in (None, 0))
+                    if failed:
+                        break
+            stop.set()
+
+        thread = threading.Thread(target=_collect_results, daemon=True)
+        start_time = time.time()
+        thread.start()
+        server_stats = serve(agent, channel, max_batch, stop)
+        seconds = time.time() - start_time
+        if failed:
+            raise RuntimeError(f"Game worker(s) {[p.pid for p in failed]} exited with "
+                               f"{[p.exitcode for p in failed]}")
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        channel.close()
+    n_moves = sum(r["moves"] for r in collector)
+    return {"games": n_games, "moves": n_moves, "seconds": seconds, "moves_per_second": n_moves / seconds,
+            "mean_batch": server_stats["requests"] / max(server_stats["batches"], 1),
+            "model_seconds": server_stats["model_seconds"],
+            # time a worker blocks for an answer, per move
+            "wait_ms_per_move": 1000 * sum(r["wait_seconds"] for r in collector) / max(n_moves, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless games served by one model process over a transport")
+    parser.add_argument("--model", default="kenhktsui/goformer-v0.1")
+    parser.add_argument("--games", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--transport", choices=["shm", "pickle", "both"], default="both")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-moves", type=int, default=100, help="plies per game")
+    parser.add_argument("--context-window", type=int, default=None)
+    parser.add_argument("--uniform", action="store_true",
+                        help="answer uniform distributions instead of running the model, to time the transport alone")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in (["shm", "pickle"] if args.transport == "both" else [args.transport]):
+        result = run_arena(args.model, args.games, args.workers, name, args.max_batch, args.max_moves,
+                           context_window=args.context_window, uniform=args.uniform)
+        print(f"{name:>6}: {result['moves']} moves in {result['seconds']:.1f}s, "
+              f"{result['moves_per_second']:.0f} moves/s, mean batch {result['mean_batch']:.1f}, "
+              f"model {result['model_seconds']:.1f}s, wait {result['wait_ms_per_move']:.2f} ms/move")
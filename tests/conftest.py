@@ -0,0 +1,23 @@
+import json
+import os
+import shutil
+import pytest
+
+
+@pytest.fixture(scope="session")
+def artifact_dir(tmp_path_factory):
+    """A tiny random GPT-2 with GoFormer's character tokenizer, saved like a Hub artifact"""
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+    from goformer.tokenizer import AlphabetTokenizer
+
+    path = str(tmp_path_factory.mktemp("artifact"))
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=len(AlphabetTokenizer()), n_positions=512, n_embd=32, n_layer=2,
+                                       n_head=2))
+    model.save_pretrained(path)
+    shutil.copy(os.path.join(os.path.dirname(__file__), "..", "goformer", "tokenizer.py"), path)
+    with open(os.path.join(path, "tokenizer_config.json"), "w") as f:
+        json.dump({"tokenizer_class": "AlphabetTokenizer",
+                   "auto_map": {"AutoTokenizer": ["tokenizer.AlphabetTokenizer", None]}}, f)
+    return path
@@ -0,0 +1,51 @@
+import json
+import os
+import numpy as np
+from goformer.analyze import GAMES_FILE, AnalysisWriter
+
+
+def _write(writer, game_id, n_moves=3):
+    writer.write({"game_id": game_id}, {"ply": np.arange(n_moves), "loss": np.zeros(n_moves, dtype=np.float32)})
+
+
+def _game_ids(output_dir):
+    with open(os.path.join(output_dir, GAMES_FILE)) as f:
+        return [json.loads(line)["game_id"] for line in f]
+
+
+def test_resume_keeps_complete_shards(tmp_path):
+    writer = AnalysisWriter(str(tmp_path), flush_every=2)
+    for game_id in "abcd":
+        _write(writer, game_id)
+    writer = AnalysisWriter(str(tmp_path), flush_every=2)
+    assert writer.completed_game_ids == set("abcd")
+    _write(writer, "e")
+    writer.flush()
+    assert sorted(os.listdir(tmp_path)) == [GAMES_FILE, "moves-00000.npz", "moves-00001.npz", "moves-00002.npz"]
+    with np.load(tmp_path / "moves-00002.npz") as shard:
+        assert shard["game_ids"].tolist() == ["e"]
+
+
+def test_resume_removes_an_orphaned_shard_and_its_games(tmp_path):
+    writer = AnalysisWriter(str(tmp_path), flush_every=2)
+    for game_id in "abcd":
+        _write(writer, game_id)
+    # a flush interrupted after the rename of its shard, while appending the summaries of its games
+    with open(tmp_path / GAMES_FILE) as f:
+        lines = f.readlines()
+    with open(tmp_path / GAMES_FILE, "w") as f:
+        f.writelines(lines[:3])
+        f.write(lines[3][:5])
+    (tmp_path / "moves-00002.npz.tmp").write_bytes(b"cut")
+
+    writer = AnalysisWriter(str(tmp_path), flush_every=2)
+    assert writer.completed_game_ids == {"a", "b"}
+    assert _game_ids(tmp_path) == ["a", "b"]
+    assert sorted(os.listdir(tmp_path)) == [GAMES_FILE, "moves-00000.npz"]
+
+    for game_id in "cd":
+        _write(writer, game_id)
+    assert _game_ids(tmp_path) == list("abcd")
+    with np.load(tmp_path / "moves-00001.npz") as shard:
+        assert shard["game_ids"].tolist() == ["c", "d"]
+        assert shard["offsets"].tolist() == [0, 3, 6]
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from goformer.goformer import GoFormer, Round
+
+
+HISTORIES = [
+    [Round(n=1, black_move=None, white_move=None)],
+    [Round(n=1, black_move="D4", white_move="Q16"), Round(n=2, black_move="C3", white_move=None)],
+    [Round(n=i + 1, black_move=f"D{i + 1}", white_move=f"Q{i + 1}") for i in range(12)]
+    + [Round(n=13, black_move=None, white_move=None)],
+]
+
+
+@pytest.fixture(scope="module")
+def agents(artifact_dir):
+    return {backend: GoFormer(artifact_dir, 'b', backend=backend, exact_scoring=True)
+            for backend in ("eager", "compiled")}
+
+
+def test_compiled_backend_matches_eager(agents):
+    colors = ['b', 'w', 'b']
+    eager = agents["eager"].move_distribution_batch(HISTORIES, colors)
+    compiled = agents["compiled"].move_distribution_batch(HISTORIES, colors)
+    for e, c in zip(eager, compiled):
+        assert e.keys() == c.keys()
+        np.testing.assert_allclose([e[m] for m in e], [c[m] for m in e], rtol=1e-4, atol=1e-6)
+
+
+def test_compiled_suggestions_match_eager(agents):
+    for history in HISTORIES:
+        eager = agents["eager"].suggest_moves(history, n_suggestion=10)
+        compiled = agents["compiled"].suggest_moves(history, n_suggestion=10)
+        assert [m for m, _ in eager] == [m for m, _ in compiled]
+
+
+def test_exact_scoring_is_opt_in(artifact_dir, agents, monkeypatch):
+    default = GoFormer(artifact_dir, 'b')
+    calls = []
+    generate = default._model.generate
+    monkeypatch.setattr(default._model, "generate", lambda **kwargs: calls.append(kwargs) or generate(**kwargs))
+    default.suggest_moves(HISTORIES[1], n_suggestion=5)
+    assert len(calls) == 1  # the beam search by default
+
+    def no_generate(**kwargs):
+        raise AssertionError("exact scoring does not generate")
+    monkeypatch.setattr(agents["eager"]._model, "generate", no_generate)
+    assert len(agents["eager"].suggest_moves(HISTORIES[1], n_suggestion=5)) == 5
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from goformer.batched_rules import BatchedGoGame, random_moves, verify
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_matches_gogame_on_seeded_random_games(seed):
+    assert verify(n_games=4, max_moves=120, seed=seed, pass_rate=0.05) > 0
+
+
+def test_games_end_after_two_passes():
+    assert verify(n_games=8, max_moves=400, seed=3, pass_rate=0.5) > 0
+
+
+def test_skipped_boards_are_left_untouched():
+    batch = BatchedGoGame(2)
+    batch.step(random_moves(batch.legal_mask(), np.random.default_rng(0)))
+    before = batch.to_game(1)
+    batch.step(np.array([0, -1]))
+    assert batch.to_game(1) == before
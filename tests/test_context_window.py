@@ -0,0 +1,35 @@
+import random
+from goformer.goformer import GoFormer, Round, bound_context, model_input_string
+from goformer.rules import GoGame
+
+
+def _random_rounds(n_plies, seed=0):
+    rng = random.Random(seed)
+    game = GoGame("B", 7.5)
+    for _ in range(n_plies):
+        legal_moves = game.legal_moves()
+        if not legal_moves:
+            break
+        game.place_stone(*rng.choice(legal_moves))
+    return GoFormer.history_to_rounds(game.get_move_history())
+
+
+def test_input_length_is_bounded_as_the_game_grows():
+    window, hop = 16, 8
+    # at most window + hop rounds of "123. >Aa Bb" and their separators
+    bound = (window + hop) * len("123. >Aa Bb ")
+    lengths = []
+    for n_plies in (60, 120, 200, 280, 360):
+        rounds = _random_rounds(n_plies)
+        text = model_input_string(rounds, '2', 'b', context_window=window, context_hop=hop)
+        assert len(text) <= bound
+        lengths.append(len(model_input_string(rounds, '2', 'b')))
+    assert lengths[-1] > bound  # the full context is not bounded
+
+
+def test_cut_moves_every_hop_rounds():
+    rounds = [Round(n=i + 1, black_move="D4", white_move="Q16") for i in range(40)]
+    bounded = bound_context(rounds, 16, 8)
+    assert 16 <= len(bounded) <= 24
+    assert bounded[0].n == 41 - len(bounded)
+    assert bound_context(rounds + rounds[:1], 16, 8)[0] is bounded[0]
@@ -0,0 +1,34 @@
+import subprocess
+import sys
+import numpy as np
+from goformer.dedup import Deduplicator, game_hashes, game_points
+
+
+def _hashes(games):
+    points = [game_points(g) for g in games]
+    offsets = np.cumsum([0] + [len(p) for p in points])
+    return game_hashes(np.concatenate(points) if points else np.zeros(0, dtype=np.int16), offsets)
+
+
+def test_trailing_empty_game_keeps_the_last_ply():
+    g1, g2 = ["D4", "Q16", "C3"], ["D4", "Q16", "R3"]
+    assert _hashes([g1])[0] != _hashes([g2])[0]
+    assert _hashes([g1, []])[0] == _hashes([g1])[0]
+    assert _hashes([g1, []])[0] != _hashes([g2, []])[0]
+    assert _hashes([[], g1, [], []])[1] == _hashes([g1])[0]
+
+
+def test_resign_only_record_at_the_end_of_a_chunk(tmp_path):
+    dedup = Deduplicator(str(tmp_path / "index"))
+    assert dedup.process([["D4", "Q16", "C3"], ["resign"]]) == [True, True]
+    assert dedup.process([["D4", "Q16", "R3"], ["resign"]])[0]
+
+
+def test_mirrored_game_is_a_duplicate(tmp_path):
+    dedup = Deduplicator(str(tmp_path / "index"))
+    assert dedup.process([["D4", "Q16"], ["Q4", "D16"]]) == [True, False]
+
+
+def test_import_does_not_load_torch():
+    code = "import sys, goformer.dedup; assert 'torch' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
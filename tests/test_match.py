@@ -0,0 +1,67 @@
+import json
+import pytest
+from goformer.match import (SPRT, MatchStats, elo_to_score, load_results, play_match_game, run_match,
+                            score_to_elo)
+
+
+def _play_game(score):
+    def play_game(game_index, candidate_color):
+        return {"candidate_color": candidate_color, "score": score}
+    return play_game
+
+
+def test_resume_after_a_line_cut_by_an_interruption(tmp_path):
+    path = tmp_path / "results.jsonl"
+    records = [{"game": i, "score": 1.0} for i in range(3)]
+    path.write_text("".join(json.dumps(r) + "\n" for r in records) + '{"game": 3, "sco')
+    assert load_results(str(path)) == records
+    assert path.read_text().endswith("\n")
+
+    result = run_match(_play_game(0.5), str(path), SPRT(), max_games=5)
+    assert result["games"] == 5
+    assert [r["game"] for r in load_results(str(path))] == [0, 1, 2, 3, 4]
+    assert (result["wins"], result["draws"]) == (3, 2)
+
+
+class FirstLegalMove:
+    """A deterministic stand-in agent without a move distribution"""
+    def make_move(self, game):
+        return game.legal_moves()[0]
+
+
+def test_sprt_accepts_a_sweep():
+    stats = MatchStats(wins=19)
+    assert stats.variance == 0.0
+    assert stats.llr(0, 10) > 0
+    sprt = SPRT(0, 10)
+    assert sprt.status(MatchStats(wins=19)) == "H1"
+    assert sprt.status(MatchStats(losses=19)) == "H0"
+    assert sprt.status(MatchStats(wins=3, losses=3)) is None
+
+
+def test_llr_bounds_and_sign():
+    sprt = SPRT(0, 10, alpha=0.05, beta=0.05)
+    assert sprt.lower == pytest.approx(-2.944, abs=1e-3)
+    assert sprt.upper == pytest.approx(2.944, abs=1e-3)
+    assert MatchStats(wins=60, draws=10, losses=40).llr(0, 10) > 0
+    assert MatchStats(wins=40, draws=10, losses=60).llr(0, 10) < 0
+    assert MatchStats().llr(0, 10) == 0.0
+
+
+def test_elo_estimate():
+    elo, low, high = MatchStats(wins=64, losses=36).elo()
+    assert low < elo < high
+    assert elo == pytest.approx(score_to_elo(0.64))
+    assert score_to_elo(elo_to_score(35.0)) == pytest.approx(35.0)
+
+
+def test_openings_are_seeded():
+    agent = FirstLegalMove()
+
+    def moves(seed):
+        return play_match_game(agent, agent, "B", max_moves=12, opening_plies=4, seed=seed)["moves"]
+    assert moves([0, 1]) == moves([0, 1])
+    assert moves([0, 1]) != moves([0, 2])
+    # without an opening, deterministic agents replay the same game whatever the seed
+    assert (play_match_game(agent, agent, "B", max_moves=12, opening_plies=0, seed=1)["moves"]
+            == play_match_game(agent, agent, "B", max_moves=12, opening_plies=0, seed=2)["moves"])
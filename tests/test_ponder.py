@@ -0,0 +1,52 @@
+import threading
+import time
+from goformer.goformer import GoFormer
+from goformer.ponder import Ponderer
+
+
+class SlowAgent:
+    """A stand-in for GoFormer answering every reply with Q16 after `delay` seconds"""
+    color = 'b'
+    history_to_rounds = staticmethod(GoFormer.history_to_rounds)
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = threading.Semaphore(0)
+
+    def suggest_moves(self, memory_of_moves, n_suggestion, color):
+        return [("D4", -1.0), ("Q4", -2.0), ("C3", -3.0)]
+
+    def predict_next_move_with_leela(self, move_history, n_suggestion=19):
+        self.calls.release()
+        time.sleep(self.delay)
+        return "Q16"
+
+
+HISTORY = {1: {"black": "D16"}}
+
+
+def test_hit_is_returned_without_waiting_for_the_call_in_progress():
+    agent = SlowAgent(0.3)
+    ponderer = Ponderer(agent, n_replies=3)
+    ponderer.start(HISTORY)
+    agent.calls.acquire()
+    agent.calls.acquire()  # the answer to D4 is ready, Q4 is in progress
+    start_time = time.time()
+    assert ponderer.take({1: {"black": "D16", "white": "D4"}}) == "Q16"
+    assert time.time() - start_time < 0.1
+    assert ponderer.stats.hits == 1
+
+
+def test_stopped_thread_does_not_race_the_lookup():
+    agent = SlowAgent(0.05)
+    ponderer = Ponderer(agent, n_replies=3)
+    for _ in range(20):
+        ponderer.start(HISTORY)
+        agent.calls.acquire()
+        # the stopped thread finishes its call and writes its answer while the lookup runs
+        assert ponderer.take({1: {"black": "D16", "white": "A1"}}) is None
+    ponderer.stop(wait=True)
+    time.sleep(0.1)
+    assert ponderer.stats.misses == 20
+    assert ponderer.stats.pondered_turns == 20
+
@@ -0,0 +1,99 @@
+import pytest
+from goformer.rules import GoGame
+
+# Black's stone at (2, 1) captures White's at (1, 1), which could then retake at once: a ko
+KO_MOVES = [(1, 0), (2, 0), (0, 1), (3, 1), (1, 2), (2, 2), (10, 10), (1, 1), (2, 1)]
+
+
+def _state(game):
+    return ([row[:] for row in game.board], game.stones_hash, game.previous_stones_hash, game.black_score,
+            game.white_score, game.current_player, game.consecutive_passes, game.game_over, game.resigned,
+            game.winner, {k: dict(v) for k, v in game.move_history.items()})
+
+
+def _play(game, moves):
+    states = [_state(game)]
+    for move in moves:
+        if move == "PASS":
+            game.pass_turn()
+        else:
+            assert game.place_stone(*move)
+        states.append(_state(game))
+    return states
+
+
+def test_ko_capture():
+    game = GoGame("B", 7.5)
+    _play(game, KO_MOVES)
+    assert game.board[1][1] is None
+    assert game.black_score == 1
+    assert not game.is_valid_move(1, 1)  # retaking at once would repeat the position
+
+
+def test_undo_and_redo_round_trip():
+    game = GoGame("B", 7.5)
+    states = _play(game, KO_MOVES + ["PASS", (15, 15)])
+    for state in reversed(states[:-1]):
+        assert game.undo()
+        assert _state(game) == state
+    assert not game.undo()
+    for state in states[1:]:
+        assert game.redo()
+        assert _state(game) == state
+    assert not game.redo()
+
+
+def test_ko_state_is_restored_by_undo():
+    game = GoGame("B", 7.5)
+    _play(game, KO_MOVES + [(15, 15), (16, 16)])
+    assert game.is_valid_move(1, 1)  # White may retake after an exchange elsewhere
+    game.undo()
+    game.undo()
+    assert not game.is_valid_move(1, 1)
+    game.redo()
+    game.redo()
+    assert game.is_valid_move(1, 1)
+
+
+def test_goto_between_variations():
+    game = GoGame("B", 7.5)
+    states = _play(game, KO_MOVES)
+    first_line = game.current_node
+    game.goto_ply(4)
+    assert _state(game) == states[4]
+    other_states = _play(game, [(16, 16), (3, 3)])
+    other_line = game.current_node
+    game.goto(first_line)
+    assert _state(game) == states[-1]
+    game.goto(other_line)
+    assert _state(game) == other_states[-1]
+    assert game.goto_ply(0)
+    assert _state(game) == states[0]
+    assert not game.goto_ply(20)
+
+
+def test_goto_rejects_a_position_of_another_game():
+    game, other = GoGame("B", 7.5), GoGame("B", 7.5)
+    other.place_stone(3, 3)
+    with pytest.raises(ValueError):
+        game.goto(other.current_node)
+
+
+def test_undo_a_resignation():
+    game = GoGame("B", 7.5)
+    states = _play(game, [(3, 3), (15, 15)])
+    game.resign()
+    assert (game.game_over, game.resigned, game.winner) == (True, True, "W")
+    assert game.undo()
+    assert _state(game) == states[-1]
+    assert game.redo()
+    assert (game.game_over, game.resigned, game.winner) == (True, True, "W")
+
+
+def test_undo_the_end_of_a_game():
+    game = GoGame("B", 7.5)
+    states = _play(game, [(3, 3), "PASS", "PASS"])
+    game.end_game()
+    assert game.game_over and game.winner is not None
+    assert game.undo()
+    assert _state(game) == states[-2]
@@ -0,0 +1,58 @@
+from goformer.goformer import model_rounds
+from goformer.rules import GoGame
+from goformer.search import PUCTSearch
+
+
+class UniformAgent:
+    """A stand-in for GoFormer giving every legal move the same probability"""
+    def __init__(self):
+        self.evaluated = 0
+
+    def history_to_model_rounds(self, leela_move_history, color=None):
+        return model_rounds(leela_move_history, color)
+
+    def move_distribution_batch(self, batch_of_moves, colors=None, legal_moves=None):
+        self.evaluated += len(batch_of_moves)
+        return [{m: 1 / len(moves) for m in moves} for moves in legal_moves]
+
+
+def _game(moves):
+    game = GoGame("B", 7.5)
+    for move in moves:
+        game.play(move)
+    return game
+
+
+def test_transposition_reuses_the_evaluation():
+    agent = UniformAgent()
+    searcher = PUCTSearch(agent, max_nodes=1, batch_size=1)
+    searcher.search(_game(["D4", "Q16", "C3"]))
+    evaluated = agent.evaluated
+    result = searcher.search(_game(["C3", "Q16", "D4"]))
+    assert result.transposition_hits >= 1
+    assert agent.evaluated - evaluated < result.simulations + 1
+
+
+def test_ko_state_is_part_of_the_key():
+    agent = UniformAgent()
+    searcher = PUCTSearch(agent, max_nodes=1, batch_size=1)
+    game = _game(["D4", "Q16"])
+    key = searcher._leaf(game, 0, [0]).key
+    game.pass_turn()
+    game.pass_turn()  # same stones and player to move, the passes lifted the Ko
+    assert searcher._leaf(game, 0, [0]).key != key
+
+
+def test_finished_game_is_not_searched():
+    agent = UniformAgent()
+    game = _game(["D4", "PASS", "PASS"])
+    assert game.game_over
+    result = PUCTSearch(agent, max_nodes=8).search(game)
+    assert result.move == "PASS"
+    assert agent.evaluated == 0
+
+
+def test_predict_next_move_with_leela_takes_goformer_arguments():
+    searcher = PUCTSearch(UniformAgent(), max_nodes=4, batch_size=2)
+    move = searcher.predict_next_move_with_leela(_game(["D4"]).get_move_history(), 19, 'w')
+    assert move == "PASS" or _game(["D4"]).play(move)
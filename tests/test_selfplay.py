@@ -0,0 +1,72 @@
+import gzip
+import json
+import os
+import numpy as np
+from goformer.selfplay import ShardWriter, sample_move
+
+
+def _record(game_id):
+    return {"game_id": game_id, "moves": ["D4", "Q16"], "winner": "b", "tokens": [1, 2, 3]}
+
+
+def _shard_game_ids(output_dir):
+    game_ids = []
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith(".jsonl.gz"):
+            with gzip.open(os.path.join(output_dir, name), "rt") as f:
+                game_ids.append([json.loads(line)["game_id"] for line in f])
+    return game_ids
+
+
+def test_chunks_fill_shards_of_the_given_size(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=5)
+    writer.write([_record(i) for i in range(3)])
+    writer.write([_record(i) for i in range(3, 12)])
+    writer.flush()
+    assert _shard_game_ids(tmp_path) == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9], [10, 11]]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".open")]
+
+
+def test_resume_truncates_games_appended_after_the_checkpoint(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=5)
+    writer.write([_record(i) for i in range(7)])
+    with open(tmp_path / "shard-00001.open", "a") as f:
+        # an append interrupted before its checkpoint, cut in the middle of a line
+        f.write(json.dumps(_record(7)) + "\n" + '{"game_id": 8')
+
+    writer = ShardWriter(str(tmp_path), shard_size=5)
+    assert writer.completed_game_ids == set(range(7))
+    writer.write([_record(i) for i in range(7, 10)])
+    writer.flush()
+    assert _shard_game_ids(tmp_path) == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]]
+
+
+def test_resume_after_a_shard_renamed_before_its_checkpoint(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=5)
+    writer.write([_record(i) for i in range(3)])
+    checkpoint = (tmp_path / "checkpoint.json").read_text()
+    open_shard = (tmp_path / "shard-00000.open").read_text()
+    writer.write([_record(i) for i in range(3, 6)])
+    # interrupted after the shard was renamed, before the checkpoint recorded it
+    (tmp_path / "checkpoint.json").write_text(checkpoint)
+    (tmp_path / "shard-00000.open").write_text(open_shard)
+
+    writer = ShardWriter(str(tmp_path), shard_size=5)
+    assert writer.completed_game_ids == {0, 1, 2}
+    assert not (tmp_path / "shard-00001.open").exists()
+    writer.write([_record(i) for i in range(3, 6)])
+    writer.flush()
+    assert _shard_game_ids(tmp_path) == [[0, 1, 2, 3, 4], [5]]
+
+
+def test_token_shards(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=2, output_format="tokens")
+    writer.write([_record(i) for i in range(3)])
+    with np.load(tmp_path / "shard-00000.npz") as shard:
+        assert shard["game_ids"].tolist() == [0, 1]
+        assert shard["offsets"].tolist() == [0, 3, 6]
+
+
+def test_greedy_sampling_at_zero_temperature():
+    rng = np.random.default_rng(0)
+    assert sample_move({"D4": 0.2, "Q16": 0.7, "PASS": 0.1}, 0.0, rng) == "Q16"
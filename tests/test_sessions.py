@@ -0,0 +1,87 @@
+import random
+import numpy as np
+import pytest
+from goformer.goformer import GoFormer
+from goformer.rules import GoGame
+from goformer.sessions import PrefixCache, SessionManager
+
+
+@pytest.fixture(scope="module")
+def agent(artifact_dir):
+    return GoFormer(artifact_dir, 'b')
+
+
+def _serve(agent, manager, n_games=3, n_plies=10, opening=(), seed=0):
+    """Play random games through the manager, checking every distribution against an uncached one"""
+    rng = random.Random(seed)
+    games = {}
+    for i in range(n_games):
+        games[i] = GoGame("B", 7.5)
+        for move in opening:
+            games[i].play(move)
+    for _ in range(n_plies):
+        for i in rng.sample(list(games), len(games)):
+            game = games[i]
+            color = game.current_player.lower()
+            rounds = agent.history_to_model_rounds(game.get_move_history(), color)
+            legal_moves = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+            distribution = manager.move_distribution((i, color), rounds, color, legal_moves)
+            expected = agent.move_distribution(rounds, color, legal_moves)
+            assert distribution.keys() == expected.keys()
+            np.testing.assert_allclose([distribution[m] for m in expected], list(expected.values()), atol=1e-5)
+            game.play(rng.choice(legal_moves[:-1]))
+    return games
+
+
+def test_sessions_match_move_distribution(agent):
+    manager = SessionManager(agent)
+    games = _serve(agent, manager)
+    assert manager.stats.hits > 0
+    assert manager.stats.reused_token_ratio > 0.5
+    for i in games:
+        for color in "bw":
+            manager.close((i, color))
+    assert len(manager) == 0
+    assert manager.stats.resident_bytes == 0
+
+
+def test_budget_evicts_the_least_recently_used_sessions(agent):
+    manager = SessionManager(agent, max_bytes=64 * 1024)
+    _serve(agent, manager, n_games=4, n_plies=6)
+    assert manager.stats.evictions > 0
+    assert manager.stats.resident_bytes <= 64 * 1024
+
+
+def _nodes(node):
+    for child in node.children.values():
+        yield child
+        yield from _nodes(child)
+
+
+@pytest.mark.parametrize("max_bytes", [2 ** 30, 96 * 1024])
+def test_prefix_cache_matches_move_distribution(agent, max_bytes):
+    prefix_cache = PrefixCache(block_size=8, max_bytes=max_bytes)
+    manager = SessionManager(agent, prefix_cache=prefix_cache)
+    games = _serve(agent, manager, opening=("D4", "Q16", "C3", "R4"))
+    assert prefix_cache.stats.hit_tokens > 0
+    assert prefix_cache.stats.resident_bytes <= max_bytes
+    for i in games:
+        for color in "bw":
+            manager.close((i, color))
+    assert all(node.ref_count == 0 for node in _nodes(prefix_cache.root))
+    assert prefix_cache.root.ref_count == 0
+    prefix_cache.evict(0)
+    assert prefix_cache.stats.blocks == 0 and prefix_cache.stats.resident_bytes == 0
+
+
+def test_games_share_their_opening(agent):
+    opening = ("D4", "Q16", "C3", "R4", "D16", "Q3")
+    game = GoGame("B", 7.5)
+    for move in opening:
+        game.play(move)
+    n_tokens = len(agent.tokenize(agent.history_to_model_rounds(game.get_move_history(), 'b'), 'b'))
+    prefix_cache = PrefixCache(block_size=8)
+    manager = SessionManager(agent, prefix_cache=prefix_cache)
+    _serve(agent, manager, n_games=4, n_plies=1, opening=opening)
+    # the first game caches the whole blocks of the opening, the other three find them
+    assert prefix_cache.stats.hit_tokens >= 3 * ((n_tokens - 1) // 8 * 8)
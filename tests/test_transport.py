@@ -0,0 +1,58 @@
+import random
+import numpy as np
+import pytest
+from goformer.goformer import GoFormer
+from goformer.rules import GoGame
+from goformer.transport import MOVES, MoveEncoder, SharedMemoryTransport, distributions, legal_mask, max_positions
+
+
+@pytest.fixture(scope="module")
+def agent(artifact_dir):
+    return GoFormer(artifact_dir, 'b')
+
+
+def _games(n_games=3, n_plies=12, seed=0):
+    rng = random.Random(seed)
+    games = []
+    for i in range(n_games):
+        game = GoGame("B", 7.5)
+        # odd and even lengths, so that both colours are to play
+        for _ in range(n_plies + i):
+            game.play(rng.choice([GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()]))
+        games.append(game)
+    return games
+
+
+def test_legal_mask_follows_the_moves_layout():
+    game = _games(n_games=1)[0]
+    mask = legal_mask(game)
+    assert {MOVES[i] for i in np.flatnonzero(mask)} == \
+        {GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()} | {"PASS"}
+
+
+def test_shared_memory_slots_match_move_distribution(agent, artifact_dir):
+    encoder = MoveEncoder(artifact_dir)
+    games = _games()
+    transport = SharedMemoryTransport(len(games), max_positions(artifact_dir))
+    try:
+        for slot, game in enumerate(games):
+            color = game.current_player.lower()
+            rounds = agent.history_to_model_rounds(game.get_move_history(), color)
+            assert encoder.encode(game) == agent.tokenize(rounds, color)
+            transport.submit(slot, encoder.encode(game), legal_mask(game))
+        slots = transport.collect(max_batch=len(games), timeout=1.0)
+        assert sorted(slots) == list(range(len(games)))
+        requests = [transport.request(slot) for slot in slots]
+        logprobs = agent.point_logprobs([tokens for tokens, _ in requests])
+        transport.respond(slots, distributions(logprobs, np.stack([legal for _, legal in requests])))
+        for slot, game in enumerate(games):
+            color = game.current_player.lower()
+            rounds = agent.history_to_model_rounds(game.get_move_history(), color)
+            legal_moves = [GoFormer.to_gtp_move(x, y) for x, y in game.legal_moves()] + ["PASS"]
+            expected = agent.move_distribution(rounds, color, legal_moves)
+            probs = transport.wait(slot, timeout=1.0)
+            np.testing.assert_allclose([probs[MOVES.index(m)] for m in expected], list(expected.values()),
+                                       atol=1e-5)
+            assert probs[~legal_mask(game)].sum() == 0
+    finally:
+        transport.close()